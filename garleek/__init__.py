@@ -32,7 +32,50 @@ Application layer
   and QM softwares handling the ONIOM calculation (backend)
 """
 
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+import sys
 __author__ = "Jaime Rodriguez-Guerra & Ignacio Funes-Ardoiz"
+
+
+def _get_version():
+    global __version__
+    from ._version import get_versions
+    __version__ = get_versions()['version']
+    return __version__
+
+
+_static_version_string = None
+
+
+def _static_version():
+    """
+    Version for the ``garleek-backend`` banner, never running git: the one
+    versioneer bakes into builds (or expands in git-archive tarballs), and
+    ``0+unknown`` in source checkouts, unless ``__version__`` was resolved.
+    """
+    global _static_version_string
+    if '__version__' in globals():
+        return __version__
+    if _static_version_string is None:
+        from . import _version
+        if hasattr(_version, 'version_json'):  # short file written at build time
+            _static_version_string = _get_version()
+        else:
+            try:
+                _static_version_string = _version.git_versions_from_keywords(
+                    _version.get_keywords(), _version.get_config().tag_prefix,
+                    False)['version']
+            except _version.NotThisMethod:
+                _static_version_string = '0+unknown'
+    return _static_version_string
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # ``__version__`` is resolved on first access: in a source checkout
+        # versioneer shells out to git, which we do not want to pay on
+        # every ``garleek-backend`` launch. Builds ship a static _version.py.
+        if name == '__version__':
+            return _get_version()
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+else:
+    _get_version()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+cache.py
+========
+
+Content-addressed, on-disk cache for files Garleek generates (TINKER
+key files, for example), so they are written once and reused across the
+steps of a calculation, and across calculations.
+
+Files live in ``$GARLEEK_CACHE_DIR`` or, if unset, ``garleek`` inside
+``$XDG_CACHE_HOME`` (``~/.cache`` by default), grouped by namespace. Their
+names are a digest of everything that determines their contents, so an
+existing file is always up to date and is never rewritten. New files are
+written to a temporary file in the same directory and renamed into place,
+so concurrent jobs sharing the cache never see partial contents.
+"""
+
+from __future__ import print_function, absolute_import, division
+import errno
+import hashlib
+import os
+import stat
+from tempfile import NamedTemporaryFile
+
+
+def cache_dir(namespace=None):
+    """
+    Root of the cache, or the directory of ``namespace`` in it.
+    Directories are not created here.
+    """
+    root = os.environ.get('GARLEEK_CACHE_DIR')
+    if not root:
+        xdg = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        root = os.path.join(xdg, 'garleek')
+    if namespace:
+        return os.path.join(root, namespace)
+    return root
+
+
+def private_dir(path):
+    """
+    Create directory ``path`` (not its parents) with mode 0700 if it does
+    not exist, and check that it can hold files only the current user may
+    plant or read: a directory, not a symbolic link, owned by the user.
+    Access by others, if any, is revoked.
+
+    Returns
+    -------
+    ok : bool
+        False if ``path`` cannot be created or belongs to someone else.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return False
+    if not hasattr(os, 'getuid'):  # Windows: no owners nor modes to check
+        return os.path.isdir(path)
+    try:
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            return False
+        if st.st_mode & 0o077:
+            os.chmod(path, 0o700)
+    except OSError:
+        return False
+    return True
+
+
+def digest(*parts):
+    """
+    Hex digest identifying ``parts`` (strings, bytes or anything with a
+    meaningful ``str``; arrays should be passed as ``tobytes()``).
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        h.update(str(len(part)).encode('ascii') + b':' + part)
+    return h.hexdigest()
+
+
+def atomic_write(path, contents):
+    """
+    Write ``contents`` (str or bytes) to ``path`` through a temporary file in
+    the same directory and an atomic rename.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    mode = 'wb' if isinstance(contents, bytes) else 'w'
+    with NamedTemporaryFile(mode, dir=directory, prefix='.tmp-', delete=False) as f:
+        tmp = f.name
+        try:
+            f.write(contents)
+        except Exception:
+            os.remove(tmp)
+            raise
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        os.remove(tmp)
+        raise
+    return path
+
+
+def cached_file(namespace, key, contents, suffix=''):
+    """
+    Path to the cached file identified by ``key``, creating it if needed.
+
+    Parameters
+    ----------
+    namespace : str
+        Subdirectory of the cache (``keys``...)
+    key : str
+        Digest of everything that determines the contents, as returned
+        by :func:`digest`.
+    contents : callable
+        Called without arguments to obtain the contents (str) only if
+        the file is not in the cache yet.
+    suffix : str, optional
+        File extension
+
+    Returns
+    -------
+    path : str or None
+        Absolute path to the cached file. None if the cache directory
+        cannot be written, so callers can fall back to uncached files.
+    """
+    directory = cache_dir(namespace)
+    path = os.path.abspath(os.path.join(directory, key + suffix))
+    if os.path.isfile(path):
+        return path
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):  # not a race with another job
+            return None
+    try:
+        return atomic_write(path, contents())
+    except (IOError, OSError):
+        return None
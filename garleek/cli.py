@@ -38,10 +38,12 @@ from __future__ import print_function, absolute_import, division
 from argparse import ArgumentParser, REMAINDER, SUPPRESS, ArgumentTypeError
 import os
 import sys
-from . import __version__
-from .connectors import CONNECTORS, PATCHERS
 from .atom_types import get_file, parse as parse_atom_types, BUILTIN_TYPES
 
+# Keep imports here to a minimum: this module is imported on every
+# ``garleek-backend`` launch. Heavier modules (``connectors`` pulls NumPy
+# and the engines) are imported where needed.
+
 
 ###
 # VALIDATORS
@@ -88,6 +90,36 @@ def _extant_file_types(path, abspath=False):
     raise ArgumentTypeError("File `{}` cannot be found".format(path))
 
 
+def _index_list(value, what='index'):
+    """
+    Parse a list of ranges like ``0-3,8,10-11``.
+    """
+    indices = []
+    try:
+        for part in value.split(','):
+            first, _, last = part.partition('-')
+            indices.extend(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise ArgumentTypeError("Invalid {} list `{}`".format(what, value))
+    if not indices:
+        raise ArgumentTypeError("Invalid {} list `{}`".format(what, value))
+    return sorted(set(indices))
+
+
+def _cpu_list(value):
+    """
+    Parse a CPU list like ``0-3,8,10-11``, as in Gaussian's ``%cpu``.
+    """
+    return _index_list(value, 'CPU')
+
+
+def _atom_list(value):
+    """
+    Parse a list of 1-based atom indices like ``1-20,35``.
+    """
+    return _index_list(value, 'atom')
+
+
 def _parse_engine_string(word):
     parts = word.split('_', 1)
     if len(parts) == 1:
@@ -101,19 +133,40 @@ def _parse_engine_string(word):
 
 def backend_app_main(argv=None):
     """ ``garleek-backend`` CLI entry-point """
-    args = _backend_args(argv)
-    msg = 'Entering Garleek v{}'.format(__version__)
+    args = vars(_backend_args(argv))
+    server, idle_timeout = args.pop('server'), args.pop('server_timeout')
+    response_timeout = args.pop('server_response_timeout')
+    if server:
+        from .server import request
+        response = request(idle_timeout=idle_timeout, response_timeout=response_timeout,
+                           **args)
+        if response is not None:
+            sys.stdout.write(response['stdout'])
+            sys.stderr.write(response['stderr'])
+            sys.exit(response['returncode'])
+        print('! Garleek server could not be reached or did not answer in time. '
+              'Running in-process...')
+    backend_app_run(**args)
+
+
+def backend_app_run(**kwargs):
+    """
+    Run :func:`backend_app` surrounded by the ``garleek-backend`` banner.
+    This is what both the CLI and the persistent server execute.
+    """
+    from . import _static_version
+    msg = 'Entering Garleek v{}'.format(_static_version())
     underline = '='*len(msg)
     print(underline)
     print(msg)
     print(underline)
-    backend_app(**vars(args))
+    backend_app(stream=True, **kwargs)
     print(underline)
     print('Exiting Garleek'.center(len(msg)))
     print(underline)
 
 
-def backend_app(qmargs, qm='gaussian', mm='tinker', ff='mm3.prm', **kw):
+def backend_app(qmargs, qm='gaussian', mm='tinker', ff='mm3.prm', stream=False, **kw):
     """
     ``garleek-backend`` Python entry-point
 
@@ -132,16 +185,20 @@ def backend_app(qmargs, qm='gaussian', mm='tinker', ff='mm3.prm', **kw):
     ff : str
         Forcefield to use in the MM part. This can be anything that the MM
         engine is able to use as a forcefield (normally a path to a file).
+    stream : bool
+        Use the connector of ``EOU_WRITERS``, which streams the output file
+        to disk as it is formatted, instead of that of ``CONNECTORS``.
 
     Returns
     -------
     result :
         Whatever the QM-MM connector returns
     """
+    from .connectors import CONNECTORS, EOU_WRITERS
     qm_engine, qm_version = _parse_engine_string(qm)
     mm_engine, mm_version = _parse_engine_string(mm)
     try:
-        connector = CONNECTORS[qm_engine][mm_engine]
+        connector = (EOU_WRITERS if stream else CONNECTORS)[qm_engine][mm_engine]
     except KeyError:
         sys.exit("ERROR: Connector with QM={} and MM={} "
                  "is not available".format(qm_engine, qm_engine))
@@ -160,9 +217,86 @@ def _backend_args(argv=None):
     p.add_argument('--mm', type=str, default='tinker',
                    help='MM engine to use. Defaults to Tinker. '
                         'Versions after an underscore: <engine>_<version>, '
-                        'like tinker_8 or tinker_qmcharges')
+                        'like tinker_8 or tinker_qmcharges. numpyff and openmm (needs '
+                        'OpenMM) evaluate class I forcefields (amber99sb, charmm22, oplsaa) '
+                        'in-process.')
     p.add_argument('--ff', type=_extant_file_prm, default='mmff.prm',
                    help='Forcefield to be used by the MM engine')
+    p.add_argument('--jobs', type=int, default=None,
+                   help='Maximum number of MM programs run concurrently in each step. '
+                        'Defaults to $GARLEEK_TINKER_JOBS or all the needed ones.')
+    p.add_argument('--nproc', type=int, default=None,
+                   help='Number of threads of the MM engine. garleek-prepare takes it '
+                        'from %%nprocshared or %%cpu. Defaults to the number of --cpus, '
+                        'if given, or the MM engine default.')
+    p.add_argument('--cpus', type=_cpu_list, default=None,
+                   help='CPUs the MM programs are pinned to, like 0-3,8 '
+                        '(garleek-prepare takes it from %%cpu)')
+    p.add_argument('--trim-ff', dest='trim_forcefield', action='store_true',
+                   default=bool(os.environ.get('GARLEEK_TRIM_FF')),
+                   help='Let the MM engine read a reduced copy of the forcefield, with '
+                        'only the parameters that apply to the atom types in the system.')
+    p.add_argument('--stage', action='store_true',
+                   default=bool(os.environ.get('GARLEEK_STAGE')),
+                   help='Copy the forcefield and key files to node-local storage '
+                        '($GARLEEK_STAGE_DIR or /dev/shm) once and make the MM engine '
+                        'read them from there')
+    p.add_argument('--keep-scratch', action='store_true', default=None,
+                   help='Keep the temporary files of each MM step (in $GARLEEK_SCRATCH_DIR '
+                        'or /dev/shm) for debugging. Also enabled by $GARLEEK_KEEP_SCRATCH.')
+    p.add_argument('--exchange', choices=('files', 'memory'),
+                   default=os.environ.get('GARLEEK_TINKER_EXCHANGE') or 'files',
+                   help='Pass the XYZ input to TINKER as an in-memory file and read the '
+                        'Hessian from a named pipe (memory), instead of regular files in the '
+                        'scratch directory. Defaults to $GARLEEK_TINKER_EXCHANGE or files.')
+    p.add_argument('--tinker-library', dest='library', default=None,
+                   help='Shared-library build of TINKER used by --mm libtinker. Defaults to '
+                        '$GARLEEK_TINKER_LIBRARY or libtinker as found by the dynamic loader.')
+    p.add_argument('--hessian', dest='hessian_method', choices=('analytic', 'fd'),
+                   default=os.environ.get('GARLEEK_HESSIAN') or 'analytic',
+                   help='Compute MM Hessians with the engine (analytic) or by central '
+                        'differences of gradients, in parallel (fd). Defaults to '
+                        '$GARLEEK_HESSIAN or analytic.')
+    # Keep in sync with garleek.hessian.FD_STEP (not imported here on purpose)
+    p.add_argument('--hessian-step', type=float,
+                   default=float(os.environ.get('GARLEEK_HESSIAN_STEP') or 0.005),
+                   help='Displacement (A) of --hessian fd. Defaults to '
+                        '$GARLEEK_HESSIAN_STEP or 0.005.')
+    p.add_argument('--hessian-processes', type=int,
+                   default=int(os.environ.get('GARLEEK_HESSIAN_PROCESSES') or 0) or None,
+                   help='Processes computing --hessian fd. Defaults to '
+                        '$GARLEEK_HESSIAN_PROCESSES, the number of --cpus or all the CPUs.')
+    p.add_argument('--hessian-checkpoint', default=os.environ.get('GARLEEK_HESSIAN_CHECKPOINT'),
+                   help='Directory where --hessian fd saves its progress, so interrupted '
+                        'jobs can be resumed. Defaults to $GARLEEK_HESSIAN_CHECKPOINT.')
+    p.add_argument('--phva-radius', type=float, default=None,
+                   help='Compute a partial MM Hessian of the real system, only for the atoms '
+                        'closer than this (A) to the --qm-atoms, by finite differences (see '
+                        '--hessian). The rest is zero.')
+    p.add_argument('--phva-atoms', type=_atom_list, default=None,
+                   help='Atoms (1-based, like 1-20,35) always included in the partial '
+                        'Hessian. Without --phva-radius, the only ones besides the '
+                        '--qm-atoms.')
+    p.add_argument('--qm-atoms', type=_atom_list, default=None,
+                   help='Atoms (1-based) of the QM layers, always part of the partial '
+                        'Hessian. Required by --phva-radius and --phva-atoms; '
+                        'garleek-prepare writes them.')
+    p.add_argument('--no-results-cache', dest='cache_results', action='store_false',
+                   help='Always run the MM engine, even if the same geometry was computed '
+                        'before. The cache size is set with $GARLEEK_RESULTS_CACHE_SIZE (MB).')
+    p.add_argument('--server', action='store_true',
+                   default=bool(os.environ.get('GARLEEK_SERVER')),
+                   help='Forward the calculation to a persistent Garleek server, '
+                        'starting it if needed. Falls back to in-process mode if '
+                        'the server cannot be reached.')
+    p.add_argument('--server-timeout', type=float, default=600,
+                   help='Seconds the persistent server waits for new requests '
+                        'before shutting down')
+    p.add_argument('--server-response-timeout', type=float,
+                   default=float(os.environ.get('GARLEEK_SERVER_RESPONSE_TIMEOUT') or 3600),
+                   help='Seconds to wait for the persistent server to finish a calculation '
+                        'before terminating it and running in-process. Defaults to '
+                        '$GARLEEK_SERVER_RESPONSE_TIMEOUT or 3600.')
     # Arguments injected by the QM program
     p.add_argument('qmargs', nargs=REMAINDER, help=SUPPRESS)
 
@@ -218,6 +352,7 @@ def frontend_app(input_file, types='uff_to_mm3', qm='gaussian', mm='tinker',
         Path to patched input file. It will always be a derivative of ``input_file``.
         If ``input_file`` is ``input.in``, ``outname`` will be ``input.garleek.in``.
     """
+    from .connectors import PATCHERS
     qm_engine, qm_version = _parse_engine_string(qm)
     rosetta = parse_atom_types(get_file(types))
     patcher = PATCHERS[qm_engine]
@@ -230,6 +365,7 @@ def frontend_app(input_file, types='uff_to_mm3', qm='gaussian', mm='tinker',
 
 
 def _frontend_args(argv=None):
+    from . import __version__
     p = ArgumentParser(prog='garleek-prepare',
         description='This executable patches QM input files so they are compatible '
                     'with the selected MM engine.')
@@ -244,6 +380,15 @@ def _frontend_args(argv=None):
                         'like tinker_8 or tinker_qmcharges')
     p.add_argument('--ff', type=_extant_file_prm, default='mm3.prm',
                    help='Forcefield to be used by the MM engine')
+    p.add_argument('--server', action='store_true',
+                   help='Make garleek-backend use a persistent server process to '
+                        'avoid paying the startup cost on every step')
+    p.add_argument('--phva-radius', type=float, default=None,
+                   help='Make garleek-backend compute partial MM Hessians, only for the '
+                        'atoms closer than this (A) to those of the QM layers')
+    p.add_argument('--phva-atoms', type=_atom_list, default=None,
+                   help='Atoms (1-based, like 1-20,35) always included in the partial '
+                        'MM Hessians, along with those of the QM layers')
     p.add_argument('--types', type=_extant_file_types, default='uff_to_mm3',
                    help='Dictionary of QM-provided and MM-needed, case-insensitive atom types. '
                    'Can be either one of {{{}}}, or a user-provided '
@@ -12,17 +12,31 @@ unit conversion.
 A ``CONNECTORS`` dict is maintained at the end of the file
 listing the connectors available. It's a dict of dicts, where
 the primary keys are QM engines and secondary keys, MM engines.
+``EOU_WRITERS`` has the same keys, for connectors that stream their
+output to the file expected by the QM engine instead of returning it.
 """
 
 from __future__ import print_function, absolute_import, division
 import os
 import shutil
+from functools import partial
 import numpy as np
-from .qm.gaussian import (parse_gaussian_EIn, prepare_gaussian_EOu,
+from .qm.gaussian import (parse_gaussian_EIn, prepare_gaussian_EOu, write_gaussian_EOu,
                           supported_versions as gaussian_supported_versions,
                           default_version as gaussian_default_version,
                           patch_gaussian_input)
-from .mm.tinker import prepare_tinker_xyz, run_tinker, prepare_tinker_key
+from .mm.tinker import (prepare_tinker_xyz, run_tinker, prepare_tinker_key,
+                        tinker_dipole_moment, _topology_hash)
+from .mm.libtinker import run_libtinker, default_library as default_tinker_library
+from .mm.numpyff import run_numpyff
+from .mm.openmm import run_openmm
+from .mm.prm import parameters_digest
+from .cache import digest
+from .hessian import (FD_STEP, checkpoint_file, finite_difference_hessian,
+                      partial_hessian_atoms)
+from .qm.structure import Atoms
+from .scratch import job_scratch
+from . import results as mm_results
 from .atom_types import parse as parse_atom_types
 from . import units as u
 
@@ -44,9 +58,14 @@ def gaussian_tinker(qmargs, forcefield='mm3.prm', write_file=True, qm_version='1
 
         1. Parse Gaussian EIn file
         2. Convert it to TINKER's XYZ and KEY files
-        3. Run TINKER to obtain energy, dipole, etc
+        3. Run TINKER to obtain energy, dipole, etc. For fixed point-charge
+           forcefields, the dipole is computed in Python instead. Results
+           already computed for the same geometry are taken from the cache.
         4. Convert units and write the EOu file
 
+    The whole EOu file is formatted in memory. :func:`gaussian_tinker_eou`
+    streams it to disk instead, which matters for large Hessians.
+
     Parameters
     ----------
     qmargs : tuple
@@ -71,47 +90,366 @@ def gaussian_tinker(qmargs, forcefield='mm3.prm', write_file=True, qm_version='1
         TINKER behavior. If QM-charges must be considered for the MM
         part, set it to 'qmcharges'
 
+    kwargs
+        See :func:`gaussian_tinker_results`.
+
     Returns
     -------
     eou_data : str
         Contents of the EOu file Gaussian expects back.
     """
+    n_atoms, mm = gaussian_tinker_results(qmargs, forcefield=forcefield, qm_version=qm_version,
+                                          mm_version=mm_version, **kwargs)
+    eou_data = prepare_gaussian_EOu(n_atoms, **mm)
+    if write_file:
+        with open(_eou_filename(qmargs), mode='w') as f:
+            f.write(eou_data)
+    return eou_data
+
+
+def gaussian_tinker_eou(qmargs, **kwargs):
+    """
+    Same as :func:`gaussian_tinker`, but the EOu file is always written,
+    streamed to disk as it is formatted, so it is never held in memory.
+    This is what ``garleek-backend`` runs.
+
+    Returns
+    -------
+    eou_filename : str
+        Path to the EOu file Gaussian expects back.
+    """
+    n_atoms, mm = gaussian_tinker_results(qmargs, **kwargs)
+    eou_filename = _eou_filename(qmargs)
+    with open(eou_filename, mode='w') as f:
+        write_gaussian_EOu(f, n_atoms, **mm)
+    return eou_filename
+
+
+def _eou_filename(qmargs):
+    """
+    EOu file requested by Gaussian, or next to the EIn file if not given.
+    """
+    ein_filename, eou_filename = qmargs[1:3]
+    if eou_filename is None:
+        eou_filename = os.path.splitext(ein_filename)[0] + '.EOu'
+    return eou_filename
+
+
+def gaussian_tinker_results(qmargs, forcefield='mm3.prm', qm_version='16',
+                            mm_version=None, jobs=None, trim_forcefield=False, nproc=None,
+                            cpus=None, stage=False, cache_results=True,
+                            keep_scratch=None, exchange='files', library=None,
+                            engine='tinker', hessian_method='analytic', hessian_step=FD_STEP,
+                            hessian_processes=None, hessian_checkpoint=None,
+                            phva_radius=None, phva_atoms=None, qm_atoms=None, **kwargs):
+    """
+    MM results for the EIn file written by Gaussian (steps 1 to 3 and the
+    unit conversion of :func:`gaussian_tinker`).
+
+    Parameters
+    ----------
+    qmargs : tuple
+        CLI arguments passed by Gaussian. Only qmargs[0] (the layer) and
+        qmargs[1] (the EIn file) are used.
+
+    forcefield : str, optional=mm3.prm
+        Path to file listing the TINKER forcefield to use. It can be a ``*.prm``
+        file or a ``*.key`` file. PRM files are full forcefields with no modifications.
+        KEY files can import PRM files with ``parameters`` and then list custom
+        parameters below.
+
+    qm_version : string, optional=16
+        Gaussian version in use. Needed to cover the slight differences
+        between Gaussian versions (EIn/EOu syntax, number of args, and so on).
+
+    mm_version : string, optional=None
+        TINKER behavior. If QM-charges must be considered for the MM
+        part, set it to 'qmcharges'
+
+    jobs : int, optional=None
+        Maximum number of TINKER programs run concurrently. See
+        :func:`garleek.mm.tinker.run_tinker`.
+
+    trim_forcefield : bool, optional=False
+        Make TINKER read a reduced forcefield, with only the parameters
+        that can apply to the atom types in the system. See
+        :func:`garleek.mm.tinker.prepare_tinker_key`.
+
+    nproc : int, optional=None
+        Number of OpenMP threads of the TINKER programs, as reserved for
+        the Gaussian job with ``%nprocshared``. Defaults to the number of
+        ``cpus`` or, if not given, TINKER's default.
+
+    cpus : list of int, optional=None
+        CPUs the TINKER programs are pinned to, as reserved for the Gaussian
+        job with ``%cpu``.
+
+    stage : bool, optional=False
+        Make TINKER read node-local copies of the forcefield and key files.
+        See :mod:`garleek.staging`.
+
+    cache_results : bool, optional=True
+        Reuse MM results computed before for the same geometry, types,
+        connectivity and forcefield, and store new ones. See
+        :mod:`garleek.results`.
+
+    keep_scratch : bool, optional=None
+        Keep the scratch directory of the step (TINKER inputs, keys that
+        could not be cached...) for debugging. Defaults to
+        ``$GARLEEK_KEEP_SCRATCH``. See :mod:`garleek.scratch`.
+
+    exchange : str, optional=files
+        How the XYZ input and the Hessian are passed to TINKER: ``files``
+        or ``memory``. See :func:`garleek.mm.tinker.run_tinker`.
+
+    library : str, optional=None
+        Path to a shared-library build of TINKER. If given, TINKER is called
+        in-process through it instead of launching its executables, and
+        ``jobs``, ``cpus`` and ``exchange`` do not apply. See
+        :mod:`garleek.mm.libtinker`.
+
+    engine : str, optional=tinker
+        ``tinker``, or ``numpyff`` or ``openmm`` to evaluate class I forcefields
+        in-process with :mod:`garleek.mm.numpyff` or :mod:`garleek.mm.openmm`
+        instead of TINKER (``library``, ``jobs``, ``cpus`` and ``exchange``
+        do not apply then; ``nproc`` sets the OpenMM threads).
+
+    hessian_method : str, optional=analytic
+        ``analytic`` (``testhess`` or the engine's own Hessian) or ``fd``,
+        for central differences of gradients over a pool of processes. See
+        :func:`garleek.hessian.finite_difference_hessian`.
+
+    hessian_step : float, optional
+        Displacement (A) of ``fd`` Hessians.
+
+    hessian_processes : int, optional=None
+        Processes computing ``fd`` Hessians. Defaults to the number of
+        ``cpus``, if given, or all the CPUs.
+
+    hessian_checkpoint : str, optional=None
+        Directory where the completed columns of ``fd`` Hessians are saved,
+        so an interrupted calculation can be resumed.
+
+    phva_radius : float, optional=None
+        Compute a partial Hessian of the real system (layer ``R``), only
+        for the ``qm_atoms``, the ``phva_atoms`` and the atoms closer than
+        this (A) to the ``qm_atoms``, by finite differences. The rest of
+        the Hessian is zero. See :func:`garleek.hessian.partial_hessian_atoms`.
+
+    phva_atoms : list of int, optional=None
+        Atoms (1-based) always included in the partial Hessian. If given
+        without ``phva_radius``, they are the only ones besides the
+        ``qm_atoms``.
+
+    qm_atoms : list of int, optional=None
+        Atoms (1-based) of the QM layers, as recorded by ``garleek-prepare``.
+        Required by ``phva_radius`` and ``phva_atoms``, and always part of
+        the partial Hessian.
+
+    Returns
+    -------
+    n_atoms : int
+        Number of atoms in the EIn file.
+    mm : dict
+        ``energy``, ``dipole_moment`` and, if requested by Gaussian,
+        ``gradients`` and ``hessian``, in Gaussian units (Hartree, Bohr).
+    """
     if qm_version is None:
         qm_version = gaussian_default_version
-    layer, ein_filename, eou_filename  = qmargs[:3]
+    layer, ein_filename = qmargs[:2]
     # In Gaussian 09d and above, two more arguments are passed
     # but we don't need them anyway
     # msg_file, fchk_file, matel_file = qmargs[3:6]
     # Gaussian Input
     ein = parse_gaussian_EIn(ein_filename, version=qm_version)
     # TINKER inputs
-    xyz = prepare_tinker_xyz(ein['atoms'], ein['bonds'], version=mm_version)
-    key = prepare_tinker_key(forcefield, atoms=ein['atoms'], version=mm_version)
-    with_gradients = ein['derivatives'] > 0
-    with_hessian = ein['derivatives'] == 2
-    mm = run_tinker(xyz, n_atoms=ein['n_atoms'], key=key, energy=True, dipole_moment=True,
-                    gradients=with_gradients, hessian=with_hessian)
+    if nproc is None and cpus:
+        nproc = len(cpus)
+    job = os.path.splitext(os.path.basename(ein_filename))[0]
+    with job_scratch(job, keep=keep_scratch) as scratch:
+        key = prepare_tinker_key(forcefield, atoms=ein['atoms'], version=mm_version,
+                                 trim=trim_forcefield, threads=nproc,
+                                 stage=stage, scratch=scratch)
+        derivatives = ein['derivatives']
+        with_gradients = derivatives > 0
+        with_hessian = derivatives == 2
+        hessian_atoms = None
+        if with_hessian and layer == 'R' and (phva_radius or phva_atoms):
+            hessian_atoms = partial_hessian_atoms(
+                Atoms.from_dict(ein['atoms']).xyz * u.RBOHR_TO_ANGSTROM, radius=phva_radius,
+                qm_atoms=np.asarray(qm_atoms or [], dtype=int) - 1,
+                atoms=np.asarray(phva_atoms or [], dtype=int) - 1)
+            print('Partial Hessian of {} out of {} atoms'.format(len(hessian_atoms),
+                                                                 ein['n_atoms']))
+        mm = cache_key = None
+        hit = False
+        if cache_results:
+            parameters = [parameters_digest(key), mm_version]
+            if engine != 'tinker':  # results are close, but not identical
+                parameters.append(engine)
+            if hessian_method != 'analytic':
+                parameters.extend([hessian_method, hessian_step])
+            if hessian_atoms is not None:
+                parameters.extend(['phva', hessian_atoms.tobytes()])
+            cache_key = mm_results.geometry_key(ein['atoms'], ein['bonds'],
+                                                digest(*parameters))
+            mm = mm_results.load(cache_key, derivatives)
+            hit = mm is not None
+        if not hit:
+            # Fixed point-charge dipoles are cheap to compute here; otherwise ask TINKER
+            dipole = tinker_dipole_moment(key, ein['atoms'])
+            fd_hessian = with_hessian and (hessian_method == 'fd' or hessian_atoms is not None)
+            processes = hessian_processes or (len(cpus) if cpus else None)
+            if engine == 'tinker' and not library:
+                xyz = prepare_tinker_xyz(ein['atoms'], ein['bonds'], version=mm_version)
+                mm = run_tinker(xyz, n_atoms=ein['n_atoms'], key=key, energy=True,
+                                dipole_moment=dipole is None, gradients=with_gradients,
+                                hessian=with_hessian, jobs=jobs, cpus=cpus,
+                                scratch=scratch, exchange=exchange,
+                                hessian_method=hessian_method, hessian_step=hessian_step,
+                                hessian_processes=processes,
+                                hessian_checkpoint=hessian_checkpoint,
+                                hessian_atoms=hessian_atoms)
+            else:
+                in_process = 'libtinker' if engine == 'tinker' else engine
+                mm = _run_in_process(in_process, ein['atoms'], ein['bonds'], key,
+                                     library=library, threads=nproc, energy=True,
+                                     dipole_moment=dipole is None, gradients=with_gradients,
+                                     hessian=with_hessian and not fd_hessian)
+                if fd_hessian:
+                    atoms = Atoms.from_dict(ein['atoms'])
+                    checkpoint = checkpoint_file(hessian_checkpoint, in_process,
+                                                 parameters_digest(key),
+                                                 _topology_hash(atoms, ein['bonds']))
+                    mm['hessian'] = finite_difference_hessian(
+                        partial(_in_process_gradients, in_process, atoms, ein['bonds'], key,
+                                library, nproc),
+                        atoms.xyz * u.RBOHR_TO_ANGSTROM, step=hessian_step,
+                        processes=processes, checkpoint=checkpoint, atoms=hessian_atoms,
+                        couplings=hessian_atoms is None)
+            if dipole is not None:
+                mm['dipole_moment'] = dipole
+            if cache_key is not None:
+                mm_results.store(cache_key, derivatives, mm)
+    if cache_key is not None:
+        stats = mm_results.statistics()
+        print('MM results cache: {} ({} hits, {} misses)'.format(
+              'hit' if hit else 'miss', stats['hits'], stats['misses']))
     # Unit conversion from Tinker to Gaussian
     mm['energy'] = mm['energy'] * u.KCALMOL_TO_HARTREE
     mm['dipole_moment'] = mm['dipole_moment'] * u.DEBYES_TO_EBOHR
     if with_gradients:
         mm['gradients'] = mm['gradients'] * u.KCALMOLEANGSTROM_TO_HARTREEBOHR
     if with_hessian:
-        mm['hessian'] = mm['hessian'][np.tril_indices(ein['n_atoms']*3)] \
-                        * u.KCALMOLEANGSTROMSQ_TO_HARTREEBOHRSQ
-    # Generate files requested by Gaussian
-    eou_data = prepare_gaussian_EOu(ein['n_atoms'], **mm)
-    if write_file:
-        if eou_filename is None:
-            eou_filename = os.path.splitext(ein_filename)[0] + '.EOu'
-        with open(eou_filename, mode='w') as f:
-            f.write(eou_data)
-    return eou_data
+        mm['hessian'] *= u.KCALMOLEANGSTROMSQ_TO_HARTREEBOHRSQ  # in place, it can be large
+    return ein['n_atoms'], mm
+
+
+def _run_in_process(engine, atoms, bonds, key, library=None, threads=None, **properties):
+    """
+    Results of the in-process ``engine`` (``numpyff``, ``openmm`` or
+    ``libtinker``), in TINKER units.
+    """
+    if engine == 'numpyff':
+        return run_numpyff(atoms, bonds, key, **properties)
+    if engine == 'openmm':
+        return _openmm_to_tinker_units(run_openmm(atoms, bonds, key, threads=threads,
+                                                  **properties))
+    return run_libtinker(atoms, bonds, key, library=library, **properties)
+
+
+def _in_process_gradients(engine, atoms, bonds, key, library, threads, xyz):
+    """
+    Gradients (kcal/mol/A) at ``xyz`` (A) from an in-process engine, used
+    for finite-difference Hessians, in pool processes.
+    """
+    atoms = Atoms(atoms.elements, atoms.types, xyz * u.ANGSTROM_TO_RBOHR, atoms.charges)
+    return _run_in_process(engine, atoms, bonds, key, library=library, threads=threads,
+                           energy=False, dipole_moment=False, gradients=True)['gradients']
+
+
+def _openmm_to_tinker_units(mm):
+    """
+    Convert OpenMM results (kJ/mol, nm) to TINKER units (kcal/mol, A), in place.
+    """
+    if 'energy' in mm:
+        mm['energy'] = mm['energy'] * u.KJMOL_TO_KCALMOL
+    if 'dipole_moment' in mm:
+        mm['dipole_moment'] = mm['dipole_moment'] * (u.NM_TO_ANGSTROM * u.EANGSTROM_TO_DEBYES)
+    if 'gradients' in mm:
+        mm['gradients'] = mm['gradients'] * (u.KJMOL_TO_KCALMOL / u.NM_TO_ANGSTROM)
+    if 'hessian' in mm:
+        mm['hessian'] *= u.KJMOL_TO_KCALMOL / u.NM_TO_ANGSTROM**2
+    return mm
+
+
+def gaussian_libtinker(qmargs, library=None, **kwargs):
+    """
+    Connects QM engine ``gaussian`` with a shared-library build of TINKER,
+    called in-process. Apart from ``library`` (by default, the one found by
+    :func:`garleek.mm.libtinker.default_library`), parameters are those of
+    :func:`gaussian_tinker`.
+    """
+    return gaussian_tinker(qmargs, library=library or default_tinker_library(), **kwargs)
+
+
+def gaussian_numpyff(qmargs, **kwargs):
+    """
+    Connects QM engine ``gaussian`` with the NumPy evaluator of class I
+    forcefields (:mod:`garleek.mm.numpyff`), called in-process. Parameters
+    are those of :func:`gaussian_tinker`; the forcefield must be a class I
+    one, like ``amber99sb.prm``, ``charmm22.prm`` or ``oplsaa.prm``.
+    """
+    return gaussian_tinker(qmargs, engine='numpyff', **kwargs)
+
+
+def gaussian_openmm(qmargs, **kwargs):
+    """
+    Connects QM engine ``gaussian`` with OpenMM (:mod:`garleek.mm.openmm`),
+    called in-process on its CPU platform. Parameters are those of
+    :func:`gaussian_tinker`; the forcefield must be a TINKER class I one,
+    like ``amber99sb.prm``, ``charmm22.prm`` or ``oplsaa.prm``.
+    """
+    return gaussian_tinker(qmargs, engine='openmm', **kwargs)
+
+
+def gaussian_libtinker_eou(qmargs, library=None, **kwargs):
+    """
+    :func:`gaussian_libtinker`, streaming the EOu file like :func:`gaussian_tinker_eou`.
+    """
+    return gaussian_tinker_eou(qmargs, library=library or default_tinker_library(), **kwargs)
+
+
+def gaussian_numpyff_eou(qmargs, **kwargs):
+    """
+    :func:`gaussian_numpyff`, streaming the EOu file like :func:`gaussian_tinker_eou`.
+    """
+    return gaussian_tinker_eou(qmargs, engine='numpyff', **kwargs)
+
+
+def gaussian_openmm_eou(qmargs, **kwargs):
+    """
+    :func:`gaussian_openmm`, streaming the EOu file like :func:`gaussian_tinker_eou`.
+    """
+    return gaussian_tinker_eou(qmargs, engine='openmm', **kwargs)
 
 
 CONNECTORS = {
     'gaussian': {
-        'tinker': gaussian_tinker
+        'tinker': gaussian_tinker,
+        'libtinker': gaussian_libtinker,
+        'numpyff': gaussian_numpyff,
+        'openmm': gaussian_openmm,
+    }
+}
+#: Same as ``CONNECTORS``, but writing the file expected by the QM engine
+#: as it is formatted and returning its path (used by ``garleek-backend``)
+EOU_WRITERS = {
+    'gaussian': {
+        'tinker': gaussian_tinker_eou,
+        'libtinker': gaussian_libtinker_eou,
+        'numpyff': gaussian_numpyff_eou,
+        'openmm': gaussian_openmm_eou,
     }
 }
 QM_ENGINES = sorted(CONNECTORS.keys())
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+hessian.py
+==========
+
+Symmetric hessian matrices, stored as their packed lower triangle.
+
+The hessian of a system with ``n_atoms`` atoms is a symmetric
+``(3*n_atoms, 3*n_atoms)`` matrix, but Gaussian only wants its lower
+triangle, row by row: ``H[i, j]`` for ``i`` = 1 to 3N, ``j`` = 1 to ``i``.
+:class:`PackedHessian` keeps only that, from the MM parser to the EOu
+writer, so large frequency calculations never hold the dense matrix
+(or the index arrays needed to extract the triangle from it) in memory.
+
+The packed data is exposed through ``__array__``, so instances can be
+passed to any NumPy function expecting the flat packed array.
+
+Hessians can also be computed by finite differences of gradients, one
+column per displaced coordinate, with :func:`finite_difference_hessian`.
+Columns are independent, so they are spread over a pool of processes, and
+completed ones can be saved to a checkpoint file to resume interrupted
+calculations.
+
+Partial Hessians (PHVA, partial Hessian vibrational analysis) only have the
+block of the atoms near the QM region (see :func:`partial_hessian_atoms`),
+computed by displacing those atoms alone. The rows and columns of the
+other atoms are zero, as if they were infinitely heavy: they do not move
+in the normal modes of the active region, and show up as zero frequencies.
+"""
+
+from __future__ import print_function, absolute_import, division
+import multiprocessing
+import os
+import numpy as np
+from .cache import digest
+from .mm.neighbors import within
+
+#: Default displacement (Angstrom) of finite-difference Hessians. TINKER
+#: prints gradients with 4 decimals, which limits how small it can be.
+FD_STEP = 0.005
+_CHECKPOINT_MAGIC = b'GARLEEK-FDHESSIAN-1 '
+_worker = None  # (gradients, xyz, step) in pool processes
+
+
+def packed_size(n_coords):
+    """
+    Number of elements in the lower triangle of a ``(n_coords, n_coords)``
+    matrix, diagonal included.
+    """
+    return n_coords * (n_coords + 1) // 2
+
+
+class PackedHessian(object):
+
+    """
+    Symmetric matrix stored as its packed, row-major lower triangle.
+
+    Parameters
+    ----------
+    n_coords : int
+        Number of cartesian coordinates (3 times the number of atoms).
+    data : np.array, optional
+        Packed lower triangle, with shape ``(n_coords*(n_coords+1)/2,)``.
+        It is used as is, without copies. If not given, a zero matrix
+        is allocated.
+    """
+
+    def __init__(self, n_coords, data=None):
+        self.n_coords = n_coords = int(n_coords)
+        if data is None:
+            data = np.zeros(packed_size(n_coords))
+        else:
+            data = np.asarray(data, dtype=float)
+            if data.shape != (packed_size(n_coords),):
+                raise ValueError('Packed hessian for {} coordinates needs {} elements, got '
+                                 'shape {}'.format(n_coords, packed_size(n_coords), data.shape))
+        self.data = data
+        rows = np.arange(n_coords)
+        self.offsets = rows * (rows + 1) // 2  # packed position of H[i, 0]
+
+    @classmethod
+    def from_dense(cls, matrix):
+        """
+        Build a packed hessian from the lower triangle of a dense matrix.
+        """
+        matrix = np.asarray(matrix)
+        hessian = cls(matrix.shape[0])
+        for i, offset in enumerate(hessian.offsets):
+            hessian.data[offset:offset+i+1] = matrix[i, :i+1]
+        return hessian
+
+    @property
+    def size(self):
+        """Number of packed elements"""
+        return self.data.size
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is not None and dtype != self.data.dtype:
+            return self.data.astype(dtype)
+        if copy:
+            return self.data.copy()
+        return self.data
+
+    def __len__(self):
+        return self.data.size
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __repr__(self):
+        return '<{} with {} coordinates>'.format(self.__class__.__name__, self.n_coords)
+
+    def index(self, i, j):
+        """
+        Position of ``H[i, j]`` (or the symmetric ``H[j, i]``) in the packed
+        array. ``i`` and ``j`` can be integers or arrays of indices.
+        """
+        i, j = np.maximum(i, j), np.minimum(i, j)
+        return self.offsets[i] + j
+
+    def __getitem__(self, ij):
+        i, j = ij
+        return self.data[self.index(i, j)]
+
+    def __setitem__(self, ij, value):
+        i, j = ij
+        self.data[self.index(i, j)] = value
+
+    def __imul__(self, factor):
+        self.data *= factor
+        return self
+
+    def __mul__(self, factor):
+        return self.__class__(self.n_coords, self.data * factor)
+
+    __rmul__ = __mul__
+
+    def copy(self):
+        return self.__class__(self.n_coords, self.data.copy())
+
+    def diagonal(self):
+        return self.data[self.offsets + np.arange(self.n_coords)]
+
+    def set_diagonal(self, values, start=0):
+        """
+        Set ``H[i, i]`` for ``i`` = ``start`` to ``start + len(values)``.
+        """
+        values = np.asarray(values)
+        rows = np.arange(start, start + values.size)
+        self.data[self.offsets[rows] + rows] = values
+
+    def set_lower_column(self, column, values):
+        """
+        Set the elements below the diagonal in ``column``, ``H[column+1:, column]``
+        (which, by symmetry, is also ``H[column, column+1:]``). If ``values``
+        is shorter than the column, only the first rows are set.
+        """
+        values = np.asarray(values)
+        self.data[self.offsets[column+1:column+1+values.size] + column] = values
+
+    def add_column(self, column, values):
+        """
+        Add a full ``column`` of a nearly symmetric matrix (like those
+        obtained by finite differences of gradients) as half of ``H[:, column]``
+        and half of ``H[column, :]``. Once all the columns have been added,
+        the result is the symmetrized matrix, ``(H + H.T) / 2``.
+        """
+        values = 0.5 * np.asarray(values)
+        start = self.offsets[column]
+        self.data[start:start+column+1] += values[:column+1]
+        self.data[self.offsets[column:] + column] += values[column:]
+
+    def row(self, i):
+        """
+        Full row ``i`` of the symmetric matrix, as a new array.
+        """
+        row = np.empty(self.n_coords, dtype=self.data.dtype)
+        row[:i+1] = self.data[self.offsets[i]:self.offsets[i]+i+1]
+        row[i+1:] = self.data[self.offsets[i+1:] + i]
+        return row
+
+    def dense(self):
+        """
+        Unpack to a dense, symmetric ``(n_coords, n_coords)`` matrix.
+        """
+        matrix = np.zeros((self.n_coords, self.n_coords), dtype=self.data.dtype)
+        for i, offset in enumerate(self.offsets):
+            matrix[i, :i+1] = self.data[offset:offset+i+1]
+        matrix += np.tril(matrix, -1).T
+        return matrix
+
+    def zero_coordinates(self, coordinates):
+        """
+        Set rows and columns of the given coordinates to zero, in place.
+        """
+        for c in coordinates:
+            self.data[self.offsets[c]:self.offsets[c]+c+1] = 0
+            self.data[self.offsets[c+1:] + c] = 0
+
+    def zero_atoms(self, indices):
+        """
+        Set rows and columns of all the coordinates of the given atoms
+        (1-based indices, as in TINKER keys) to zero, in place.
+        """
+        atoms = np.asarray(indices, dtype=int) - 1
+        self.zero_coordinates((3 * atoms[:, None] + np.arange(3)).ravel())
+
+
+def _fd_column(gradients, xyz, step, column):
+    """
+    Column of the Hessian for coordinate ``column``, by central differences.
+    """
+    displaced = np.array(xyz, dtype=float)
+    flat = displaced.reshape(-1)
+    flat[column] += step
+    forward = np.asarray(gradients(displaced), dtype=float).reshape(-1)
+    flat[column] -= 2 * step
+    backward = np.asarray(gradients(displaced), dtype=float).reshape(-1)
+    return column, (forward - backward) / (2 * step)
+
+
+def _init_worker(gradients, xyz, step):
+    global _worker
+    _worker = gradients, xyz, step
+
+
+def _pool_fd_column(column):
+    return _fd_column(*(_worker + (column,)))
+
+
+def _read_checkpoint(path, header, n_coords):
+    """
+    Columns saved in the checkpoint file at ``path``, if it belongs to the
+    same calculation (``header``). Incomplete records are discarded.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(header)) != header:
+                return {}
+            data = f.read()
+    except (IOError, OSError):
+        return {}
+    record = np.dtype([('column', '<i8'), ('values', '<f8', (n_coords,))])
+    records = np.frombuffer(data[:len(data) - len(data) % record.itemsize], dtype=record)
+    return dict(zip(records['column'].tolist(), records['values']))
+
+
+def checkpoint_file(directory, *parts):
+    """
+    Path of the checkpoint file (see :func:`finite_difference_hessian`) in
+    ``directory`` for the calculation identified by ``parts`` (see
+    :func:`garleek.cache.digest`), creating the directory if needed. None
+    if ``directory`` is None.
+    """
+    if directory is None:
+        return None
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    return os.path.join(directory, 'fd-{}.hes'.format(digest(*parts)))
+
+
+def finite_difference_hessian(gradients, xyz, step=FD_STEP, processes=1, checkpoint=None,
+                              atoms=None, couplings=True):
+    """
+    Hessian by central differences of ``gradients``, ``6N`` evaluations for
+    ``N`` atoms, assembled column by column (see :meth:`PackedHessian.add_column`).
+
+    Parameters
+    ----------
+    gradients : callable
+        Takes coordinates with the shape of ``xyz`` and returns the gradients
+        (any shape with the same size). With several ``processes``, it must
+        be picklable (a module-level function or a ``functools.partial`` of
+        one), since it is sent to fresh interpreters.
+    xyz : np.array with shape (N, 3)
+        Coordinates where the Hessian is computed.
+    step : float, optional
+        Displacement, in the units of ``xyz``.
+    processes : int, optional=1
+        Size of the pool of processes evaluating columns. If None, the
+        number of CPUs. With 1, everything runs in this process.
+    checkpoint : str, optional=None
+        File where completed columns are appended as they arrive. If it
+        already holds columns of the same calculation (same ``xyz``,
+        ``step`` and ``atoms``; callers should name it after anything else
+        that changes the gradients), they are not computed again. It is removed
+        once the Hessian is complete. It can grow as large as the dense
+        Hessian.
+    atoms : sequence of int, optional=None
+        0-based indices of the atoms whose coordinates are displaced. The
+        rows and columns of the others only get their couplings with these
+        ones, computed from the displaced atoms' columns; the rest is zero.
+        Defaults to all atoms.
+    couplings : bool, optional=True
+        If False, those couplings are left at zero too, so only the block of
+        the displaced ``atoms`` is filled (a partial Hessian).
+
+    Returns
+    -------
+    hessian : PackedHessian
+        In the units of ``gradients`` over those of ``xyz``.
+    """
+    xyz = np.array(xyz, dtype=float)
+    n_coords = xyz.size
+    if atoms is None:
+        columns = np.arange(n_coords)
+    else:
+        columns = (3 * np.unique(np.asarray(atoms, dtype=int))[:, None] + np.arange(3)).ravel()
+    # Off-diagonal elements get half of each of their two columns;
+    # those whose other column is not computed get all of this one
+    weights = np.full(n_coords, 2.0 if couplings else 0.0)
+    weights[columns] = 1.0
+    hessian = PackedHessian(n_coords)
+    done = {}
+    if checkpoint:
+        header = _CHECKPOINT_MAGIC + digest(xyz.tobytes(), repr(step),
+                                            columns.tobytes()).encode('ascii') + b'\n'
+        done = _read_checkpoint(checkpoint, header, n_coords)
+        with open(checkpoint, 'wb') as f:  # rewritten without incomplete records
+            f.write(header)
+            for column, values in sorted(done.items()):
+                f.write(np.int64(column).astype('<i8').tobytes())
+                f.write(np.asarray(values, dtype='<f8').tobytes())
+    for column, values in done.items():
+        hessian.add_column(column, weights * values)
+    pending = [int(c) for c in columns if int(c) not in done]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(pending)))
+    pool = None
+    if processes > 1:
+        # fresh interpreters: engines with threads or open handles are not forked
+        context = getattr(multiprocessing, 'get_context', None)  # Python 3.4+
+        pool = (context('spawn') if context else multiprocessing).Pool(
+            processes, initializer=_init_worker, initargs=(gradients, xyz, step))
+        results = pool.imap_unordered(_pool_fd_column, pending)
+    else:
+        results = (_fd_column(gradients, xyz, step, column) for column in pending)
+    stream = open(checkpoint, 'ab') if checkpoint else None
+    try:
+        for column, values in results:
+            hessian.add_column(column, weights * values)
+            if stream:
+                stream.write(np.int64(column).astype('<i8').tobytes())
+                stream.write(values.astype('<f8').tobytes())
+                stream.flush()
+    finally:
+        if stream:
+            stream.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if checkpoint:
+        os.remove(checkpoint)
+    return hessian
+
+
+def partial_hessian_atoms(xyz, qm_atoms, radius=None, atoms=()):
+    """
+    Atoms whose second derivatives are computed in partial Hessian mode:
+    the ``qm_atoms`` (at least one), the explicit ``atoms`` and, if
+    ``radius`` is given, every atom closer than ``radius`` to any of those
+    QM atoms, found with a cell list (:func:`garleek.mm.neighbors.within`).
+
+    Parameters
+    ----------
+    xyz : np.array with shape (N, 3)
+        Coordinates of all the atoms, in the units of ``radius``.
+    qm_atoms, atoms : sequence of int
+        0-based indices.
+    radius : float, optional=None
+        Distance to the QM atoms.
+
+    Returns
+    -------
+    indices : np.array of int
+        Sorted 0-based indices.
+    """
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    qm_atoms = np.asarray(qm_atoms, dtype=int)
+    selected = np.concatenate([qm_atoms, np.asarray(atoms, dtype=int)])
+    if not qm_atoms.size:
+        raise ValueError('Partial Hessians need the indices of the QM atoms')
+    if selected.min() < 0 or selected.max() >= len(xyz):
+        raise ValueError('Partial Hessian atoms out of range for {} atoms'.format(len(xyz)))
+    if radius:
+        selected = np.concatenate([selected, within(xyz, xyz[qm_atoms], radius)])
+    return np.unique(selected)
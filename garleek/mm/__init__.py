@@ -30,8 +30,10 @@ document those in the docstring!)
         Potential energy
     gradients : np.array with shape (3*n_atom,)
         Gradient on each tom
-    hessian : np.array with shape (9*n_atom,)
-        Flattened hessian matrix (force constants)
+    hessian : garleek.hessian.PackedHessian
+        Lower triangle of the hessian matrix (force constants),
+        packed row by row: H[i, j] for i = 1 to 3*n_atom, j = 1 to i.
+        Plain arrays with shape (3*n_atom*(3*n_atom+1)/2,) are accepted too.
     dipole_moment : np.array with shape (3,), optional
         Dipole X,Y,Z-Components
     polarizability : np.array with shape (6,), optional
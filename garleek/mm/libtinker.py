@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+mm.libtinker.py
+===============
+
+In-process TINKER evaluations through a shared-library build of TINKER,
+loaded with ``ctypes``.
+
+Instead of launching ``analyze``, ``testgrad`` and ``testhess`` on every
+step (each one reading the key file, assigning parameters and printing
+results that must be parsed back), the library is loaded once per process,
+set up once per key file and topology, and then only receives coordinates.
+It is most useful together with the persistent server
+(see :mod:`garleek.server`), which keeps both across steps.
+
+The library is taken from ``$GARLEEK_TINKER_LIBRARY`` or, if not set,
+looked up as ``tinker`` by the dynamic loader (``libtinker.so``). It must
+export the following C functions (ABI version 1), a thin layer over
+TINKER's own routines (``getkey``, ``mechanic``, ``gradient``,
+``hessian``, ``moments``...) that any TINKER build can provide::
+
+    /* Version of this interface: 1 */
+    int garleek_abi_version(void);
+
+    /* Message describing the last failure. Owned by the library. */
+    const char *garleek_last_error(void);
+
+    /* Read the key file and assign parameters. types are the TINKER
+       atom types; the atoms bonded to atom i (0-based) are the 1-based
+       neighbors[indptr[i]:indptr[i+1]], in CSR layout. */
+    int garleek_setup(const char *keyfile, int n_atoms, const int *types,
+                      const int *indptr, const int *neighbors);
+
+    /* Evaluate the system set up last at xyz (n_atoms x 3, Angstrom).
+       derivatives is 0 (energy), 1 (and gradients) or 2 (and Hessian).
+       Outputs are in TINKER units: energy in kcal/mol, dipole (3) in
+       Debye, gradients (n_atoms x 3) in kcal/mol/A and hessian in
+       kcal/mol/A^2, as the row-major packed lower triangle (3N(3N+1)/2
+       values). NULL outputs are not computed. */
+    int garleek_evaluate(const double *xyz, int derivatives, double *energy,
+                         double *dipole, double *gradients, double *hessian);
+
+    /* Free everything allocated by garleek_setup. */
+    void garleek_release(void);
+
+Functions returning ``int`` return 0 on success. The library holds a
+single system at a time and is not expected to be thread-safe.
+"""
+
+from __future__ import print_function, absolute_import, division
+import ctypes
+import ctypes.util
+import os
+import numpy as np
+from .. import units as u
+from ..hessian import PackedHessian
+from ..qm.structure import Atoms, Bonds
+from .tinker import _topology_hash
+
+ABI_VERSION = 1
+
+_libraries = {}
+_systems = {}  # library path -> (key, key mtime, topology) set up in it
+
+_c_int_p = ctypes.POINTER(ctypes.c_int)
+_c_double_p = ctypes.POINTER(ctypes.c_double)
+
+
+def default_library():
+    """
+    Path to the TINKER shared library: ``$GARLEEK_TINKER_LIBRARY`` or
+    ``libtinker`` as found by the dynamic loader.
+    """
+    path = os.environ.get('GARLEEK_TINKER_LIBRARY') or ctypes.util.find_library('tinker')
+    if not path:
+        raise RuntimeError('TINKER shared library could not be found. '
+                           'Set $GARLEEK_TINKER_LIBRARY to its path.')
+    return path
+
+
+def _resolve(path=None):
+    path = path or default_library()
+    if os.path.sep in path:
+        return os.path.abspath(path)
+    return path
+
+
+def load_library(path=None):
+    """
+    Load the TINKER shared library at ``path`` (see :func:`default_library`)
+    and check its ABI version. Libraries are loaded once per process.
+    """
+    path = _resolve(path)
+    if path in _libraries:
+        return _libraries[path]
+    library = ctypes.CDLL(path)
+    try:
+        library.garleek_abi_version.restype = ctypes.c_int
+        library.garleek_abi_version.argtypes = []
+        library.garleek_last_error.restype = ctypes.c_char_p
+        library.garleek_last_error.argtypes = []
+        library.garleek_setup.restype = ctypes.c_int
+        library.garleek_setup.argtypes = [ctypes.c_char_p, ctypes.c_int, _c_int_p, _c_int_p,
+                                          _c_int_p]
+        library.garleek_evaluate.restype = ctypes.c_int
+        library.garleek_evaluate.argtypes = [_c_double_p, ctypes.c_int, _c_double_p,
+                                             _c_double_p, _c_double_p, _c_double_p]
+        library.garleek_release.restype = None
+        library.garleek_release.argtypes = []
+    except AttributeError as e:
+        raise RuntimeError('{} does not export the Garleek TINKER interface: {}'.format(path, e))
+    version = library.garleek_abi_version()
+    if version != ABI_VERSION:
+        raise RuntimeError('{} implements version {} of the Garleek TINKER interface; '
+                           'version {} is needed'.format(path, version, ABI_VERSION))
+    _libraries[path] = library
+    return library
+
+
+def _check(library, status, action):
+    if status:
+        message = library.garleek_last_error()
+        message = message.decode('utf-8', 'replace') if message else 'error {}'.format(status)
+        raise RuntimeError('TINKER library could not {}: {}'.format(action, message))
+
+
+def _pointer(array, ctype=ctypes.c_double):
+    if array is None:
+        return None
+    return array.ctypes.data_as(ctypes.POINTER(ctype))
+
+
+def _setup(library, path, key, atoms, bonds):
+    """
+    Set up ``key`` and the topology in ``library``, unless it is
+    already the last one set up there.
+    """
+    try:
+        mtime = os.path.getmtime(key)
+    except OSError:  # let the library report it
+        mtime = None
+    system = key, mtime, _topology_hash(atoms, bonds)
+    if _systems.get(path) == system:
+        return
+    try:
+        types = np.char.strip(np.asarray(atoms.types, dtype=str)).astype(np.intc)
+    except ValueError:
+        raise ValueError('TINKER library needs numeric atom types')
+    if bonds:
+        kept = bonds.orders >= 0.5  # same rule as the XYZ files
+        counts = np.concatenate([[0], np.cumsum(kept)])
+        indptr = counts[bonds.indptr].astype(np.intc)
+        neighbors = bonds.neighbors[kept].astype(np.intc)
+    else:
+        indptr = np.zeros(len(atoms) + 1, dtype=np.intc)
+        neighbors = np.zeros(0, dtype=np.intc)
+    _systems.pop(path, None)
+    library.garleek_release()
+    status = library.garleek_setup(os.path.abspath(key).encode('utf-8'), len(atoms),
+                                   _pointer(types, ctypes.c_int), _pointer(indptr, ctypes.c_int),
+                                   _pointer(neighbors, ctypes.c_int))
+    _check(library, status, 'read {}'.format(key))
+    _systems[path] = system
+
+
+def run_libtinker(atoms, bonds, key, library=None, energy=True, dipole_moment=True,
+                  gradients=False, hessian=False):
+    """
+    Compute the requested properties in-process with a shared-library build
+    of TINKER. Parameters are only assigned again when the key file or the
+    topology change.
+
+    Parameters
+    ----------
+    atoms : garleek.qm.structure.Atoms or OrderedDict
+        Atoms of the MM system, with coordinates in bohr, as parsed from
+        the QM engine.
+    bonds : garleek.qm.structure.Bonds or OrderedDict
+        Connectivity of the MM system.
+    key : str
+        Path to the TINKER key file (see
+        :func:`garleek.mm.tinker.prepare_tinker_key`).
+    library : str, optional=None
+        Path to the library. See :func:`default_library`.
+    energy, dipole_moment, gradients, hessian : bool
+        Properties to compute.
+
+    Returns
+    -------
+    results : dict
+        Same keys and TINKER units as :func:`garleek.mm.tinker.run_tinker`.
+    """
+    path = _resolve(library)
+    library = load_library(path)
+    atoms = Atoms.from_dict(atoms)
+    bonds = Bonds.from_dict(bonds, n_atoms=len(atoms)) if bonds else None
+    _setup(library, path, key, atoms, bonds)
+    n_coords = 3 * len(atoms)
+    xyz = np.ascontiguousarray(atoms.xyz * u.RBOHR_TO_ANGSTROM, dtype=np.double)
+    derivatives = 2 if hessian else int(bool(gradients))
+    value = ctypes.c_double()
+    dipole = np.zeros(3) if dipole_moment else None
+    gradient = np.zeros((len(atoms), 3)) if gradients else None
+    packed = PackedHessian(n_coords) if hessian else None
+    status = library.garleek_evaluate(_pointer(xyz), derivatives, ctypes.byref(value),
+                                      _pointer(dipole), _pointer(gradient),
+                                      _pointer(packed.data) if packed else None)
+    _check(library, status, 'evaluate the system')
+    results = {}
+    if energy:
+        results['energy'] = value.value
+    if dipole_moment:
+        results['dipole_moment'] = dipole
+    if gradients:
+        results['gradients'] = gradient
+    if hessian:
+        results['hessian'] = packed
+    return results
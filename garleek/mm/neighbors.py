@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+mm.neighbors.py
+===============
+
+Spatial searches over ``(N, 3)`` coordinate arrays with cell lists:
+space is divided into cubic cells as large as the search distance, so
+only points in the same or adjacent cells have to be compared. Both
+the cost and the memory grow linearly with the number of points (for
+a fixed density), instead of quadratically.
+"""
+
+from __future__ import print_function, absolute_import, division
+import numpy as np
+
+#: Offsets to the cells that share a face, edge or corner with a given one
+_SHELL = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+#: Same, keeping only one of each pair of opposite offsets (the other one
+#: is visited from the neighbor cell)
+_HALF_SHELL = _SHELL[[tuple(offset) >= (0, 0, 0) for offset in _SHELL]]
+#: Cells used when the bounding box of the points fits in fewer than
+#: these, where comparing all the pairs is cheaper
+_MIN_CELLS = 27
+
+
+def _expand(starts, counts):
+    """
+    Concatenation of ``arange(start, start + count)`` for every pair.
+    """
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(counts.sum()) - offsets + np.repeat(starts, counts)
+
+
+def _candidates(cells, other_cells, dims, offsets, same=False):
+    """
+    Pairs ``(a, b)`` of indices of points in ``cells`` and ``other_cells``
+    (integer cell coordinates) such that the cell of ``b`` is the cell of
+    ``a`` plus one of ``offsets``. If both are the ``same`` points, pairs
+    within a cell are only given once, with ``a < b``.
+    """
+    linear = np.ravel_multi_index(other_cells.T, dims)
+    order = np.argsort(linear, kind='mergesort')
+    counts = np.bincount(linear, minlength=np.prod(dims))
+    starts = np.cumsum(counts) - counts
+    found_a, found_b = [], []
+    for offset in offsets:
+        neighbor = cells + offset
+        valid = np.all((neighbor >= 0) & (neighbor < dims), axis=1)
+        cell = np.ravel_multi_index(neighbor[valid].T, dims)
+        number = counts[cell]
+        a = np.repeat(np.nonzero(valid)[0], number)
+        b = order[_expand(starts[cell], number)]
+        if same and not offset.any():
+            keep = a < b
+            a, b = a[keep], b[keep]
+        found_a.append(a)
+        found_b.append(b)
+    return np.concatenate(found_a), np.concatenate(found_b)
+
+
+def pairs(xyz, cutoff=None):
+    """
+    Pairs of points closer than ``cutoff``.
+
+    Parameters
+    ----------
+    xyz : np.array with shape (N, 3)
+        Coordinates.
+    cutoff : float, optional=None
+        Search distance, in the units of ``xyz``. If None, all pairs
+        are returned.
+
+    Returns
+    -------
+    i, j : np.array of int
+        Indices of the points of each pair, with ``i < j``, sorted by
+        ``i`` and then ``j``.
+    """
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    n = len(xyz)
+    if cutoff is None or n < 2:
+        return np.triu_indices(n, 1)
+    cells = np.floor((xyz - xyz.min(axis=0)) / cutoff).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    if np.prod(dims) < _MIN_CELLS:
+        i, j = np.triu_indices(n, 1)
+    else:
+        i, j = _candidates(cells, cells, dims, _HALF_SHELL, same=True)
+    d = xyz[i] - xyz[j]
+    close = np.einsum('ij,ij->i', d, d) < cutoff * cutoff
+    keys = np.sort(np.minimum(i[close], j[close]) * n + np.maximum(i[close], j[close]))
+    return keys // n, keys % n
+
+
+def all_pairs(n, chunk):
+    """
+    All the pairs ``(i, j)`` of ``n`` points, with ``i < j``, in the order
+    of :func:`pairs`, as blocks of whole rows with about ``chunk`` pairs
+    each (at least one row), so memory does not grow quadratically.
+
+    Yields
+    ------
+    i, j : np.array of int
+    """
+    rows = np.arange(n - 1)
+    counts = n - 1 - rows
+    done = np.cumsum(counts)
+    start = 0
+    while start < n - 1:
+        previous = done[start - 1] if start else 0
+        stop = max(int(np.searchsorted(done, previous + chunk, side='right')), start + 1)
+        yield (np.repeat(rows[start:stop], counts[start:stop]),
+               _expand(rows[start:stop] + 1, counts[start:stop]))
+        start = stop
+
+
+def within(xyz, centers, radius):
+    """
+    Indices of the points of ``xyz`` closer than ``radius`` to any of
+    the points in ``centers``, sorted.
+    """
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    centers = np.asarray(centers, dtype=float).reshape(-1, 3)
+    if not len(xyz) or not len(centers):
+        return np.zeros(0, dtype=int)
+    origin = np.minimum(xyz.min(axis=0), centers.min(axis=0))
+    cells = np.floor((xyz - origin) / radius).astype(np.int64)
+    center_cells = np.floor((centers - origin) / radius).astype(np.int64)
+    dims = np.maximum(cells.max(axis=0), center_cells.max(axis=0)) + 1
+    i, j = _candidates(cells, center_cells, dims, _SHELL)
+    d = xyz[i] - centers[j]
+    return np.unique(i[np.einsum('ij,ij->i', d, d) < radius * radius])
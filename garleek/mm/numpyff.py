@@ -0,0 +1,724 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+mm.numpyff.py
+=============
+
+In-process evaluation of class I forcefields with NumPy.
+
+AMBER, CHARMM and OPLS-AA (as distributed with TINKER: ``amber99sb.prm``,
+``charmm22.prm``, ``oplsaa.prm``) share the same functional form:
+
+- harmonic bonds and Urey-Bradley 1-3 terms, ``k (r - r0)^2``
+- harmonic angles, ``k (theta - theta0)^2``
+- Fourier torsions and improper torsions (``torsion``, ``imptors``),
+  ``sum V_n (1 + cos(n phi - delta_n))``
+- harmonic impropers (``improper``), ``k (phi - phi0)^2``
+- Lennard-Jones van der Waals and Coulomb point charges, with 1-2 and 1-3
+  pairs excluded and 1-4 pairs scaled
+
+For those, the energy, gradients and Hessian can be computed here from the
+same ``*.prm`` / ``*.key`` files, following TINKER conventions and units
+(kcal/mol and Angstrom), instead of launching three TINKER programs per
+step. Terms are assigned once per topology and stored as arrays, so each
+step is a handful of vectorized operations over them.
+
+Gradients are analytic. The Hessian of the pairwise terms (bonds,
+Urey-Bradley, nonbonded) is analytic too; that of angles and torsions is
+obtained from their analytic gradients with complex-step differentiation,
+which, unlike finite differences, is exact to rounding error.
+
+Nonbonded pairs are all the pairs, like TINKER does by default for non-periodic
+systems, or those found by :func:`garleek.mm.neighbors.pairs` if the key sets
+``cutoff``, ``vdw-cutoff`` or ``chg-cutoff``. With cutoffs, energies are
+smoothly switched off over the last part of the cutoff distance (``vdw-taper``
+and ``chg-taper``), with the same polynomial for van der Waals and charges,
+so results differ slightly from TINKER there, which shifts charge energies.
+"""
+
+from __future__ import print_function, absolute_import, division
+import os
+from collections import OrderedDict
+from functools import partial
+from itertools import combinations, permutations
+import numpy as np
+from .. import units as u
+from ..hessian import PackedHessian
+from ..qm.structure import Atoms, Bonds
+from .neighbors import all_pairs, pairs as neighbor_pairs
+from .prm import (CLASS_INDEXED_RECORDS, NON_FIXED_CHARGE_RECORDS, iter_tinker_records)
+from .tinker import _topology_hash, tinker_dipole_moment
+
+#: Records and keywords that fall outside the class I functional form
+UNSUPPORTED_RECORDS = frozenset(
+    NON_FIXED_CHARGE_RECORDS | (set(CLASS_INDEXED_RECORDS) -
+                                set(['bond', 'angle', 'ureybrad', 'torsion', 'imptors',
+                                     'improper'])) |
+    set(['vdwpr', 'ewald', 'a-axis', 'solvate', 'polarization', 'bond-cubic', 'bond-quartic',
+         'angle-cubic', 'angle-quartic', 'angle-pentic', 'angle-sextic', 'urey-cubic',
+         'urey-quartic', 'dielectric-offset']))
+#: Supported values of the van der Waals settings, the first one being
+#: TINKER's default
+VDW_SETTINGS = OrderedDict([
+    ('vdwtype', ('LENNARD-JONES',)),
+    ('radiusrule', ('ARITHMETIC', 'GEOMETRIC')),
+    ('radiustype', ('R-MIN', 'SIGMA')),
+    ('radiussize', ('RADIUS', 'DIAMETER')),
+    ('epsilonrule', ('GEOMETRIC',)),
+    ('vdwindex', ('CLASS', 'TYPE')),
+])
+_DEFAULTS = {
+    'bondunit': 1.0, 'angleunit': (np.pi / 180)**2, 'ureyunit': 1.0, 'torsionunit': 1.0,
+    'imptorunit': 1.0, 'impropunit': (np.pi / 180)**2, 'electric': 332.063713,
+    'dielectric': 1.0, 'vdw-12-scale': 0.0, 'vdw-13-scale': 0.0, 'vdw-14-scale': 1.0,
+    'chg-12-scale': 0.0, 'chg-13-scale': 0.0, 'chg-14-scale': 1.0, 'vdw-cutoff': None,
+    'chg-cutoff': None, 'vdw-taper': 0.90, 'chg-taper': 0.65,
+}
+#: Step of the complex-step derivatives
+_COMPLEX_STEP = 1e-20
+#: Pairs or terms processed at once, to bound memory
+_CHUNK = 200000
+
+_forcefields = {}
+_models = OrderedDict()
+_MODELS_SIZE = 4
+
+
+###
+# Parameters
+###
+
+def read_forcefield(path):
+    """
+    Parameters of a class I forcefield, from a TINKER ``*.prm`` or ``*.key``
+    file (``parameters`` imports are followed; later records override earlier
+    ones). Cached by path and modification time.
+
+    Returns
+    -------
+    forcefield : dict
+        ``settings`` (keyword -> value), ``classes``, ``charges``, ``vdw`` and
+        ``vdw14`` (indexed by atom type or class), ``atom_charges`` (per atom
+        serial number, from negative ``charge`` indices), and ``bond``,
+        ``angle``, ``ureybrad``, ``torsion``, ``imptors`` and ``improper``,
+        indexed by tuples of atom classes.
+
+    Raises
+    ------
+    ValueError
+        If the forcefield is not a class I one, or the key has ``active`` or
+        ``inactive`` records: TINKER skips the terms between inactive atoms
+        and reports no gradients for them, which is not reproduced here.
+    """
+    path = os.path.abspath(path)
+    cache_key = path, os.path.getmtime(path)
+    if cache_key in _forcefields:
+        return _forcefields[cache_key]
+    ff = dict((name, {}) for name in ('classes', 'charges', 'atom_charges', 'vdw', 'vdw14',
+                                      'bond', 'angle', 'ureybrad', 'torsion', 'imptors',
+                                      'improper'))
+    settings = ff['settings'] = dict(_DEFAULTS)
+    for name, values in VDW_SETTINGS.items():
+        settings[name] = values[0]
+    unsupported = set()
+    for keyword, fields in iter_tinker_records(path):
+        if keyword in ('active', 'inactive'):
+            raise ValueError('`{}` has `{}` atoms, which are only supported by the tinker MM '
+                             'engine'.format(path, keyword))
+        if keyword in UNSUPPORTED_RECORDS:
+            if keyword.endswith(('-cubic', '-quartic', '-pentic', '-sextic')) \
+                    and fields and float(fields[0]) == 0:
+                continue
+            unsupported.add(keyword)
+        elif keyword == 'atom':
+            # Without a class field, the class is the type
+            number = fields[1] if fields[1].isdigit() else fields[0]
+            ff['classes'][int(fields[0])] = int(number)
+        elif keyword == 'charge':
+            index = int(fields[0])
+            if index < 0:
+                ff['atom_charges'][-index] = float(fields[1])
+            else:
+                ff['charges'][index] = float(fields[1])
+        elif keyword in ('vdw', 'vdw14'):
+            if len(fields) > 3 and float(fields[3]) != 0:
+                unsupported.add('vdw reduction factors')
+            ff[keyword][int(fields[0])] = float(fields[1]), abs(float(fields[2]))
+        elif keyword in ('bond', 'ureybrad', 'improper'):
+            n = {'bond': 2, 'ureybrad': 3, 'improper': 4}[keyword]
+            index = tuple(int(f) for f in fields[:n])
+            ff[keyword][index] = float(fields[n]), float(fields[n+1])
+        elif keyword == 'angle':
+            if len(fields) > 5:
+                unsupported.add('angle with several ideal values')
+            ff['angle'][tuple(int(f) for f in fields[:3])] = float(fields[3]), float(fields[4])
+        elif keyword in ('torsion', 'imptors'):
+            values = [float(f) for f in fields[4:]]
+            ff[keyword][tuple(int(f) for f in fields[:4])] = \
+                [tuple(values[i:i+3]) for i in range(0, len(values) - 2, 3)]
+        elif keyword in VDW_SETTINGS:
+            settings[keyword] = fields[0].upper() if fields else ''
+        elif keyword in _DEFAULTS and fields:
+            settings[keyword] = float(fields[0])
+        elif keyword in ('cutoff', 'taper') and fields:
+            settings['vdw-' + keyword] = settings['chg-' + keyword] = float(fields[0])
+    for name, values in VDW_SETTINGS.items():
+        if settings[name] not in values:
+            unsupported.add('{} {}'.format(name, settings[name]))
+    if unsupported:
+        raise ValueError('`{}` is not a class I forcefield: unsupported {}'.format(
+                         path, ', '.join(sorted(unsupported))))
+    for name in ('vdw-12-scale', 'vdw-13-scale', 'vdw-14-scale', 'chg-12-scale', 'chg-13-scale',
+                 'chg-14-scale'):
+        if settings[name] > 1:  # as in TINKER, values above 1 are divisors
+            settings[name] = 1 / settings[name]
+    _forcefields[cache_key] = ff
+    return ff
+
+
+def _lookup(table, indices, name):
+    """
+    Parameters for a term, trying both directions of ``indices``.
+    """
+    indices = tuple(indices)
+    for key in (indices, indices[::-1]):
+        if key in table:
+            return table[key]
+    raise ValueError('No {} parameters for atom classes {}'.format(name, indices))
+
+
+def _lookup_torsion(table, indices):
+    """
+    Torsion parameters, in both directions, with the terminal classes
+    replaced by the ``0`` wildcard when no exact match is found.
+    """
+    a, b, c, d = indices
+    for candidates in (((a, b, c, d),), ((0, b, c, d), (a, b, c, 0)), ((0, b, c, 0),)):
+        for key in candidates:
+            for key in (key, key[::-1]):
+                if key in table:
+                    return table[key]
+    raise ValueError('No torsion parameters for atom classes {}'.format(indices))
+
+
+def _match_out_of_plane(table, center, neighbors, classes, position):
+    """
+    Orderings of the three ``neighbors`` of ``center`` matching an
+    out-of-plane record of ``table``, with ``center`` at ``position``
+    (first for ``improper``, third for ``imptors``). Exact matches take
+    precedence over those with fewer and fewer specific classes (``0``
+    is a wildcard). Each matching ordering gets an equal share of the
+    parameters, so symmetric centers are not counted several times.
+
+    Returns
+    -------
+    terms : list of (atoms, parameters, weight)
+    """
+    candidates = [key for key in table if key[position] == classes[center]]
+    matches = {}
+    for ordering in permutations(neighbors):
+        atoms = list(ordering)
+        atoms.insert(position, center)
+        found = [(key.count(0), key) for key in candidates
+                 if all(k in (0, classes[a]) for (k, a) in zip(key, atoms))]
+        if found:
+            wildcards, key = min(found)
+            matches.setdefault(wildcards, []).append((tuple(atoms), table[key]))
+    if not matches:
+        return []
+    best = matches[min(matches)]
+    return [(atoms, parameters, 1 / len(best)) for (atoms, parameters) in best]
+
+
+###
+# Topology
+###
+
+def _connectivity(n_atoms, bonds):
+    """
+    Neighbor lists (0-based) of each atom.
+    """
+    neighbors = [[] for _ in range(n_atoms)]
+    if bonds:
+        kept = bonds.orders >= 0.5  # same rule as TINKER XYZ files
+        for i, j in zip(bonds.atoms()[kept] - 1, bonds.neighbors[kept] - 1):
+            if j not in neighbors[i]:
+                neighbors[i].append(j)
+            if i not in neighbors[j]:
+                neighbors[j].append(i)
+    return neighbors
+
+
+def build_model(ff, atoms, bonds):
+    """
+    Assign the terms of forcefield ``ff`` (see :func:`read_forcefield`) to a
+    system with the given atom types and connectivity.
+
+    Returns
+    -------
+    model : dict
+        Arrays of atom indices and parameters for each kind of term:
+        ``springs`` (bonds and Urey-Bradley), ``angles``, ``torsions``
+        (including ``imptors``), ``impropers``, and per-atom nonbonded
+        parameters and pair scaling factors.
+    """
+    settings = ff['settings']
+    n = len(atoms)
+    try:
+        types = [int(t) for t in np.char.strip(np.asarray(atoms.types, dtype=str))]
+        classes = [ff['classes'][t] for t in types]
+    except (ValueError, KeyError):
+        raise ValueError('Atom types must be defined in the forcefield')
+    neighbors = _connectivity(n, bonds)
+    springs, angles, torsions, impropers = [], [], [], []
+    pairs_12, pairs_13, pairs_14 = set(), set(), set()
+    for i in range(n):
+        for j in neighbors[i]:
+            if i < j:
+                k, r0 = _lookup(ff['bond'], (classes[i], classes[j]), 'bond')
+                springs.append((i, j, settings['bondunit'] * k, r0))
+                pairs_12.add((i, j))
+    for b in range(n):
+        for a, c in combinations(neighbors[b], 2):
+            k, theta0 = _lookup(ff['angle'], (classes[a], classes[b], classes[c]), 'angle')
+            angles.append((a, b, c, settings['angleunit'] * k * (180 / np.pi)**2,
+                           np.radians(theta0)))
+            pairs_13.add((min(a, c), max(a, c)))
+            urey = (classes[a], classes[b], classes[c])
+            if urey in ff['ureybrad'] or urey[::-1] in ff['ureybrad']:
+                k, r0 = _lookup(ff['ureybrad'], urey, 'ureybrad')
+                springs.append((a, c, settings['ureyunit'] * k, r0))
+    for b in range(n):
+        for c in neighbors[b]:
+            if b > c:
+                continue
+            for a in neighbors[b]:
+                for d in neighbors[c]:
+                    if a == c or d == b or a == d:
+                        continue
+                    terms = _lookup_torsion(ff['torsion'], [classes[x] for x in (a, b, c, d)])
+                    for (amplitude, phase, periodicity) in terms:
+                        if amplitude:
+                            torsions.append((a, b, c, d, settings['torsionunit'] * amplitude,
+                                             np.radians(phase), periodicity))
+                    pairs_14.add((min(a, d), max(a, d)))
+    for center in range(n):
+        if len(neighbors[center]) != 3:
+            continue
+        for (quartet, terms, weight) in _match_out_of_plane(ff['imptors'], center,
+                                                            neighbors[center], classes, 2):
+            for (amplitude, phase, periodicity) in terms:
+                torsions.append(quartet + (weight * settings['imptorunit'] * amplitude,
+                                           np.radians(phase), periodicity))
+        for (quartet, (k, phi0), weight) in _match_out_of_plane(ff['improper'], center,
+                                                               neighbors[center], classes, 0):
+            impropers.append(quartet + (weight * settings['impropunit'] * k *
+                                        (180 / np.pi)**2, np.radians(phi0)))
+    vdw_index = types if settings['vdwindex'] == 'TYPE' else classes
+    try:
+        vdw = np.array([ff['vdw'][i] for i in vdw_index]).reshape(n, 2)
+    except KeyError as e:
+        raise ValueError('No vdw parameters for atom type or class {}'.format(e))
+    vdw14 = np.array([ff['vdw14'].get(i, ff['vdw'][i]) for i in vdw_index]).reshape(n, 2)
+    radii, radii14 = vdw[:, 0].copy(), vdw14[:, 0].copy()
+    for r in (radii, radii14):  # TINKER stores R-min radii
+        if settings['radiustype'] == 'SIGMA':
+            r *= 2**(1 / 6)
+        if settings['radiussize'] == 'DIAMETER':
+            r /= 2
+    charges = np.array([ff['atom_charges'].get(i + 1, ff['charges'].get(t, 0.0))
+                        for (i, t) in enumerate(types)])
+    # Scaled pairs, with 1-2 taking precedence over 1-3 and 1-3 over 1-4
+    pairs_13 -= pairs_12
+    pairs_14 -= pairs_12 | pairs_13
+    special, vdw_scale, chg_scale, is_14 = [], [], [], []
+    for (pairs, order) in ((pairs_12, '12'), (pairs_13, '13'), (pairs_14, '14')):
+        special.extend(i * n + j for (i, j) in pairs)
+        vdw_scale.extend([settings['vdw-{}-scale'.format(order)]] * len(pairs))
+        chg_scale.extend([settings['chg-{}-scale'.format(order)]] * len(pairs))
+        is_14.extend([order == '14'] * len(pairs))
+    order = np.argsort(np.array(special, dtype=np.int64), kind='mergesort')
+    special = np.array(special, dtype=np.int64)[order]
+    vdw_scale, chg_scale = np.array(vdw_scale)[order], np.array(chg_scale)[order]
+    return {
+        'n_atoms': n,
+        'springs': _term_arrays(springs, 2, 2),
+        'angles': _term_arrays(angles, 3, 2),
+        'torsions': _term_arrays(torsions, 4, 3),
+        'impropers': _term_arrays(impropers, 4, 2),
+        'radii': radii, 'epsilons': vdw[:, 1], 'radii14': radii14, 'epsilons14': vdw14[:, 1],
+        'charges': charges * np.sqrt(settings['electric'] / settings['dielectric']),
+        'special': special, 'vdw_scale': vdw_scale, 'chg_scale': chg_scale,
+        'is_14': np.array(is_14, dtype=bool)[order],
+        'excluded': special[(vdw_scale == 0) & (chg_scale == 0)],
+        'settings': settings,
+    }
+
+
+def _term_arrays(terms, n_atoms, n_parameters):
+    """
+    ``(indices, parameters)`` arrays from a list of terms, each one made
+    of ``n_atoms`` indices followed by ``n_parameters`` values.
+    """
+    if not terms:
+        return np.zeros((0, n_atoms), dtype=int), np.zeros((n_parameters, 0))
+    table = np.array(terms, dtype=float).reshape(len(terms), n_atoms + n_parameters)
+    return table[:, :n_atoms].astype(int), table[:, n_atoms:].T.copy()
+
+
+###
+# Terms: energies and gradients of (real or complex) coordinates
+###
+
+def _norm(v):
+    # no absolute values, so complex steps go through
+    return np.sqrt(np.sum(v * v, axis=-1))
+
+
+def _dot(v, w):
+    return np.sum(v * w, axis=-1)
+
+
+def _angle_terms(x, k, theta0):
+    """
+    Harmonic angles. ``x`` has shape ``(m, 3, 3)``: atoms a, b (center), c.
+    """
+    ab, cb = x[:, 0] - x[:, 1], x[:, 2] - x[:, 1]
+    rab2, rcb2 = _dot(ab, ab), _dot(cb, cb)
+    cosine = _dot(ab, cb) / np.sqrt(rab2 * rcb2)
+    if np.iscomplexobj(cosine):
+        cosine = np.clip(cosine.real, -1, 1) + 1j * cosine.imag
+    else:
+        cosine = np.clip(cosine, -1, 1)
+    dt = np.arccos(cosine) - theta0
+    energy = k * dt * dt
+    p = np.cross(cb, ab)
+    rp = _norm(p)
+    rp = np.where(rp.real < 1e-6, 1e-6, rp)  # linear angles
+    deddt = 2 * k * dt
+    ga = (-deddt / (rab2 * rp))[:, None] * np.cross(ab, p)
+    gc = (deddt / (rcb2 * rp))[:, None] * np.cross(cb, p)
+    return energy, np.stack([ga, -ga - gc, gc], axis=1)
+
+
+def _dihedral(x):
+    """
+    Cosine and sine of the dihedral angles of ``x`` (shape ``(m, 4, 3)``),
+    and the derivatives of the angle with respect to the four atoms, up to
+    the ``dE/dphi`` factor (callable).
+    """
+    ba, cb, dc = x[:, 1] - x[:, 0], x[:, 2] - x[:, 1], x[:, 3] - x[:, 2]
+    t, w = np.cross(ba, cb), np.cross(cb, dc)
+    rt2, rw2 = _dot(t, t), _dot(w, w)
+    rtrw = np.sqrt(rt2 * rw2)
+    rcb = _norm(cb)
+    cosine = _dot(t, w) / rtrw
+    sine = _dot(cb, np.cross(t, w)) / (rcb * rtrw)
+
+    def derivatives(dedphi):
+        dt = (dedphi / (rt2 * rcb))[:, None] * np.cross(t, cb)
+        dw = (-dedphi / (rw2 * rcb))[:, None] * np.cross(w, cb)
+        ca, db = x[:, 2] - x[:, 0], x[:, 3] - x[:, 1]
+        return np.stack([np.cross(dt, cb), np.cross(ca, dt) + np.cross(dw, dc),
+                         np.cross(dt, ba) + np.cross(db, dw), np.cross(dw, cb)], axis=1)
+
+    return cosine, sine, derivatives
+
+
+def _torsion_terms(x, amplitude, phase, periodicity):
+    """
+    Fourier torsions, one term per row: ``V (1 + cos(n phi - delta))``.
+    """
+    cosine, sine, derivatives = _dihedral(x)
+    # cos(n phi) and sin(n phi) by recurrence, as TINKER does
+    cos_n, sin_n = np.ones_like(cosine), np.zeros_like(sine)
+    for n in range(1, int(periodicity.max(initial=0)) + 1):
+        cos_n, sin_n = (np.where(periodicity >= n, cos_n * cosine - sin_n * sine, cos_n),
+                        np.where(periodicity >= n, sin_n * cosine + cos_n * sine, sin_n))
+    cos_phase, sin_phase = np.cos(phase), np.sin(phase)
+    energy = amplitude * (1 + cos_n * cos_phase + sin_n * sin_phase)
+    dedphi = amplitude * periodicity * (cos_n * sin_phase - sin_n * cos_phase)
+    return energy, derivatives(dedphi)
+
+
+def _improper_terms(x, k, phi0):
+    """
+    Harmonic impropers, ``k (phi - phi0)^2``.
+    """
+    cosine, sine, derivatives = _dihedral(x)
+    if np.iscomplexobj(cosine):  # first-order rule for atan2, exact for complex steps
+        phi = np.arctan2(sine.real, cosine.real) + 1j * (
+            (cosine.real * sine.imag - sine.real * cosine.imag) /
+            (cosine.real**2 + sine.real**2))
+    else:
+        phi = np.arctan2(sine, cosine)
+    dphi = phi - phi0
+    dphi = dphi - 2 * np.pi * np.round(dphi.real / (2 * np.pi))
+    return k * dphi * dphi, derivatives(2 * k * dphi)
+
+
+def switch_start(cutoff, taper):
+    """
+    Distance at which switching off starts, for a ``cutoff`` and a TINKER
+    ``taper`` value (fraction of the cutoff if up to 1, else a distance).
+    """
+    return taper * cutoff if taper <= 1 else min(taper, cutoff)
+
+
+def _switch(r, cutoff, taper):
+    """
+    Quintic switching function going from 1 at :func:`switch_start` to 0
+    at ``cutoff``, and its first and second derivatives.
+    """
+    on = switch_start(cutoff, taper)
+    width = max(cutoff - on, 1e-12)
+    s = np.clip((r - on) / width, 0, 1)
+    value = 1 - s**3 * (10 - 15 * s + 6 * s * s)
+    first = -30 * s * s * (1 - s)**2 / width
+    second = -60 * s * (1 - s) * (1 - 2 * s) / width**2
+    return value, first, second
+
+
+def pair_parameters(model, i, j):
+    """
+    Lennard-Jones parameters (R-min distance and well depth) and charge
+    product of the atom pairs ``(i, j)``, with 1-4 parameters and the 1-2,
+    1-3 and 1-4 scaling factors applied. Charge products include the
+    ``electric / dielectric`` factor, so the Coulomb energy is ``qq / r``.
+    """
+    settings = model['settings']
+    n = model['n_atoms']
+    vdw_scale, chg_scale = np.ones(len(i)), np.ones(len(i))
+    is_14 = np.zeros(len(i), dtype=bool)
+    if model['special'].size:
+        keys = np.minimum(i, j).astype(np.int64) * n + np.maximum(i, j)
+        position = np.minimum(np.searchsorted(model['special'], keys), model['special'].size - 1)
+        found = model['special'][position] == keys
+        vdw_scale[found] = model['vdw_scale'][position[found]]
+        chg_scale[found] = model['chg_scale'][position[found]]
+        is_14[found] = model['is_14'][position[found]]
+    radii = np.where(is_14[:, None], model['radii14'][np.stack([i, j], 1)],
+                     model['radii'][np.stack([i, j], 1)])
+    epsilons = np.where(is_14[:, None], model['epsilons14'][np.stack([i, j], 1)],
+                        model['epsilons'][np.stack([i, j], 1)])
+    if settings['radiusrule'] == 'GEOMETRIC':
+        rv = 2 * np.sqrt(radii[:, 0] * radii[:, 1])
+    else:
+        rv = radii[:, 0] + radii[:, 1]
+    eps = vdw_scale * np.sqrt(epsilons[:, 0] * epsilons[:, 1])
+    qq = chg_scale * model['charges'][i] * model['charges'][j]
+    return rv, eps, qq
+
+
+def _nonbonded(model, i, j, r, second=False):
+    """
+    Energy (per pair) of Lennard-Jones and Coulomb interactions between
+    atoms ``i`` and ``j`` at distance ``r``, and its first and (optionally)
+    second derivatives with respect to ``r``.
+    """
+    settings = model['settings']
+    rv, eps, qq = pair_parameters(model, i, j)
+    p6 = (rv / r)**6
+    vdw = [eps * p6 * (p6 - 2), eps * 12 * p6 * (1 - p6) / r]
+    chg = [qq / r, -qq / (r * r)]
+    if second:
+        vdw.append(eps * p6 * (156 * p6 - 84) / (r * r))
+        chg.append(2 * qq / r**3)
+    for (values, name) in ((vdw, 'vdw'), (chg, 'chg')):
+        cutoff = settings[name + '-cutoff']
+        if cutoff is None:
+            continue
+        s = _switch(r, cutoff, settings[name + '-taper'])
+        if second:
+            values[2] = values[2] * s[0] + 2 * values[1] * s[1] + values[0] * s[2]
+        values[1] = values[1] * s[0] + values[0] * s[1]
+        values[0] = values[0] * s[0]
+    return [a + b for (a, b) in zip(vdw, chg)]
+
+
+def _nonbonded_pairs(model, xyz):
+    """
+    Nonbonded pairs ``(i, j)``, without the fully excluded ones, in blocks
+    of about ``_CHUNK`` pairs. Without cutoffs, all the pairs are generated
+    block by block, so memory does not grow with the square of the number
+    of atoms; with them, they are found with cell lists.
+    """
+    settings = model['settings']
+    cutoffs = [c for c in (settings['vdw-cutoff'], settings['chg-cutoff']) if c is not None]
+    if len(cutoffs) == 2:
+        i, j = neighbor_pairs(xyz, max(cutoffs))
+        blocks = ((i[start:start+_CHUNK], j[start:start+_CHUNK])
+                  for start in range(0, len(i), _CHUNK))
+    else:
+        blocks = all_pairs(model['n_atoms'], _CHUNK)
+    n, excluded = model['n_atoms'], model['excluded']
+    for (i, j) in blocks:
+        if excluded.size:  # sorted, like the keys of each block
+            keys = i.astype(np.int64) * n + j
+            position = np.minimum(np.searchsorted(excluded, keys), excluded.size - 1)
+            kept = excluded[position] != keys
+            i, j = i[kept], j[kept]
+        yield i, j
+
+
+###
+# Evaluation
+###
+
+def _accumulate(gradients, indices, values):
+    for position in range(indices.shape[1]):
+        for axis in range(3):
+            gradients[:, axis] += np.bincount(indices[:, position], weights=values[:, position, axis],
+                                              minlength=len(gradients))
+
+
+def _add_blocks(data, p, q, blocks):
+    """
+    Add 3x3 ``blocks`` at atoms ``(p, q)`` to a packed lower triangle.
+    """
+    swap = p < q
+    p, q = np.where(swap, q, p), np.where(swap, p, q)
+    blocks = np.where(swap[:, None, None], blocks.transpose(0, 2, 1), blocks)
+    rows = 3 * p[:, None, None] + np.arange(3)[None, :, None]
+    cols = 3 * q[:, None, None] + np.arange(3)[None, None, :]
+    lower = np.broadcast_to(rows >= cols, blocks.shape)
+    rows, cols = np.broadcast_to(rows, blocks.shape)[lower], np.broadcast_to(cols, blocks.shape)[lower]
+    np.add.at(data, rows * (rows + 1) // 2 + cols, blocks[lower])
+
+
+def _pair_terms(gradients, hessian, xyz, i, j, function):
+    """
+    Energy of terms that depend on the distance between atoms ``i`` and
+    ``j``, adding their derivatives to ``gradients`` and ``hessian`` (if
+    not None). ``function(r, second)`` returns the energies and their first
+    and, if ``second``, second derivatives with respect to the distance.
+    """
+    d = xyz[i] - xyz[j]
+    r = np.sqrt(np.einsum('ij,ij->i', d, d))
+    values = function(r, hessian is not None)
+    if gradients is not None:
+        g = (values[1] / r)[:, None] * d
+        _accumulate(gradients, np.stack([i, j], 1), np.stack([g, -g], 1))
+    if hessian is not None:
+        unit = d / r[:, None]
+        uu = unit[:, :, None] * unit[:, None, :]
+        blocks = (values[2] * np.ones_like(r))[:, None, None] * uu + \
+            (values[1] / r)[:, None, None] * (np.eye(3) - uu)
+        _add_blocks(hessian.data, i, i, blocks)
+        _add_blocks(hessian.data, j, j, blocks)
+        _add_blocks(hessian.data, i, j, -blocks)
+    return np.sum(values[0])
+
+
+def _term_hessian(data, terms, function, xyz):
+    """
+    Hessian blocks of terms of ``function``, by complex-step differentiation
+    of their analytic gradients.
+    """
+    indices, parameters = terms
+    for start in range(0, len(indices), _CHUNK // 12):
+        chunk = indices[start:start+_CHUNK // 12]
+        chunk_parameters = [p[start:start+_CHUNK // 12] for p in parameters]
+        m, k = chunk.shape
+        x = xyz[chunk].astype(complex)
+        local = np.empty((m, 3 * k, 3 * k))
+        for s in range(k):
+            for axis in range(3):
+                x[:, s, axis] += 1j * _COMPLEX_STEP
+                gradient = function(x, *chunk_parameters)[1]
+                local[:, :, 3 * s + axis] = gradient.imag.reshape(m, 3 * k) / _COMPLEX_STEP
+                x[:, s, axis] = x[:, s, axis].real
+        local = (local + local.transpose(0, 2, 1)) / 2
+        for s in range(k):
+            for t in range(s + 1):
+                _add_blocks(data, chunk[:, s], chunk[:, t],
+                            local[:, 3 * s:3 * s + 3, 3 * t:3 * t + 3])
+
+
+def evaluate(model, xyz, derivatives=0):
+    """
+    Energy (kcal/mol) and, depending on ``derivatives``, gradients
+    (kcal/mol/A, shape ``(n_atoms, 3)``) and Hessian (kcal/mol/A^2,
+    :class:`garleek.hessian.PackedHessian`) of a system built with
+    :func:`build_model`, at coordinates ``xyz`` (Angstrom).
+    """
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    n = len(xyz)
+    energy = 0.0
+    gradients = np.zeros((n, 3)) if derivatives > 0 else None
+    hessian = PackedHessian(3 * n) if derivatives > 1 else None
+    # Springs (bonds, Urey-Bradley) and nonbonded pairs, functions of distances
+    indices, (k, r0) = model['springs']
+    energy += _pair_terms(gradients, hessian, xyz, indices[:, 0], indices[:, 1],
+                          lambda r, second: (k * (r - r0)**2, 2 * k * (r - r0), 2 * k))
+    for (i, j) in _nonbonded_pairs(model, xyz):
+        energy += _pair_terms(gradients, hessian, xyz, i, j, partial(_nonbonded, model, i, j))
+    # Angles, torsions and impropers
+    for (name, function) in (('angles', _angle_terms), ('torsions', _torsion_terms),
+                             ('impropers', _improper_terms)):
+        indices, parameters = model[name]
+        if not len(indices):
+            continue
+        values, g = function(xyz[indices], *parameters)
+        energy += np.sum(values)
+        if gradients is not None:
+            _accumulate(gradients, indices, g)
+        if hessian is not None:
+            _term_hessian(hessian.data, model[name], function, xyz)
+    return energy, gradients, hessian
+
+
+def _model(key, atoms, bonds):
+    """
+    Model for ``key`` and the topology of ``atoms``, cached.
+    """
+    cache_key = os.path.abspath(key), os.path.getmtime(key), _topology_hash(atoms, bonds)
+    if cache_key not in _models:
+        _models[cache_key] = build_model(read_forcefield(key), atoms, bonds)
+        while len(_models) > _MODELS_SIZE:
+            _models.popitem(last=False)
+    return _models[cache_key]
+
+
+def run_numpyff(atoms, bonds, key, energy=True, dipole_moment=True, gradients=False,
+                hessian=False):
+    """
+    Compute the requested properties in-process for a class I forcefield.
+
+    Parameters
+    ----------
+    atoms : garleek.qm.structure.Atoms or OrderedDict
+        Atoms of the MM system, with coordinates in bohr, as parsed from
+        the QM engine.
+    bonds : garleek.qm.structure.Bonds or OrderedDict
+        Connectivity of the MM system.
+    key : str
+        TINKER ``*.prm`` or ``*.key`` file (see
+        :func:`garleek.mm.tinker.prepare_tinker_key`).
+    energy, dipole_moment, gradients, hessian : bool
+        Properties to compute.
+
+    Returns
+    -------
+    results : dict
+        Same keys and TINKER units as :func:`garleek.mm.tinker.run_tinker`.
+    """
+    atoms = Atoms.from_dict(atoms)
+    bonds = Bonds.from_dict(bonds, n_atoms=len(atoms)) if bonds else None
+    model = _model(key, atoms, bonds)
+    derivatives = 2 if hessian else int(bool(gradients))
+    value, gradient, packed = evaluate(model, atoms.xyz * u.RBOHR_TO_ANGSTROM, derivatives)
+    results = {}
+    if energy:
+        results['energy'] = value
+    if dipole_moment:
+        results['dipole_moment'] = tinker_dipole_moment(key, atoms)
+        if results['dipole_moment'] is None:
+            raise ValueError('Dipole moment could not be computed from `{}`: missing atom '
+                             'types'.format(key))
+    if gradients:
+        results['gradients'] = gradient
+    if hessian:
+        results['hessian'] = packed
+    return results
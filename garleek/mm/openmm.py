@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+mm.openmm.py
+============
+
+MM engine backed by `OpenMM <http://openmm.org>`_, on its CPU platform.
+
+OpenMM's own forcefields assign parameters by matching residue templates,
+which Gaussian EIn files do not carry. Instead, the OpenMM ``System`` is
+built from the same TINKER class I forcefields and atom types as the
+other engines (``amber99sb.prm``, ``charmm22.prm``, ``oplsaa.prm`` and
+keys based on them), from the terms assigned by
+:func:`garleek.mm.numpyff.build_model`:
+
+- bonds and Urey-Bradley terms: ``HarmonicBondForce``
+- angles: ``HarmonicAngleForce``
+- torsions and ``imptors``: ``PeriodicTorsionForce``
+- harmonic impropers: ``CustomTorsionForce``
+- Lennard-Jones and charges: one ``CustomNonbondedForce`` each, with
+  TINKER's combining rules and tapers, and a ``CustomBondForce`` for the
+  scaled 1-4 pairs
+
+so energies match those of :mod:`garleek.mm.numpyff` (and TINKER, without
+cutoffs). A ``Context`` is created once per key file, topology and thread
+count, and kept for the lifetime of the process (across steps, with the
+persistent server); each step only sets the new positions. OpenMM has no
+analytic Hessians, so they are computed by central differences of the
+forces, with ``6N`` evaluations.
+
+OpenMM is an optional dependency (``conda install -c conda-forge openmm``),
+only imported when this engine is used. Results are returned in OpenMM
+units: kJ/mol, nm and elementary charges.
+"""
+
+from __future__ import print_function, absolute_import, division
+import os
+from collections import OrderedDict
+import numpy as np
+from .. import units as u
+from ..hessian import finite_difference_hessian
+from ..qm.structure import Atoms, Bonds
+from .numpyff import read_forcefield, build_model, pair_parameters, switch_start
+from .tinker import _topology_hash, tinker_dipole_moment
+
+#: Default displacement (nm) of the finite-difference Hessian
+HESSIAN_STEP = 1e-4
+_KJ = 1 / u.KJMOL_TO_KCALMOL  # kcal/mol to kJ/mol
+_NM = u.ANGSTROM_TO_NM
+
+_contexts = OrderedDict()
+_CONTEXTS_SIZE = 2
+
+_VDW = 'eps * p6 * (p6 - 2); p6 = (rv / r)^6'
+_PAIR = 'eps * p6 * (p6 - 2) * sw_vdw + qq / r * sw_chg; p6 = (rv / r)^6'
+_SWITCH = ('sw_{name} = 1 - s_{name}^3 * (10 - 15 * s_{name} + 6 * s_{name}^2); '
+           's_{name} = min(1, max(0, (r - {on}) / {width}))')
+
+
+def _import_openmm():
+    try:
+        import openmm
+    except ImportError:
+        try:
+            from simtk import openmm  # OpenMM < 7.6
+        except ImportError:
+            raise ImportError('The openmm MM engine needs OpenMM. Install it with '
+                              '`conda install -c conda-forge openmm`.')
+    return openmm
+
+
+def build_system(model):
+    """
+    OpenMM ``System`` with the terms of ``model`` (see
+    :func:`garleek.mm.numpyff.build_model`), in OpenMM units.
+    """
+    openmm = _import_openmm()
+    system = openmm.System()
+    for _ in range(model['n_atoms']):
+        system.addParticle(1.0)  # masses do not affect energies
+    indices, (k, r0) = model['springs']
+    bonds = openmm.HarmonicBondForce()
+    for (i, j), kb, rb in zip(indices.tolist(), 2 * _KJ * k / _NM**2, _NM * r0):
+        bonds.addBond(i, j, rb, kb)
+    indices, (k, theta0) = model['angles']
+    angles = openmm.HarmonicAngleForce()
+    for (a, b, c), ka, ta in zip(indices.tolist(), 2 * _KJ * k, theta0):
+        angles.addAngle(a, b, c, ta, ka)
+    indices, (amplitude, phase, periodicity) = model['torsions']
+    torsions = openmm.PeriodicTorsionForce()
+    for (a, b, c, d), v, p, m in zip(indices.tolist(), _KJ * amplitude, phase, periodicity):
+        torsions.addTorsion(a, b, c, d, int(m), p, v)
+    indices, (k, phi0) = model['impropers']
+    impropers = openmm.CustomTorsionForce('k * dphi^2; dphi = theta - phi0 - 2 * pi * '
+                                          'floor((theta - phi0 + pi) / (2 * pi)); '
+                                          'pi = {}'.format(np.pi))
+    impropers.addPerTorsionParameter('k')
+    impropers.addPerTorsionParameter('phi0')
+    for (a, b, c, d), ki, pi in zip(indices.tolist(), _KJ * k, phi0):
+        impropers.addTorsion(a, b, c, d, [ki, pi])
+    for force in (bonds, angles, torsions, impropers):
+        system.addForce(force)
+    for force in _nonbonded_forces(model, openmm):
+        system.addForce(force)
+    return system
+
+
+def _nonbonded_forces(model, openmm):
+    """
+    Lennard-Jones and charge forces between all pairs, excluding the
+    1-2, 1-3 and 1-4 ones, which are added separately with their scaling
+    factors.
+    """
+    settings = model['settings']
+    n = model['n_atoms']
+    if settings['radiusrule'] == 'GEOMETRIC':
+        rule = 'rv = 2 * sqrt(r1 * r2)'
+    else:
+        rule = 'rv = r1 + r2'
+    vdw = openmm.CustomNonbondedForce('{}; {}; eps = sqrt(e1 * e2)'.format(_VDW, rule))
+    vdw.addPerParticleParameter('r')
+    vdw.addPerParticleParameter('e')
+    chg = openmm.CustomNonbondedForce('q1 * q2 / r')
+    chg.addPerParticleParameter('q')
+    # Charges already include the electric / dielectric factor
+    for radius, epsilon, charge in zip(_NM * model['radii'], _KJ * model['epsilons'],
+                                       np.sqrt(_KJ * _NM) * model['charges']):
+        vdw.addParticle([radius, epsilon])
+        chg.addParticle([charge])
+    switches = {}
+    for force, name in ((vdw, 'vdw'), (chg, 'chg')):
+        cutoff = settings[name + '-cutoff']
+        switches[name] = 'sw_{} = 1'.format(name)
+        if cutoff is None:
+            force.setNonbondedMethod(openmm.CustomNonbondedForce.NoCutoff)
+            continue
+        on = switch_start(cutoff, settings[name + '-taper'])
+        force.setNonbondedMethod(openmm.CustomNonbondedForce.CutoffNonPeriodic)
+        force.setCutoffDistance(_NM * cutoff)
+        if on < cutoff:
+            force.setUseSwitchingFunction(True)
+            force.setSwitchingDistance(_NM * on)
+        # OpenMM's switching polynomial, for the pairs handled outside these forces
+        switches[name] = _SWITCH.format(name=name, on=_NM * on,
+                                        width=_NM * max(cutoff - on, 1e-12))
+    special = model['special']
+    i, j = special // n, special % n
+    for a, b in zip(i.tolist(), j.tolist()):
+        vdw.addExclusion(a, b)
+        chg.addExclusion(a, b)
+    pairs = openmm.CustomBondForce('; '.join([_PAIR, switches['vdw'], switches['chg']]))
+    for parameter in ('rv', 'eps', 'qq'):
+        pairs.addPerBondParameter(parameter)
+    scaled = (model['vdw_scale'] != 0) | (model['chg_scale'] != 0)
+    if scaled.any():
+        # with the 1-4 parameters and scaling factors
+        rv, eps, qq = pair_parameters(model, i[scaled], j[scaled])
+        for a, b, r, e, q in zip(i[scaled].tolist(), j[scaled].tolist(), _NM * rv, _KJ * eps,
+                                 _KJ * _NM * qq):
+            pairs.addBond(a, b, [r, e, q])
+    return vdw, chg, pairs
+
+
+def _context(key, atoms, bonds, platform='CPU', threads=None):
+    """
+    OpenMM ``Context`` for ``key`` and the topology of ``atoms``, cached.
+    """
+    cache_key = (os.path.abspath(key), os.path.getmtime(key), _topology_hash(atoms, bonds),
+                 platform, threads)
+    if cache_key not in _contexts:
+        openmm = _import_openmm()
+        system = build_system(build_model(read_forcefield(key), atoms, bonds))
+        properties = {}
+        if threads and platform == 'CPU':
+            properties['Threads'] = str(threads)
+        _contexts[cache_key] = openmm.Context(system, openmm.VerletIntegrator(0.001),
+                                              openmm.Platform.getPlatformByName(platform),
+                                              properties)
+        while len(_contexts) > _CONTEXTS_SIZE:
+            _contexts.popitem(last=False)
+    return _contexts[cache_key]
+
+
+def _evaluate(context, xyz, forces=True):
+    """
+    Energy (kJ/mol) and, optionally, forces (kJ/mol/nm) at ``xyz`` (nm).
+    """
+    openmm = _import_openmm()
+    context.setPositions(xyz)
+    state = context.getState(getEnergy=True, getForces=forces)
+    energy = state.getPotentialEnergy().value_in_unit(openmm.unit.kilojoule_per_mole)
+    if not forces:
+        return energy, None
+    return energy, state.getForces(asNumpy=True).value_in_unit(
+        openmm.unit.kilojoule_per_mole / openmm.unit.nanometer)
+
+
+def run_openmm(atoms, bonds, key, energy=True, dipole_moment=True, gradients=False,
+               hessian=False, threads=None, platform='CPU', step=HESSIAN_STEP):
+    """
+    Compute the requested properties with OpenMM, reusing the ``Context``
+    of previous calls for the same key file and topology.
+
+    Parameters
+    ----------
+    atoms : garleek.qm.structure.Atoms or OrderedDict
+        Atoms of the MM system, with coordinates in bohr, as parsed from
+        the QM engine.
+    bonds : garleek.qm.structure.Bonds or OrderedDict
+        Connectivity of the MM system.
+    key : str
+        TINKER ``*.prm`` or ``*.key`` file of a class I forcefield (see
+        :func:`garleek.mm.tinker.prepare_tinker_key`).
+    energy, dipole_moment, gradients, hessian : bool
+        Properties to compute.
+    threads : int, optional=None
+        Threads of the CPU platform. Defaults to OpenMM's choice
+        (``$OPENMM_CPU_THREADS`` or all the cores).
+    platform : str, optional=CPU
+        OpenMM platform. ``Reference`` is slower, but fully double precision.
+    step : float, optional
+        Displacement (nm) of the finite-difference Hessian.
+
+    Returns
+    -------
+    results : dict
+        ``energy`` in kJ/mol, ``dipole_moment`` in e nm (from the fixed
+        charges), ``gradients`` in kJ/mol/nm and ``hessian`` in kJ/mol/nm^2.
+    """
+    atoms = Atoms.from_dict(atoms)
+    bonds = Bonds.from_dict(bonds, n_atoms=len(atoms)) if bonds else None
+    context = _context(key, atoms, bonds, platform=platform, threads=threads)
+    xyz = atoms.xyz * (u.RBOHR_TO_ANGSTROM * _NM)
+    value, forces = _evaluate(context, xyz, forces=gradients)
+    results = {}
+    if energy:
+        results['energy'] = value
+    if dipole_moment:
+        dipole = tinker_dipole_moment(key, atoms)
+        if dipole is None:
+            raise ValueError('Dipole moment could not be computed from `{}`: missing atom '
+                             'types'.format(key))
+        results['dipole_moment'] = dipole / (u.EANGSTROM_TO_DEBYES * u.NM_TO_ANGSTROM)
+    if gradients:
+        results['gradients'] = -forces
+    if hessian:
+        results['hessian'] = finite_difference_hessian(
+            lambda displaced: -_evaluate(context, displaced)[1], xyz, step=step)
+    return results
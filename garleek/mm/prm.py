@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+mm.prm.py
+=========
+
+Helpers to extract structured data from TINKER parameter (``*.prm``)
+and keyword (``*.key``) files, so Garleek does not need to launch
+TINKER to answer simple questions about the forcefield.
+"""
+
+from __future__ import print_function, absolute_import, division
+import os
+from ..cache import digest
+from .prmdb import parameter_database
+
+
+#: Records that make the electrostatics depend on more than fixed point
+#: charges (bond dipoles, multipoles, polarization, MMFF charge increments...)
+NON_FIXED_CHARGE_RECORDS = frozenset([
+    'dipole', 'dipole5', 'dipole4', 'dipole3', 'multipole', 'polarize',
+    'mmffbci', 'mmffpbci', 'chgflx', 'chgpen', 'chgtrn',
+])
+
+#: Records indexed by atom classes, and how many indices they take.
+#: Class 0 is a wildcard in some of them (torsions, out-of-plane bends...)
+CLASS_INDEXED_RECORDS = {
+    'bond': 2, 'bond5': 2, 'bond4': 2, 'bond3': 2, 'electneg': 3,
+    'angle': 3, 'angle5': 3, 'angle4': 3, 'angle3': 3, 'anglep': 3, 'anglef': 3,
+    'strbnd': 3, 'ureybrad': 3, 'angang': 1, 'opbend': 4, 'opdist': 4,
+    'improper': 4, 'imptors': 4, 'torsion': 4, 'torsion5': 4, 'torsion4': 4,
+    'pitors': 2, 'strtors': 4, 'angtors': 4, 'hbond': 2, 'piatom': 1,
+    'pibond': 2, 'pibond5': 2, 'pibond4': 2,
+}
+#: Records indexed by atom classes, or atom types if ``vdwindex type`` is set
+VDW_INDEXED_RECORDS = {'vdw': 1, 'vdw14': 1, 'vdwpr': 2}
+#: Records indexed by atom types
+TYPE_INDEXED_RECORDS = {'atom': 1, 'charge': 1}
+#: Bond dipoles are documented with atom types but looked up with atom classes
+#: in some TINKER versions; keep them if they match either
+EITHER_INDEXED_RECORDS = {'dipole': 2, 'dipole5': 2, 'dipole4': 2, 'dipole3': 2}
+
+_here = os.path.dirname(os.path.abspath(__file__))
+_charge_models = {}
+
+
+def resolve_parameters_path(value, relative_to=None):
+    """
+    Find the file referenced by a ``parameters`` keyword, trying the
+    value as given and with the ``.prm`` extension TINKER would add,
+    relative to the current directory, ``relative_to`` and the
+    forcefields bundled with Garleek.
+
+    Returns None if the file cannot be found.
+    """
+    candidates = [value, value + '.prm']
+    for base in (relative_to, os.path.join(_here, '..', 'data', 'prm')):
+        if base and not os.path.isabs(value):
+            candidates.extend([os.path.join(base, value), os.path.join(base, value + '.prm')])
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return os.path.abspath(candidate)
+
+
+def iter_tinker_records(path):
+    """
+    Iterate over the records of a TINKER ``*.prm`` or ``*.key`` file.
+    Files imported with ``parameters`` in key files are followed at the
+    point they are referenced, so later records override earlier ones, as
+    in TINKER. Like TINKER, ``parameters`` lines in ``*.prm`` files are
+    not imports (some forcefields have them in their header text).
+
+    Yields
+    ------
+    keyword : str
+        Lowercased record keyword (``atom``, ``charge``, ``vdw``...)
+    fields : list of str
+        Remaining whitespace-separated fields, comments excluded
+    """
+    for keyword, fields, _ in _iter_tinker_lines(path):
+        yield keyword, fields
+
+
+def _iter_tinker_lines(path, _seen=None, _databases=False):
+    """
+    Like :func:`iter_tinker_records`, but also yielding the original line.
+
+    With ``_databases``, ``*.prm`` files that can be compiled (see
+    :mod:`garleek.mm.prmdb`) are yielded as a single ``(None, db, path)``
+    item instead of their records.
+    """
+    path = os.path.abspath(path)
+    if _seen is None:
+        _seen = set()
+    if path in _seen:
+        return
+    _seen.add(path)
+    if _databases and path.lower().endswith('.prm'):
+        db = parameter_database(path)
+        if db is not None:
+            yield None, db, path
+            return
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            keyword = fields[0].lower()
+            if keyword == 'parameters' and not path.lower().endswith('.prm'):
+                if len(fields) > 1 and fields[1].lower() != 'none':
+                    imported = resolve_parameters_path(fields[1], os.path.dirname(path))
+                    if imported is None:
+                        raise ValueError('Parameters file `{}` referenced in `{}` '
+                                         'cannot be found'.format(fields[1], path))
+                    for record in _iter_tinker_lines(imported, _seen, _databases):
+                        yield record
+                continue
+            yield keyword, fields[1:], line
+
+
+def parameters_digest(path):
+    """
+    Digest of the contents of a TINKER ``*.prm`` or ``*.key`` file and,
+    for key files, of the files imported with ``parameters``.
+    """
+    parts, pending, seen = [], [os.path.abspath(path)], set()
+    while pending:
+        path = pending.pop(0)
+        if path in seen:
+            continue
+        seen.add(path)
+        with open(path, 'rb') as f:
+            contents = f.read()
+        parts.append(contents)
+        if path.lower().endswith('.prm'):
+            continue
+        for line in contents.decode('utf-8', 'replace').splitlines():
+            fields = line.split('#', 1)[0].split()
+            if len(fields) > 1 and fields[0].lower() == 'parameters' \
+                    and fields[1].lower() != 'none':
+                imported = resolve_parameters_path(fields[1], os.path.dirname(path))
+                if imported is not None:
+                    pending.append(imported)
+    return digest(*parts)
+
+
+def _parse_atom_record(fields):
+    """
+    ``atom  type  class  symbol  "description"  atomic_number  mass  valence``
+
+    The description is quoted and can contain spaces, so the numeric
+    fields are taken from the end of the record.
+    """
+    return fields[0], fields[1], float(fields[-2])
+
+
+def fixed_charge_model(path):
+    """
+    Collect the point charges defined in a TINKER ``*.prm`` or ``*.key`` file.
+
+    Parameters
+    ----------
+    path : str
+        Forcefield or key file. ``parameters`` imports are followed.
+
+    Returns
+    -------
+    model : dict or None
+        Dictionary with keys ``charges`` (type -> charge), ``atom_charges``
+        (atom serial number -> charge, from negative ``charge`` indices as
+        written in ``qmcharges`` mode) and ``masses`` (type -> mass). None if
+        the electrostatics cannot be described with fixed point charges alone.
+    """
+    path = os.path.abspath(path)
+    cache_key = path, os.path.getmtime(path)
+    if cache_key in _charge_models:
+        return _charge_models[cache_key]
+    model = {'charges': {}, 'atom_charges': {}, 'masses': {}}
+    for keyword, fields, _ in _iter_tinker_lines(path, _databases=True):
+        if keyword is None:  # compiled forcefield
+            db = fields
+            if NON_FIXED_CHARGE_RECORDS.intersection(db.keywords):
+                model = None
+                break
+            model['masses'].update((t, mass) for (t, (_, mass)) in db.atoms().items())
+            for index, charge in db.charges().items():
+                if index.startswith('-'):
+                    model['atom_charges'][-int(index)] = charge
+                else:
+                    model['charges'][index] = charge
+        elif keyword in NON_FIXED_CHARGE_RECORDS:
+            model = None
+            break
+        elif keyword == 'atom':
+            atom_type, _, mass = _parse_atom_record(fields)
+            model['masses'][atom_type] = mass
+        elif keyword == 'charge':
+            index, charge = int(fields[0]), float(fields[1])
+            if index < 0:
+                model['atom_charges'][-index] = charge
+            else:
+                model['charges'][str(index)] = charge
+    _charge_models[cache_key] = model
+    return model
+
+
+def atom_classes(path):
+    """
+    Dict mapping the atom types defined in a TINKER ``*.prm`` or ``*.key``
+    file (and the files it imports) to their atom classes.
+    """
+    classes = {}
+    for keyword, fields, _ in _iter_tinker_lines(path, _databases=True):
+        if keyword is None:  # compiled forcefield
+            classes.update((t, c) for (t, (c, _)) in fields.atoms().items())
+        elif keyword == 'atom' and len(fields) > 1:
+            classes[fields[0]] = fields[1]
+    return classes
+
+
+def trim_tinker_parameters(path, types, classes=None):
+    """
+    Reduced copy of a TINKER ``*.prm`` file, with only the parameters
+    that can apply to a system made of the given atom types.
+
+    ``atom``, ``charge`` and ``biotype`` records are kept for the given
+    types, and the records listed in ``CLASS_INDEXED_RECORDS``,
+    ``VDW_INDEXED_RECORDS`` and ``EITHER_INDEXED_RECORDS`` only if all
+    their indices belong to the classes (or types) in use, or are
+    wildcards. Everything else (global keywords, multipoles, polarization,
+    torsion-torsion grids...) is kept verbatim. Comments are dropped.
+
+    Parameters
+    ----------
+    path : str
+        Forcefield file. ``parameters`` imports are followed and inlined.
+    types : iterable of str
+        Atom types present in the system.
+    classes : iterable of str, optional
+        Atom classes present in the system. Taken from the ``atom`` records
+        in ``path`` if not given; pass them if some types are defined
+        elsewhere (in a key file, for example).
+
+    Returns
+    -------
+    contents : str or None
+        Trimmed forcefield. None if it cannot be trimmed safely: MMFF
+        forcefields (whose parameters are assigned through equivalence
+        tables) and types not defined in ``path``.
+    """
+    types = set(str(t) for t in types)
+    records = list(_iter_tinker_lines(path))
+    if any(keyword.startswith('mmff') for (keyword, _, _) in records):
+        return None
+    defined = dict((fields[0], fields[1]) for (keyword, fields, _) in records
+                   if keyword == 'atom' and len(fields) > 1)
+    if classes is None:
+        if not types.issubset(defined):
+            return None
+        classes = set(defined[t] for t in types)
+    classes = set(str(c) for c in classes) | set(['0'])
+    by_type = any(keyword == 'vdwindex' and fields and fields[0].lower() == 'type'
+                  for (keyword, fields, _) in records)
+    indices = {}
+    indices.update(dict((k, (n, classes)) for (k, n) in CLASS_INDEXED_RECORDS.items()))
+    indices.update(dict((k, (n, types if by_type else classes))
+                        for (k, n) in VDW_INDEXED_RECORDS.items()))
+    indices.update(dict((k, (n, types)) for (k, n) in TYPE_INDEXED_RECORDS.items()))
+    indices.update(dict((k, (n, types | classes)) for (k, n) in EITHER_INDEXED_RECORDS.items()))
+    lines = []
+    for keyword, fields, line in records:
+        if keyword == 'biotype':
+            if fields and fields[-1] not in types:
+                continue
+        elif keyword in indices:
+            n, allowed = indices[keyword]
+            if len(fields) >= n and not all(i in allowed for i in fields[:n]):
+                if not (keyword == 'charge' and fields[0].startswith('-')):
+                    continue
+        lines.append(line if line.endswith('\n') else line + '\n')
+    return ''.join(lines)
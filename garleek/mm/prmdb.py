@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+mm.prmdb.py
+===========
+
+Indexed database of the records in a TINKER ``*.prm`` file.
+
+Parsing a 300 KB forcefield to answer a question like *what is the charge
+of type 2001* takes longer than the rest of a small MM step. The first time
+a forcefield is needed, its records are compiled into an SQLite database
+stored in the cache (see :mod:`garleek.cache`), named after the digest of
+the forcefield contents, so it is rebuilt whenever the file changes. Later
+lookups open it memory-mapped and query its indices instead.
+
+Tables
+------
+
+``records``
+    Every record, in file order (``seq``), with its lowercased ``keyword``,
+    its first four fields (``i1`` to ``i4``, the type or class indices in
+    indexed records), its last field (``ilast``) and the original ``line``.
+    Indexed by ``(keyword, i1, i2, i3, i4)``.
+``atoms``
+    ``type -> class, mass`` from ``atom`` records (last definition wins).
+``charges``
+    ``type -> charge`` from ``charge`` records. Negative indices (charges
+    of specific atoms) are kept as such.
+``keywords``
+    Number of records of each keyword.
+
+If SQLite is not available or the cache cannot be written,
+:func:`parameter_database` returns None and callers parse the text.
+"""
+
+from __future__ import print_function, absolute_import, division
+import os
+from tempfile import NamedTemporaryFile
+try:
+    import sqlite3
+except ImportError:  # Python built without SQLite
+    sqlite3 = None
+from ..cache import cache_dir, digest
+
+# Bump when the schema changes
+_FORMAT = 1
+_MMAP_SIZE = 64 * 1024 * 1024
+_databases = {}
+
+_SCHEMA = """
+CREATE TABLE records (seq INTEGER PRIMARY KEY, keyword TEXT NOT NULL,
+                      i1 TEXT, i2 TEXT, i3 TEXT, i4 TEXT, ilast TEXT, line TEXT NOT NULL);
+CREATE INDEX records_index ON records (keyword, i1, i2, i3, i4);
+CREATE TABLE atoms (type TEXT PRIMARY KEY, class TEXT, mass REAL);
+CREATE TABLE charges (type TEXT PRIMARY KEY, charge REAL);
+CREATE TABLE keywords (keyword TEXT PRIMARY KEY, count INTEGER);
+"""
+
+
+def parameter_database(path):
+    """
+    Open the database of the ``*.prm`` file at ``path``, building it
+    if needed. Databases are kept open for the lifetime of the process.
+
+    Returns
+    -------
+    db : ParameterDatabase or None
+        None if SQLite is not available or the database cannot be built.
+    """
+    if sqlite3 is None:
+        return None
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo = path, stat.st_mtime, stat.st_size
+    if memo in _databases:
+        return _databases[memo]
+    with open(path, 'rb') as f:
+        key = digest(_FORMAT, f.read())
+    dbpath = os.path.join(cache_dir('prmdb'), key + '.sqlite')
+    try:
+        if not os.path.isfile(dbpath):
+            _build(path, dbpath)
+        db = ParameterDatabase(dbpath)
+    except (OSError, IOError, ValueError, sqlite3.Error):
+        return None
+    _databases[memo] = db
+    return db
+
+
+def _records(path):
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                yield fields[0].lower(), fields[1:], line
+
+
+def _build(path, dbpath):
+    """
+    Compile the records of ``path`` into a new database at ``dbpath``,
+    written to a temporary file first and renamed into place.
+    """
+    directory = os.path.dirname(dbpath)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    with NamedTemporaryFile(dir=directory, prefix='.tmp-', suffix='.sqlite', delete=False) as f:
+        tmp = f.name
+    try:
+        conn = sqlite3.connect(tmp)
+        try:
+            conn.executescript(_SCHEMA)
+            rows, atoms, charges, counts = [], {}, {}, {}
+            for seq, (keyword, fields, line) in enumerate(_records(path)):
+                indices = (fields + [None] * 4)[:4]
+                rows.append([seq, keyword] + indices + [fields[-1] if fields else None, line])
+                counts[keyword] = counts.get(keyword, 0) + 1
+                if keyword == 'atom' and len(fields) > 2:
+                    atoms[fields[0]] = fields[1], float(fields[-2])
+                elif keyword == 'charge' and len(fields) > 1:
+                    charges[str(int(fields[0]))] = float(fields[1])
+            conn.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.executemany('INSERT INTO atoms VALUES (?, ?, ?)',
+                             [(t, c, m) for (t, (c, m)) in atoms.items()])
+            conn.executemany('INSERT INTO charges VALUES (?, ?)', charges.items())
+            conn.executemany('INSERT INTO keywords VALUES (?, ?)', counts.items())
+            conn.commit()
+        finally:
+            conn.close()
+        os.rename(tmp, dbpath)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ParameterDatabase(object):
+
+    """
+    Read-only, memory-mapped view of a compiled forcefield.
+    See :func:`parameter_database`.
+    """
+
+    def __init__(self, dbpath):
+        self.path = dbpath
+        try:
+            self._conn = sqlite3.connect('file:{}?mode=ro'.format(dbpath), uri=True,
+                                         check_same_thread=False)
+        except TypeError:  # Python 2, no URIs
+            self._conn = sqlite3.connect(dbpath, check_same_thread=False)
+        self._conn.execute('PRAGMA mmap_size = {}'.format(_MMAP_SIZE))
+        self.keywords = dict(self._conn.execute('SELECT keyword, count FROM keywords'))
+
+    def _query(self, sql, *args):
+        return self._conn.execute(sql, args).fetchall()
+
+    def atom(self, atom_type):
+        """
+        ``(class, mass)`` of ``atom_type``, or None if it is not defined.
+        """
+        rows = self._query('SELECT class, mass FROM atoms WHERE type = ?', str(atom_type))
+        return tuple(rows[0]) if rows else None
+
+    def atoms(self):
+        """
+        Dict mapping every defined type to its ``(class, mass)``.
+        """
+        return dict((t, (c, m)) for (t, c, m) in self._query('SELECT type, class, mass FROM atoms'))
+
+    def charge(self, atom_type):
+        """
+        Charge of ``atom_type``, or None if there is no ``charge`` record for it.
+        """
+        rows = self._query('SELECT charge FROM charges WHERE type = ?', str(atom_type))
+        return rows[0][0] if rows else None
+
+    def charges(self):
+        """
+        Dict mapping types (or negative atom indices) to charges.
+        """
+        return dict(self._query('SELECT type, charge FROM charges'))
+
+    def records(self, keyword, *indices):
+        """
+        Fields of the ``keyword`` records whose first fields are ``indices``,
+        in file order. For example, ``db.records('bond', '1', '5')``.
+        """
+        if len(indices) > 4:
+            raise ValueError('Records are indexed by up to 4 fields')
+        where = ''.join(' AND i{} = ?'.format(n) for n in range(1, len(indices) + 1))
+        rows = self._query('SELECT line FROM records WHERE keyword = ?' + where + ' ORDER BY seq',
+                           keyword.lower(), *[str(i) for i in indices])
+        return [line.split('#', 1)[0].split()[1:] for (line,) in rows]
+
+    def lines(self):
+        """
+        Iterate over ``(keyword, indices, last_field, line)`` for every record,
+        in file order. ``indices`` holds the first four fields (None if absent).
+        """
+        cursor = self._conn.execute('SELECT keyword, i1, i2, i3, i4, ilast, line FROM records '
+                                    'ORDER BY seq')
+        for keyword, i1, i2, i3, i4, ilast, line in cursor:
+            yield keyword, (i1, i2, i3, i4), ilast, line
@@ -9,21 +9,66 @@ Garleek - Tinker bridge
 """
 
 from __future__ import print_function, absolute_import, division
+import hashlib
+import io
 import os
+import re
+import select
 import sys
 import shutil
-from distutils.spawn import find_executable
-from subprocess import check_output
+import signal
+import threading
+from collections import deque, OrderedDict
+from functools import partial
+from glob import glob
+from subprocess import Popen, PIPE, CalledProcessError
 from tempfile import NamedTemporaryFile
 import numpy as np
 from  .. import units as u
+from ..hessian import (PackedHessian, FD_STEP, checkpoint_file, finite_difference_hessian)
+from ..qm.structure import Atoms, Bonds
+from ..cache import atomic_write, cache_dir, cached_file, digest
+from ..staging import stage_file
+from .prm import (atom_classes, fixed_charge_model, parameters_digest,
+                  resolve_parameters_path, trim_tinker_parameters)
 
 supported_versions = '8', '8.1', 'qmcharges'
 default_version = '8.1'
 
-tinker_testhess = os.environ.get('TINKER_TESTHESS') or find_executable('testhess')
-tinker_analyze = os.environ.get('TINKER_ANALYZE') or find_executable('analyze')
-tinker_testgrad = os.environ.get('TINKER_TESTGRAD') or find_executable('testgrad')
+_executables = {}
+# testhess builds that write to new files instead of existing named pipes;
+# also recorded in the cache (see _fifo_flag), so later processes know
+_fifo_unsupported = set()
+# Bump when the contents of generated key files change
+_KEY_FORMAT = 1
+# XYZ templates by topology hash, see _tinker_xyz_template
+_xyz_templates = OrderedDict()
+_XYZ_TEMPLATES_SIZE = 8
+# Character to digit lookup table for _decode_fixed_width; NaN for anything
+# that is not a digit, a space, a minus sign or a decimal point
+_DIGITS = np.full(256, np.nan)
+_DIGITS[[ord(c) for c in '0123456789']] = np.arange(10)
+_DIGITS[[ord(c) for c in ' -.']] = 0
+
+
+def _find_executable(name):
+    try:
+        return shutil.which(name)
+    except AttributeError:  # Python 2
+        from distutils.spawn import find_executable
+        return find_executable(name)
+
+
+def tinker_executable(program):
+    """
+    Path to TINKER ``program`` (``analyze``, ``testgrad``, ``testhess``...).
+    ``$TINKER_<PROGRAM>`` takes precedence over ``$PATH``. Lookups are
+    deferred until needed and memoized for the lifetime of the process.
+    """
+    if program not in _executables:
+        _executables[program] = (os.environ.get('TINKER_' + program.upper())
+                                 or _find_executable(program))
+    return _executables[program]
 
 
 def prepare_tinker_xyz(atoms, bonds=None, version=None):
@@ -35,11 +80,16 @@ def prepare_tinker_xyz(atoms, bonds=None, version=None):
 
     TINKER expects coordinates in Angstrom.
 
+    Everything but the coordinates (indices, elements, types and bonds) is
+    static during an ONIOM job, so it is rendered once per topology into a
+    template (see :func:`_tinker_xyz_template`). Each call then only formats
+    the coordinate block, in a single operation.
+
     Parameters
     ----------
-    atoms : OrderedDict
+    atoms : garleek.qm.structure.Atoms or OrderedDict
         Set of atoms to write, following convention defined in :mod:`garleek.qm`.
-    bonds : OrderedDict
+    bonds : garleek.qm.structure.Bonds or OrderedDict
         Connectivity information, following convention defined in :mod:`garleek.qm`.
     version : str, optional=None
         Specific behavior flag, if needed. Like 'qmcharges'
@@ -48,22 +98,57 @@ def prepare_tinker_xyz(atoms, bonds=None, version=None):
     xyzblock : str
         String with XYZ contents
     """
-    out = [str(len(atoms))]
-    for index, atom in atoms.items():
-        if not bonds:
-            atom_bonds = ''
-        else:
-            atom_bonds = ' '.join([str(bonded_to) for (bonded_to, bond_index) in bonds[index]
-                                   if bond_index >= 0.5])
-        line = '{index} E{element} {xyz[0]} {xyz[1]} {xyz[2]} {type} {bonds}'
-        line = line.format(index=index, element=atom['element'], type=atom['type'],
-                           xyz=atom['xyz'] * u.RBOHR_TO_ANGSTROM, bonds=atom_bonds)
-        out.append(line)
+    atoms = Atoms.from_dict(atoms)
+    bonds = Bonds.from_dict(bonds, n_atoms=len(atoms)) if bonds else None
+    template = _tinker_xyz_template(atoms, bonds)
+    return template % tuple((atoms.xyz * u.RBOHR_TO_ANGSTROM).ravel().tolist())
+
+
+def _topology_hash(atoms, bonds=None):
+    """
+    Digest of everything in an XYZ file but the coordinates.
+    """
+    digest = hashlib.sha1(str(len(atoms)).encode())
+    for array in (atoms.elements, atoms.types):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    if bonds:
+        digest.update(bonds.indptr.tobytes())
+        digest.update(bonds.neighbors.tobytes())
+        digest.update((bonds.orders >= 0.5).tobytes())
+    return digest.hexdigest()
+
 
-    return '\n'.join(out)
+def _tinker_xyz_template(atoms, bonds=None):
+    """
+    ``%``-template of a TINKER XYZ file, with ``%.12f`` placeholders for the
+    coordinates. Templates are cached by topology, so a long-lived process
+    (see :mod:`garleek.server`) only renders them once per ONIOM layer.
+    """
+    key = _topology_hash(atoms, bonds)
+    if key in _xyz_templates:
+        return _xyz_templates[key]
+    if bonds:
+        kept = bonds.orders >= 0.5
+        neighbors = bonds.neighbors.astype(str)
+        bonded = [' '.join(neighbors[start:end][kept[start:end]])
+                  for (start, end) in zip(bonds.indptr[:-1], bonds.indptr[1:])]
+    else:
+        bonded = [''] * len(atoms)
+    out = [str(len(atoms))]
+    for index, (element, atom_type, atom_bonds) in enumerate(zip(atoms.elements, atoms.types,
+                                                                 bonded), 1):
+        line = '{index} E{element} %.12f %.12f %.12f {type} {bonds}'
+        out.append(line.format(index=index, element=str(element).replace('%', '%%'),
+                               type=(str(atom_type) or 'None').replace('%', '%%'),
+                               bonds=atom_bonds))
+    template = _xyz_templates[key] = '\n'.join(out)
+    while len(_xyz_templates) > _XYZ_TEMPLATES_SIZE:
+        _xyz_templates.popitem(last=False)
+    return template
 
 
-def prepare_tinker_key(forcefield, atoms=None, version=None):
+def prepare_tinker_key(forcefield, atoms=None, version=None, trim=False, threads=None,
+                       stage=False, scratch=None):
     """
     Prepare a file ready for TINKER's -k option.
 
@@ -84,31 +169,175 @@ def prepare_tinker_key(forcefield, atoms=None, version=None):
         Specific behavior flag. Supports:
         - ``qmcharges``, which would write charges provided by QM engine.
           Needs ``atoms`` to be passed.
+    trim : bool, optional=False
+        Reference a reduced copy of the forcefield, with only the parameters
+        that can apply to the atom types in ``atoms``, so TINKER programs
+        parse less data on startup. See :func:`garleek.mm.prm.trim_tinker_parameters`.
+        The full forcefield is used if it cannot be trimmed safely.
+    threads : int, optional=None
+        Number of OpenMP threads TINKER programs should use (``openmp-threads``).
+        By default, TINKER decides (usually from ``$OMP_NUM_THREADS``).
+    stage : bool, optional=False
+        Make TINKER read node-local copies of the forcefield, the files it
+        imports with ``parameters`` and the generated key, instead of the
+        originals (which may be on a network filesystem). See
+        :func:`garleek.staging.stage_file`.
+    scratch : str, optional=None
+        Directory for keys that cannot be cached (see below), usually the
+        job scratch directory (see :mod:`garleek.scratch`).
+
+    Generated keys (and trimmed forcefields) are stored in the content-addressed
+    cache described in :mod:`garleek.cache`, identified by the forcefield path
+    and modification time, ``version``, the referenced parameter files and
+    the charges. Steps that need the same key reuse the existing file. If the
+    cache cannot be written, keys are written to ``scratch`` (or, if not
+    given, the working directory), as ``garleek.key`` or ``*.charges.key``.
+    User key files are never overwritten.
 
     Returns
     -------
     path: str
         Absolute path to the generated TINKER .key file
     """
-    if forcefield.lower().endswith('.prm'):
-        with open('garleek.key', 'w') as f:
-            print('parameters', os.path.abspath(forcefield), file=f)
-        keypath = os.path.abspath('garleek.key')
-    elif os.path.splitext(forcefield)[1].lower() in ('.par', '.key'):
-        keypath = os.path.abspath(forcefield)
-    else:
+    ext = os.path.splitext(forcefield)[1].lower()
+    if ext not in ('.prm', '.key', '.par'):
         raise ValueError('TINKER key file must be .prm, .key or .par')
-    if version == 'qmcharges' and atoms:
-        keypath_original = keypath
-        keypath = os.path.splitext(keypath_original)[0] + '.charges.key'
-        shutil.copyfile(keypath_original, keypath)
-        with open(keypath, 'a') as f:
-            print('', file=f)
-            for index, atom in atoms.items():
-                print('CHARGE', -1 * index, atom['charge'], file=f)
+    forcefield = os.path.abspath(forcefield)
+    if stage and ext == '.prm':
+        forcefield = stage_file(forcefield)
+    with_charges = version == 'qmcharges' and bool(atoms)
+    trimmer = _parameters_trimmer(forcefield, atoms) if trim and atoms else None
+    extra = []
+    if threads:
+        extra.append('openmp-threads {:d}\n'.format(threads))
+    if ext != '.prm' and not (with_charges or trimmer or extra or stage):
+        return forcefield
+
+    def referenced(prm):
+        if trimmer is not None:
+            prm = trimmer(prm)
+        return stage_file(prm) if stage else prm
+
+    charges = Atoms.from_dict(atoms).charges if with_charges else np.empty(0)
+    # Rendered on every call, so referenced files (trimmed, staged) are always there
+    if ext == '.prm':
+        head = ['parameters {}\n'.format(referenced(forcefield))]
+    else:
+        head = _absolute_parameters(forcefield, referenced)
+    head.extend(extra)
+
+    def contents():
+        lines = list(head)
+        if with_charges:
+            lines.append('\n')
+            indices = -np.arange(1, charges.size + 1)
+            pairs = np.column_stack([indices, charges]).ravel().tolist()
+            lines.append(('CHARGE %d %s\n' * charges.size) % tuple(pairs))
+        return ''.join(lines)
+
+    key = digest(_KEY_FORMAT, forcefield, os.path.getmtime(forcefield), version,
+                 ''.join(head), charges.tobytes())
+    keypath = cached_file('keys', key, contents, suffix='.key')
+    if keypath is None:  # cache not writable, use the scratch or working directory
+        if ext == '.prm':
+            keypath = os.path.abspath(os.path.join(scratch or '.', 'garleek.key'))
+        elif scratch:
+            keypath = os.path.join(scratch, os.path.basename(forcefield))
+        else:
+            keypath = forcefield
+        if with_charges:
+            keypath = os.path.splitext(keypath)[0] + '.charges.key'
+        elif keypath == forcefield:  # never overwrite the user's key
+            keypath = os.path.splitext(keypath)[0] + '.garleek.key'
+        atomic_write(keypath, contents())
+    elif stage:
+        keypath = stage_file(keypath)
     return keypath
 
 
+def _absolute_parameters(keyfile, referenced=None):
+    """
+    Lines of ``keyfile``, with paths in ``parameters`` records made absolute
+    so the key keeps working from any directory (and replaced by the path
+    ``referenced`` returns for them, if given: trimmed or staged copies).
+    """
+    lines = []
+    with open(keyfile) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) > 1 and fields[0].lower() == 'parameters' and fields[1].lower() != 'none':
+                path = resolve_parameters_path(fields[1], os.path.dirname(keyfile))
+                if path is not None:
+                    line = 'parameters {}\n'.format(referenced(path) if referenced else path)
+            lines.append(line if line.endswith('\n') else line + '\n')
+    return lines
+
+
+def _parameters_trimmer(forcefield, atoms):
+    """
+    Function mapping a forcefield path to the path of its cached, trimmed
+    version for the types in ``atoms`` (or to itself, if it cannot be trimmed).
+    None if some types are not defined in ``forcefield`` (or its imports).
+    """
+    types = set(np.char.strip(Atoms.from_dict(atoms).types).tolist())
+    defined = atom_classes(forcefield)
+    if not types.issubset(defined):
+        return None
+    classes = set(defined[t] for t in types)
+
+    def trimmer(prm):
+        key = digest(_KEY_FORMAT, prm, os.path.getmtime(prm), sorted(types), sorted(classes))
+        path = os.path.join(cache_dir('prm'), key + '.prm')
+        if os.path.isfile(path):
+            return path
+        contents = trim_tinker_parameters(prm, types, classes)
+        if contents is None:
+            return prm
+        return cached_file('prm', key, lambda: contents, suffix='.prm') or prm
+
+    return trimmer
+
+
+def tinker_dipole_moment(key, atoms):
+    """
+    Compute the dipole moment (Debyes) of a fixed point-charge model in Python,
+    so ``analyze`` does not need to be launched just for that. Like TINKER,
+    coordinates are taken relative to the center of mass.
+
+    Parameters
+    ----------
+    key : str
+        Path to the TINKER key (or prm) file that will be used for the
+        calculation. Per-atom ``charge`` overrides (negative indices, as
+        written in ``qmcharges`` mode) are honored.
+    atoms : garleek.qm.structure.Atoms or OrderedDict
+        Set of atoms, following convention defined in :mod:`garleek.qm`.
+
+    Returns
+    -------
+    dipole : np.array with shape (3,) or None
+        None if the forcefield is not a fixed point-charge model (bond
+        dipoles, multipoles, polarization...) or some atom types are not
+        defined. TINKER must be used in that case.
+    """
+    model = fixed_charge_model(key)
+    if model is None:
+        return None
+    atoms = Atoms.from_dict(atoms)
+    types, per_atom = np.unique(np.char.strip(atoms.types), return_inverse=True)
+    if not all(atom_type in model['masses'] for atom_type in types):
+        return None
+    masses = np.array([model['masses'][t] for t in types])[per_atom]
+    charges = np.array([model['charges'].get(t, 0.0) for t in types])[per_atom]
+    for index, charge in model['atom_charges'].items():
+        if index <= len(atoms):
+            charges[index - 1] = charge
+    xyz = atoms.xyz.copy()
+    xyz *= u.RBOHR_TO_ANGSTROM
+    center_of_mass = np.dot(masses, xyz) / masses.sum()
+    return np.dot(charges, xyz - center_of_mass) * u.EANGSTROM_TO_DEBYES
+
+
 def _decode(data):
     try:
         return data.decode()
@@ -116,148 +345,687 @@ def _decode(data):
         return data.decode('utf-8', 'ignore')
 
 
+class _StreamedOutput(object):
+
+    """
+    Decoded lines of a running TINKER program stdout, read as they arrive.
+
+    Parsers iterate over it and stop as soon as they have what they need;
+    iterating again resumes where the previous loop stopped. Only the last
+    ``keep`` lines are remembered, to quote them in error messages.
+    """
+
+    def __init__(self, process, keep=100):
+        self.process = process
+        self._tail = deque(maxlen=keep)
+
+    def __iter__(self):
+        for line in iter(self.process.stdout.readline, b''):
+            line = _decode(line)
+            self._tail.append(line)
+            yield line
+
+    def tail(self):
+        return ''.join(self._tail)
+
+    def wait(self):
+        """
+        Consume the remaining output and wait for the program to finish.
+        """
+        for _ in self:
+            pass
+        return self.process.wait()
+
+
+def _lines(data):
+    """
+    Parsers accept either the whole output as a string or any iterable of lines.
+    """
+    if hasattr(data, 'splitlines'):
+        return iter(data.splitlines())
+    return iter(data)
+
+
 def _parse_tinker_analyze(data):
     """
     Takes the output of TINKER's ``analyze`` program and obtain
     the potential energy (kcal/mole) and the dipole x, y, z
-    components (debyes).
+    components (debyes). Reading stops after the dipole line.
     """
     energy, dipole = None, None
-    for line in data.splitlines():
+    for line in _lines(data):
         line = line.strip()
         if line.startswith('Total Potential Energy'):
             energy = float(line[26:49])
         elif line.startswith('Dipole X,Y,Z-Components'):
-            dipole = list(map(float, [line[26:49], line[49:62], line[62:75]]))
+            dipole = np.array([float(line[26:49]), float(line[49:62]), float(line[62:75])])
             break
-    return energy, np.array(dipole)
+    return energy, dipole
 
 
-def _parse_tinker_testgrad(data):
+def _parse_tinker_energy(data):
     """
-
+    Obtain the total potential energy (kcal/mole) reported by any TINKER
+    program (``analyze``, ``testgrad``...). Reading stops right after it.
     """
-    gradients = []
-    lines = data.splitlines()
-    for i, line in enumerate(lines):
+    for line in _lines(data):
         line = line.strip()
-        if line.startswith('Cartesian Gradient Breakdown over Individual Atoms'):
+        if line.startswith('Total Potential Energy'):
+            return float(line.split(':', 1)[1].split()[0])
+
+
+def _parse_tinker_testgrad(data, n_atoms=None):
+    """
+    Takes the output of TINKER's ``testgrad`` program and obtain the
+    cartesian gradients (kcal/mole/A) as a ``(n_atoms, 3)`` array.
+
+    If ``n_atoms`` is given, the array is preallocated and filled as lines
+    arrive. Reading stops at the end of the gradient block. Only active
+    atoms are reported by TINKER, so fewer rows might be returned.
+    """
+    lines = _lines(data)
+    for line in lines:
+        if line.strip().startswith('Cartesian Gradient Breakdown over Individual Atoms'):
             break
+    else:
+        return None
+    for _ in range(3):  # blank, header, blank
+        next(lines, None)
 
-    for line in lines[i+4:]:
-        if not line.strip() or line.startswith('Total Gradient'):
+    gradients = np.empty((n_atoms or 0, 3))
+    i = 0
+    for line in lines:
+        if not line.strip() or line.startswith(' Total Gradient'):
             break
-        fields = line[16:35], line[35:47], line[47:59]
-        gradients.append(list(map(float, fields)))
+        if i == gradients.shape[0]:  # unknown size or more atoms than expected
+            gradients = np.resize(gradients, (max(2 * i, 64), 3))
+        gradients[i] = float(line[16:35]), float(line[35:47]), float(line[47:59])
+        i += 1
+    return gradients[:i]
+
 
-    return np.array(gradients)
+def _decode_fixed_width(block):
+    """
+    Bulk-decode the right-aligned fixed-width real fields TINKER writes in
+    ``.hes`` files. Depending on ``digits``, those are ``f12.4``, ``f14.6``
+    or ``f16.8``; the width is guessed from the decimals of the first field.
+    Numbers too big for their field can run together, so we cannot split on
+    whitespace.
+
+    Fields are decoded as integer mantissas (a lookup table maps characters
+    to digits, and a matrix-vector product with the powers of ten of each
+    column accumulates them), then scaled by the number of decimals. Both
+    operations are exact in double precision, so the result is identical
+    to ``float(field)``.
+
+    Parameters
+    ----------
+    block : str
+        Lines of values, as found in the file (newlines included).
+    """
+    block = block.strip('\r\n')
+    if not block:
+        return np.empty(0)
+    match = re.search(r'\.(\d+)', block)
+    decimals = len(match.group(1)) if match else None
+    width = {4: 12, 6: 14, 8: 16}.get(decimals)
+    if width is None:  # not fixed-width, after all
+        return np.array(block.split(), dtype=float)
+    data = block.replace('\r', '').replace('\n', '')
+    if len(data) % width:  # trailing spaces in some lines
+        data = ''.join(line[:len(line) - len(line) % width] for line in block.splitlines())
+    data = data.encode('ascii')
+    chars = np.frombuffer(data, dtype=np.uint8).reshape(-1, width)
+    dot = width - decimals - 1
+    weights = np.zeros(width)
+    weights[np.arange(width) != dot] = 10.0 ** np.arange(width - 2, -1, -1)
+    values = _DIGITS[chars].dot(weights)
+    if not (chars[:, dot] == ord('.')).all() or np.isnan(values).any():
+        # unexpected characters (asterisks, exponents...); let numpy deal with it
+        return np.frombuffer(data, dtype='S{}'.format(width)).astype(float)
+    values[np.flatnonzero(chars.ravel() == ord('-')) // width] *= -1
+    values /= 10 ** decimals
+    return values
 
 
 def _parse_tinker_testhess(hesfile, n_atoms, remove=False):
     """
+    Parse the ``.hes`` file written by TINKER's ``testhess`` program.
+
+    Each block of values (the diagonal, and then the elements below it for
+    each cartesian coordinate) is decoded in bulk and written straight into
+    a packed lower-triangular array, in the row-major order Gaussian expects
+    (``H[i, j]`` for ``i`` = 1 to 3N, ``j`` = 1 to ``i``).
 
+    Parameters
+    ----------
+    hesfile : str or iterable of str
+        Path to the ``.hes`` file, or its lines. Either way, they are
+        consumed block by block as they arrive.
+    n_atoms : int
+        Number of atoms in the system.
+    remove : bool, optional=False
+        Remove ``hesfile`` after parsing it.
+
+    Returns
+    -------
+    hessian : garleek.hessian.PackedHessian
+        Packed lower triangle of the hessian (kcal/mole/A^2)
     """
-    hessian = np.zeros((n_atoms * 3, n_atoms * 3))
+    hessian = PackedHessian(3 * n_atoms)
     xyz_to_int = {'X': 0, 'Y': 1, 'Z': 2}
-    with open(hesfile) as lines:
+
+    def store(header, block):
+        values = _decode_fixed_width(block)
+        if header.startswith(' Diagonal'):
+            hessian.set_diagonal(values)
+        elif header.startswith(' Off-diagonal'):  # H[column+1:, column]
+            column = 3 * (int(header[39:45]) - 1) + xyz_to_int[header[46:47]]
+            hessian.set_lower_column(column, values)
+
+    def parse(lines):
+        header, block = '', []
         for line in lines:
-            if not line.strip():
-                continue
-            elif line.startswith(' Diagonal'):
-                _, line = next(lines), next(lines).rstrip()  # skip blank line
-                nums = []
-                while line.strip():
-                    nums.extend(filter(bool, [line[:12], line[12:24], line[24:36],
-                                              line[36:48], line[48:60], line[60:72]]))
-                    line = next(lines).rstrip()
-                for i, num in enumerate(map(float, nums)):
-                    hessian[i, i] = num
-            elif line.startswith(' Off-diagonal'):
-                atom_pos, axis_pos = int(line[39:45])-1, xyz_to_int[line[46:47]]
-                _, line = next(lines), next(lines).rstrip() # skip blank line
-                nums = []
-                while line.strip():
-                    nums.extend(filter(bool, [line[:12], line[12:24], line[24:36],
-                                              line[36:48], line[48:60], line[60:72]]))
-                    try:
-                        line = next(lines).rstrip()
-                    except StopIteration:
-                        break
-                j = 3*atom_pos+axis_pos
-                for i, num in enumerate(map(float, nums)):
-                    hessian[i+j+1, j] = num
+            if line.startswith((' Diagonal', ' Off-diagonal')):
+                store(header, ''.join(block))
+                header, block = line, []
+            elif line.strip():
+                block.append(line)
+        store(header, ''.join(block))
+
+    if hasattr(hesfile, 'lower'):
+        # Block by block, so only the packed hessian is ever fully in memory
+        with open(hesfile) as f:
+            parse(f)
+    else:
+        parse(hesfile)
     if remove:
         os.remove(hesfile)
     return hessian
 
 
+def plan_tinker_programs(energy=True, dipole_moment=True, gradients=True, hessian=True):
+    """
+    Choose the smallest set of TINKER programs that covers the requested
+    properties, so each step launches (and re-parses the forcefield) as few
+    times as possible:
+
+    - ``testhess`` is the only one providing the hessian.
+    - ``testgrad`` provides the gradients and also reports the energy.
+    - ``analyze`` is only needed for the dipole moment, or for the energy
+      when no gradients are requested. If it runs anyway, it also reports
+      the energy, which is then cross-checked against ``testgrad``.
+
+    Returns
+    -------
+    plan : list of 2-tuples
+        ``(program, provides)`` pairs, where ``provides`` is the tuple of
+        result keys that should be obtained from ``program``.
+    """
+    plan = []
+    if dipole_moment or (energy and not gradients):
+        plan.append(('analyze', ('energy', 'dipole_moment') if dipole_moment else ('energy',)))
+    if gradients:
+        plan.append(('testgrad', ('energy', 'gradients') if energy else ('gradients',)))
+    if hessian:
+        plan.append(('testhess', ('hessian',)))
+    return plan
+
+
+def _run_tinker_program(command, parser):
+    process = Popen(command, stdout=PIPE)
+    output = _StreamedOutput(process)
+    try:
+        result = parser(output, command)
+    except Exception:
+        process.stdout.close()
+        if process.wait():
+            raise CalledProcessError(process.returncode, command, output.tail())
+        raise
+    # We have everything we need: stop reading. The program might die of
+    # a broken pipe if it was still writing, which is expected. Any other
+    # failure means the data we parsed cannot be trusted.
+    process.stdout.close()
+    if process.wait() not in (0, -signal.SIGPIPE):
+        raise CalledProcessError(process.returncode, command, output.tail())
+    return result
+
+
+def _run_tinker_programs(programs, jobs=None, cpus=None):
+    """
+    Launch several TINKER programs concurrently and parse their output
+    as soon as each one finishes.
+
+    Parameters
+    ----------
+    programs : list of 2-tuples
+        Each item is a ``(command, parser)`` pair. ``command`` is the argument
+        list to launch, and ``parser`` a callable taking the program output
+        (a ``_StreamedOutput``, consumed while the program runs) and the
+        command, returning a dict of results (or raising an error). Parsers
+        can stop reading as soon as they have what they need.
+    jobs : int, optional
+        Maximum number of programs running at the same time. Defaults to
+        ``$GARLEEK_TINKER_JOBS`` or, if unset, all of them at once.
+    cpus : list of int, optional
+        CPUs the programs are pinned to, where supported. Each program is
+        launched from its own thread, which sets its affinity first, so
+        only the children inherit it.
+
+    Returns
+    -------
+    results : dict
+        Union of the dicts returned by each parser. If several programs
+        report the same value, they are cross-checked and a warning is
+        printed if they do not agree.
+    """
+    if jobs is None:
+        jobs = int(os.environ.get('GARLEEK_TINKER_JOBS') or len(programs))
+    slots = threading.Semaphore(max(1, jobs))
+    outcomes = [None] * len(programs)
+
+    def worker(i, command, parser):
+        if cpus:
+            _pin_thread(cpus)
+        with slots:
+            try:
+                print('Running TINKER:', *command)
+                outcomes[i] = True, _run_tinker_program(command, parser)
+            except Exception as e:
+                outcomes[i] = False, e
+
+    threads = [threading.Thread(target=worker, args=(i, command, parser))
+               for i, (command, parser) in enumerate(programs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    errors = [outcome for (ok, outcome) in outcomes if not ok]
+    for error in errors[1:]:  # the first one is raised below
+        print('! TINKER error:', error)
+    if errors:
+        raise errors[0]
+    results = {}
+    for (command, _), (_, outcome) in zip(programs, outcomes):
+        for name, value in outcome.items():
+            if name in results and not np.allclose(results[name], value, rtol=1e-6, atol=1e-3):
+                print('! Warning: TINKER programs disagree on {}: {} vs {} ({})'.format(
+                      name, results[name], value, os.path.basename(command[0])))
+            results.setdefault(name, value)
+    return results
+
+
+def _pin_thread(cpus):
+    """
+    Restrict the calling thread (and the processes it launches) to ``cpus``.
+    Ignored where CPU affinity is not supported.
+    """
+    try:
+        os.sched_setaffinity(0, cpus)
+    except AttributeError:
+        pass
+    except OSError as e:
+        print('! Warning: could not set CPU affinity to {}: {}'.format(
+              ','.join(map(str, cpus)), e))
+
+
+def _memory_file(path, contents):
+    """
+    Replace ``path`` with a symbolic link to an in-memory file (``memfd``)
+    holding ``contents``, through ``/proc/<pid>/fd``. Unlike a pipe, it can
+    be rewound and stat'ed like a regular file, and TINKER still derives
+    the names of its outputs from ``path``.
+
+    Returns
+    -------
+    fd : int or None
+        Descriptor of the in-memory file, to be closed once TINKER is done.
+        None if not supported (the caller should write ``path`` instead).
+    """
+    if not hasattr(os, 'memfd_create') or not os.path.isdir('/proc/self/fd'):
+        return None
+    try:
+        fd = os.memfd_create(os.path.basename(path))
+    except OSError:
+        return None
+    try:
+        data = contents.encode('utf-8')
+        while data:
+            data = data[os.write(fd, data):]
+        os.remove(path)
+        os.symlink('/proc/{}/fd/{}'.format(os.getpid(), fd), path)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _fifo_flag(testhess):
+    """
+    Digest naming the cache file that records that ``testhess`` does not
+    write to named pipes. It covers the path, size and modification time
+    of the executable, so a rebuilt ``testhess`` is tried again. None if
+    the executable cannot be found.
+    """
+    try:
+        stat = os.stat(testhess)
+    except (OSError, TypeError):
+        return None
+    return digest(os.path.abspath(testhess), stat.st_size, stat.st_mtime)
+
+
+def _fifo_supported(testhess):
+    """
+    Whether ``testhess`` may write to named pipes: not known (in this
+    process or, through the cache, in an earlier one) to refuse to.
+    """
+    if testhess in _fifo_unsupported:
+        return False
+    flag = _fifo_flag(testhess)
+    if flag and os.path.isfile(os.path.join(cache_dir('testhess'), flag + '.nofifo')):
+        _fifo_unsupported.add(testhess)
+        return False
+    return True
+
+
+def _make_fifo(path, testhess):
+    """
+    Create a named pipe for ``testhess`` to write its Hessian to, unless
+    this ``testhess`` build is known not to write into existing files.
+    """
+    if not hasattr(os, 'mkfifo') or not _fifo_supported(testhess):
+        return False
+    try:
+        os.mkfifo(path)
+    except OSError:
+        return False
+    return True
+
+
+def _read_hessian_fifo(hesfile, n_atoms, output, command):
+    """
+    Parse the Hessian that ``testhess`` writes to the named pipe ``hesfile``
+    while it runs, so it never reaches the disk and parsing overlaps with
+    the calculation. Its standard output is consumed in another thread.
+
+    The read end is opened without blocking and polled until ``testhess``
+    opens the pipe or exits, so a program that never writes to it (it
+    failed, or see below) cannot leave us waiting forever.
+
+    Some TINKER builds refuse to overwrite existing files and write to a
+    new version (``*.hes_2``) instead. In that case, that file is parsed
+    and pipes are not used with that ``testhess`` any more, in this
+    process or later ones (see :func:`_fifo_supported`).
+    """
+    import fcntl  # Unix only, like named pipes
+    status = []
+    finished = threading.Event()
+
+    def watch():
+        try:
+            status.append(output.wait())
+        except Exception:
+            status.append(-1)
+        finished.set()
+
+    fd = os.open(hesfile, os.O_RDONLY | os.O_NONBLOCK)
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    received = []
+
+    def lines(f):
+        for line in f:
+            if not received:
+                received.append(True)
+            yield line
+
+    hessian = None
+    try:
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        # Data (or the writer closing) makes the pipe readable; before any
+        # writer shows up, it is not
+        while True:
+            done = finished.is_set()
+            ready = bool(poller.poll(0 if done else 100))
+            if ready or done:
+                break
+        if ready:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            with io.open(fd, closefd=False) as f:
+                hessian = _parse_tinker_testhess(lines(f), n_atoms)
+    finally:
+        os.close(fd)
+        watcher.join()
+    if status[0]:
+        raise CalledProcessError(output.process.returncode, command, output.tail())
+    if received:
+        return hessian
+    versions = sorted(glob(hesfile + '_*'), key=os.path.getmtime)
+    if not versions:
+        return None
+    print('! {} does not write to named pipes, using files'.format(command[0]))
+    _fifo_unsupported.add(command[0])
+    flag = _fifo_flag(command[0])
+    if flag:
+        cached_file('testhess', flag, lambda: command[0] + '\n', suffix='.nofifo')
+    hessian = _parse_tinker_testhess(versions[-1], n_atoms)
+    for path in versions:
+        os.remove(path)
+    return hessian
+
+
 def run_tinker(xyz_data, n_atoms, key, energy=True, dipole_moment=True,
-               gradients=True, hessian=True):
-    if not all([tinker_testhess, tinker_analyze, tinker_testgrad]):
+               gradients=True, hessian=True, jobs=None, cpus=None, scratch=None,
+               exchange='files', hessian_method='analytic', hessian_step=FD_STEP,
+               hessian_processes=None, hessian_checkpoint=None, hessian_atoms=None):
+    """
+    Compute the requested properties with TINKER's ``analyze``, ``testgrad``
+    and ``testhess``. Only the programs chosen by :func:`plan_tinker_programs`
+    are launched. They read the same XYZ and key files and are independent,
+    so they run concurrently (up to ``jobs`` at a time).
+
+    Results are given in TINKER units: kcal/mol for ``energy``, Debyes for
+    ``dipole_moment``, kcal/mol/A for ``gradients`` and kcal/mol/A^2 for
+    ``hessian``, which is returned as a :class:`garleek.hessian.PackedHessian`.
+
+    If ``cpus`` is given, the programs are pinned to those CPUs (see
+    :func:`_run_tinker_programs`). The number of threads they use is set
+    in the key file (see :func:`prepare_tinker_key`).
+
+    The XYZ file (and the Hessian written by ``testhess``) are created
+    with unique names in ``scratch`` (by default, the temporary directory)
+    and removed afterwards. With ``exchange='memory'``, no file data is
+    written there: the XYZ path is a link to an in-memory file (see
+    :func:`_memory_file`) and ``testhess`` writes its Hessian to a named
+    pipe, parsed while it is being written (see :func:`_read_hessian_fifo`).
+    Regular files are used where that is not supported.
+
+    With ``hessian_method='fd'``, the Hessian is not computed by ``testhess``
+    but by central differences of ``testgrad`` gradients, displacing each
+    coordinate of the active atoms by ``hessian_step`` A (see
+    :func:`garleek.hessian.finite_difference_hessian`). The ``6N`` runs are
+    spread over ``hessian_processes`` processes (by default, as many as
+    ``cpus`` or all of them). If ``hessian_checkpoint`` is a directory,
+    completed columns are saved there and reused if the same calculation is
+    interrupted and requested again.
+
+    If ``hessian_atoms`` (0-based indices) are given, only their block of
+    the Hessian is computed, always by finite differences, and the rest is
+    zero (a partial Hessian, see :mod:`garleek.hessian`).
+    """
+    if hessian_method not in ('analytic', 'fd'):
+        raise ValueError('Unknown Hessian method `{}`'.format(hessian_method))
+    fd_hessian = hessian and (hessian_method == 'fd' or hessian_atoms is not None)
+    plan = plan_tinker_programs(energy=energy, dipole_moment=dipole_moment,
+                                gradients=gradients, hessian=hessian and not fd_hessian)
+    needed = [program for (program, _) in plan] + (['testgrad'] if fd_hessian else [])
+    executables = dict((program, tinker_executable(program)) for program in needed)
+    if not all(executables.values()):
         raise RuntimeError('TINKER executables could not be found in $PATH')
 
     error = 'Could not obtain {}! Command run:\n  {}\n\nTINKER output:\n{}'
 
-    with NamedTemporaryFile(suffix='.xyz', delete=False, mode='w') as f_xyz:
-        f_xyz.write(xyz_data)
+    if exchange not in ('files', 'memory'):
+        raise ValueError('Unknown exchange mode `{}`'.format(exchange))
+    with NamedTemporaryFile(suffix='.xyz', prefix='tinker-', dir=scratch, delete=False,
+                            mode='w') as f_xyz:
         xyz = f_xyz.name
+        memfd = _memory_file(xyz, xyz_data) if exchange == 'memory' else None
+        if memfd is None:
+            f_xyz.write(xyz_data)
+    hesfile = os.path.splitext(xyz)[0] + '.hes'
+    inactive_indices, all_active = _inactive_atoms(key)
+    fifo = (exchange == 'memory' and hessian and not fd_hessian and
+            _make_fifo(hesfile, executables.get('testhess')))
 
-    results = {}
-    if energy or dipole_moment:
-        args = ','.join(['E' if energy else '', 'M' if dipole_moment else ''])
-        command = [tinker_analyze, xyz, '-k', key, args]
-        print('Running TINKER:', *command)
-        output = _decode(check_output(command))
+    def parse_analyze(output, command):
         energy, dipole = _parse_tinker_analyze(output)
         if energy is None:
-            raise ValueError(error.format('energy', ' '.join(command), _decode(output)))
-        results['energy'] = energy
+            raise ValueError(error.format('energy', ' '.join(command), output.tail()))
+        if not dipole_moment:
+            return {'energy': energy}
         if dipole is None:
-            raise ValueError(error.format('dipole', ' '.join(command), _decode(output)))
-        results['dipole_moment'] = dipole
+            raise ValueError(error.format('dipole', ' '.join(command), output.tail()))
+        return {'energy': energy, 'dipole_moment': dipole}
 
-    if gradients:
-        command = [tinker_testgrad, xyz, '-k', key,  'y', 'n', '0.1D-04']
-        print('Running TINKER:', *command)
-        output = _decode(check_output(command))
-        gradients = _parse_tinker_testgrad(output)
-        if gradients is None:
-            raise ValueError(error.format('gradients', ' '.join(command), _decode(output)))
-        results['gradients'] = gradients
+    def parse_testgrad(output, command):
+        results = {}
+        if energy:
+            # energy is printed before the gradients block
+            results['energy'] = _parse_tinker_energy(output)
+            if results['energy'] is None:
+                raise ValueError(error.format('energy', ' '.join(command), output.tail()))
+        results['gradients'] = _parse_tinker_testgrad(output, n_atoms)
+        if results['gradients'] is None or (all_active and
+                                            len(results['gradients']) != n_atoms):
+            raise ValueError(error.format('gradients', ' '.join(command), output.tail()))
+        return results
 
-    if hessian:
-        command = [tinker_testhess, xyz, '-k', key, 'y', 'n']
-        print('Running TINKER:', *command)
-        output = _decode(check_output(command))
-        hesfile = os.path.splitext(xyz)[0] + '.hes'
-        hessian = _parse_tinker_testhess(hesfile, n_atoms, remove=True)
+    def parse_testhess(output, command):
+        if fifo:
+            hessian = _read_hessian_fifo(hesfile, n_atoms, output, command)
+        else:
+            if output.wait():
+                raise CalledProcessError(output.process.returncode, command, output.tail())
+            hessian = _parse_tinker_testhess(hesfile, n_atoms, remove=True)
         if hessian is None:
-            raise ValueError(error.format('hessian', ' '.join(command), _decode(output)))
-        results['hessian'] = hessian
+            raise ValueError(error.format('hessian', ' '.join(command), output.tail()))
+        return {'hessian': hessian}
 
-    inactive_indices = []
-    with open(key) as f:
-        for line in f:
-            if line.lower().startswith('inactive'):
-                inactive_indices.extend([int(i) for i in line.split()[1:]])
+    commands = {
+        'analyze': ([executables.get('analyze'), xyz, '-k', key, 'E,M' if dipole_moment else 'E'],
+                    parse_analyze),
+        'testgrad': ([executables.get('testgrad'), xyz, '-k', key,  'y', 'n', '0.1D-04'], parse_testgrad),
+        'testhess': ([executables.get('testhess'), xyz, '-k', key, 'y', 'n'], parse_testhess),
+    }
+    programs = [commands[program] for (program, _) in plan]
+
+    try:
+        results = _run_tinker_programs(programs, jobs=jobs, cpus=cpus)
+    finally:
+        os.remove(xyz)
+        if memfd is not None:
+            os.close(memfd)
+        if os.path.exists(hesfile):  # the pipe, or left behind by a failed testhess
+            os.remove(hesfile)
+
+    if fd_hessian:
+        template, coordinates = _coordinates_template(xyz_data, n_atoms)
+        active = np.setdiff1d(np.arange(n_atoms), np.array(inactive_indices, dtype=int) - 1)
+        if hessian_atoms is not None:
+            active = np.intersect1d(active, hessian_atoms)
+        checkpoint = checkpoint_file(hessian_checkpoint, 'testgrad', parameters_digest(key),
+                                     template)
+        print('Computing TINKER Hessian from {} testgrad runs'.format(6 * len(active)))
+        results['hessian'] = finite_difference_hessian(
+            partial(_testgrad_gradients, template, key, inactive_indices, all_active, scratch),
+            coordinates, step=hessian_step, checkpoint=checkpoint, atoms=active,
+            couplings=hessian_atoms is None,
+            processes=hessian_processes or (len(cpus) if cpus else None))
 
     if inactive_indices:
         results = patch_tinker_output_for_inactive_atoms(results, inactive_indices, n_atoms)
 
-    os.remove(xyz)
     return results
 
 
+def _coordinates_template(xyz_data, n_atoms):
+    """
+    ``%``-template of a TINKER XYZ file (see :func:`_tinker_xyz_template`)
+    and the ``(n_atoms, 3)`` coordinates in it.
+    """
+    lines = xyz_data.replace('%', '%%').splitlines()
+    coordinates = np.empty((n_atoms, 3))
+    for i in range(n_atoms):
+        fields = lines[i + 1].split()
+        coordinates[i] = [float(v) for v in fields[2:5]]
+        lines[i + 1] = ' '.join(fields[:2] + ['%.12f'] * 3 + fields[5:])
+    return '\n'.join(lines), coordinates
+
+
+def _inactive_atoms(key):
+    """
+    1-based indices listed in the ``inactive`` records of ``key``, and
+    whether all the atoms are active (no ``inactive`` nor ``active``
+    records), so TINKER reports gradients for every one of them.
+    """
+    inactive, restricted = [], False
+    with open(key) as f:
+        for line in f:
+            keyword = line.lower()
+            if keyword.startswith('inactive'):
+                inactive.extend([int(i) for i in line.split()[1:]])
+            elif keyword.startswith('active'):
+                restricted = True
+    return inactive, not (inactive or restricted)
+
+
+def _testgrad_gradients(template, key, inactive, all_active, scratch, xyz):
+    """
+    Gradients (kcal/mol/A) at ``xyz`` (A) from ``testgrad``, used for
+    finite-difference Hessians, in pool processes. ``template`` is a
+    TINKER XYZ file with ``%.12f`` placeholders for the coordinates.
+    """
+    n_atoms = len(xyz)
+    with NamedTemporaryFile(suffix='.xyz', prefix='tinker-', dir=scratch, delete=False,
+                            mode='w') as f:
+        f.write(template % tuple(xyz.ravel().tolist()))
+    command = [tinker_executable('testgrad'), f.name, '-k', key, 'y', 'n', '0.1D-04']
+
+    def parse_testgrad(output, command):
+        gradients = _parse_tinker_testgrad(output, n_atoms)
+        if gradients is None or (all_active and len(gradients) != n_atoms):
+            raise ValueError('Could not obtain gradients! Command run:\n  {}\n\nTINKER '
+                             'output:\n{}'.format(' '.join(command), output.tail()))
+        return {'gradients': gradients}
+
+    try:
+        results = _run_tinker_program(command, parse_testgrad)
+    finally:
+        os.remove(f.name)
+    if inactive:
+        results = patch_tinker_output_for_inactive_atoms(results, inactive, n_atoms)
+    return results['gradients']
+
+
 def patch_tinker_output_for_inactive_atoms(results, indices, n_atoms):
     """
-    TODO: Patch 'hessian' to support FREQ calculations with inactive
+    TINKER does not report gradients for inactive atoms, but Gaussian
+    expects one per atom: insert zeros at their positions. If present,
+    the rows and columns of the hessian that belong to inactive atoms
+    are zeroed in place too, so frozen atoms are decoupled from the rest.
     """
-    values = results['gradients']
-    shape = (n_atoms, 3)
-    idx = np.array(indices) - 1
-    filled = np.zeros(shape, dtype=values.dtype)
-    mask = np.ones(shape[0], np.bool)
-    mask[idx] = 0
-    filled[mask] = values
-    results['gradients'] = filled
+    values = results.get('gradients')
+    if values is not None:
+        shape = (n_atoms, 3)
+        idx = np.array(indices) - 1
+        filled = np.zeros(shape, dtype=values.dtype)
+        mask = np.ones(shape[0], bool)
+        mask[idx] = 0
+        filled[mask] = values
+        results['gradients'] = filled
+    if results.get('hessian') is not None:
+        results['hessian'].zero_atoms(indices)
     return results
@@ -39,8 +39,8 @@ keys and values:
         Global charge of the structure
     spin : int
         Multiplicity of the system
-    atoms : OrderedDict of dicts
-        Ordered dictionary mapping atom index with another
+    atoms : garleek.qm.structure.Atoms or OrderedDict of dicts
+        Ordered mapping of atom index with another
         dictionary containing these values:
 
         - ``element`` : ``str``. Chemical element
@@ -48,9 +48,16 @@ keys and values:
         - ``xyz`` : ``np.array`` with shape (3,). Cartesian coordinates
         - ``charge`` : ``float``. Atom point charge for the MM part
 
-    bonds : OrderedDict of lists of 2-tuples
-        Ordered dictionary mapping atom-index to a list of
+    bonds : garleek.qm.structure.Bonds or OrderedDict of lists of 2-tuples
+        Ordered mapping of atom-index to a list of
         2-tuples containing bonded atom index (int) and
         bond order (float)
 
+Parsers should return the columnar :class:`~garleek.qm.structure.Atoms`
+and :class:`~garleek.qm.structure.Bonds` objects, which store the data
+in contiguous arrays (``elements``, ``types``, ``xyz``, ``charges``;
+CSR ``indptr``, ``neighbors``, ``orders``) and also implement the
+mapping interface above. Consumers should accept plain dicts too;
+``Atoms.from_dict`` and ``Bonds.from_dict`` convert them.
+
 """
\ No newline at end of file
@@ -9,31 +9,55 @@ Garleek - Gaussian bridge
 """
 
 from __future__ import print_function, absolute_import, division
-from collections import OrderedDict
+from io import StringIO
 import re
 import sys
 import numpy as np
-from .. import __version__
 from ..atom_types import ELEMENTS
+from .structure import Atoms, Bonds
 
 
 supported_versions = '09a', '09b', '09c', '09d', '16'
 default_version = '16'
+_QM_ATOMS_PLACEHOLDER = ' <garleek-qm-atoms>'
 
 
 class GaussianPatcher(object):
 
-    def __init__(self, filename, atom_types, mm='tinker', qm='gaussian', forcefield=None, version=default_version):
+    def __init__(self, filename, atom_types, mm='tinker', qm='gaussian', forcefield=None,
+                 version=default_version, server=False, phva_radius=None,
+                 phva_atoms=None):
         self.filename = filename
         self.atom_types = atom_types
         self.mm = mm
         self.qm = qm
         self.forcefield = forcefield
         self.version = version
+        self.server = server
+        self.phva_radius = phva_radius
+        self.phva_atoms = phva_atoms
         self.basis_patch = None
+        self.nproc = None
+        self.cpus = None
+        self.qm_atoms = []  # 1-based, in the high and medium layers
 
         self._external_rx = r'#.*oniom=?\(\w+\/([^\s:/]+):((external|amber|uff|dreiding)(=?("[^"]+"|\w+))?)(\/\S+)?\).*'
         self._opt_rx = r'#.*((opt\w*)=?\(?([^\s\)]+)?\)?).*'
+        self._link0_rx = r'%\s*(nprocshared|nprocs|nproc|cpu)\s*=\s*([\d,\-]+)'
+
+    def _parse_link0(self, line):
+        """
+        Keep the processors reserved with ``%nprocshared`` (or ``%nproc``)
+        and ``%cpu`` so the MM engine uses the same ones.
+        """
+        matches = re.match(self._link0_rx, line, re.IGNORECASE)
+        if not matches:
+            return
+        keyword, value = matches.group(1).lower(), matches.group(2)
+        if keyword == 'cpu':
+            self.cpus = value
+        else:
+            self.nproc = int(value)
 
     def _is_route(self, line):
         return line.startswith('#')
@@ -50,6 +74,15 @@ class GaussianPatcher(object):
         command = 'garleek-backend --qm {} --mm {}'.format(self.qm, self.mm)
         if self.forcefield:
             command += " --ff '{}'".format(self.forcefield)
+        if self.nproc:
+            command += ' --nproc {}'.format(self.nproc)
+        if self.cpus:
+            command += ' --cpus {}'.format(self.cpus)
+        if self.server:
+            command += ' --server'
+        if self.phva_radius or self.phva_atoms:
+            # QM atoms are only known once the molecule specification is read
+            command += _QM_ATOMS_PLACEHOLDER
         return line.replace(matches.group(2), 'external="{}"{}'.format(command, gen))
 
     def _patch_opt_keyword(self, line):
@@ -64,6 +97,18 @@ class GaussianPatcher(object):
         opt_options = ','.join(['nomicro'] + (opt_options.split(',') if opt_options else []))
         return line.replace(matches[0], '{}({})'.format(matches[1], opt_options))
 
+    def _record_layer(self, line, index):
+        """
+        Keep the index of the atom in ``line`` if it belongs to the high or
+        medium ONIOM layers. The layer is the first field after the atom
+        specification that is not a number (freeze code or coordinates).
+        """
+        for field in line.split()[1:]:
+            if field.upper() in ('H', 'M', 'L'):
+                if field.upper() != 'L':
+                    self.qm_atoms.append(index)
+                return
+
     def _patch_atom_type(self, line):
         """
         Atom types in Gaussian cannot contain the following characters:
@@ -114,7 +159,9 @@ class GaussianPatcher(object):
         return line
 
     def patch(self):
+        from .. import __version__
         skipped_mult_charges = False
+        n_atoms = 0
         blocks = [['! Created with Garleek v{}\n'.format(__version__)]]
         basis_index = []
         errors = []
@@ -123,6 +170,8 @@ class GaussianPatcher(object):
                 orig_line, line = line, line.strip()
                 if line.startswith('!'):
                     continue
+                elif line.startswith('%'):
+                    self._parse_link0(line)
                 elif not line:
                     blocks.append([])
                 elif self._is_route(line):
@@ -130,6 +179,8 @@ class GaussianPatcher(object):
                     orig_line = self._patch_opt_keyword(orig_line)
                 elif line and len(blocks) == 3:
                     if skipped_mult_charges:
+                        n_atoms += 1
+                        self._record_layer(line, n_atoms)
                         try:
                             orig_line = self._patch_atom_type(orig_line)
                         except Exception as e:
@@ -155,7 +206,34 @@ class GaussianPatcher(object):
                 blocks.insert(idx, blocks[idx])
                 blocks.insert(idx+3, blocks[idx+1])
 
-        return ''.join([l for b in blocks for l in b])
+        patched = ''.join([l for b in blocks for l in b])
+        if _QM_ATOMS_PLACEHOLDER in patched:
+            options = ''
+            if self.qm_atoms:
+                if self.phva_atoms:
+                    options += ' --phva-atoms {}'.format(_index_ranges(self.phva_atoms))
+                if self.phva_radius:
+                    options += ' --phva-radius {}'.format(self.phva_radius)
+                options += ' --qm-atoms {}'.format(_index_ranges(self.qm_atoms))
+            else:
+                print('! No atoms in the high or medium layers: partial MM Hessians '
+                      'will not be computed')
+            patched = patched.replace(_QM_ATOMS_PLACEHOLDER, options)
+        return patched
+
+
+def _index_ranges(indices):
+    """
+    Compact representation of sorted integers, like ``1-3,8,10-11``.
+    """
+    ranges = []
+    for index in sorted(set(indices)):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last)
+                    for first, last in ranges)
 
 
 def patch_gaussian_input(*a, **kw):
@@ -180,54 +258,39 @@ def parse_gaussian_EIn(ein_filename, version=default_version):
     - ``derivatives-requested`` can be ``0`` (energy only), ``1`` (first derivatives)
       or ``2`` (second derivatives).
     - ``version`` must be one of ``garleek.qm.gaussian.supported_versions``
+
+    Atoms whose type starts with ``#`` (``EmbedCharge``) are left out and the
+    remaining ones renumbered sequentially, connectivity included.
+
+    ``atoms`` and ``bonds`` are returned as columnar :class:`garleek.qm.structure.Atoms`
+    and :class:`garleek.qm.structure.Bonds` objects, which also behave as
+    the dicts documented in :mod:`garleek.qm`.
     """
+    if version in ('09d', '16'):
+        bond_index_pos, bond_list_pos = 0, 1
+    elif version in ('03', '09a', '09b', '09c'):
+        bond_index_pos, bond_list_pos = 1, 6
+    else:
+        raise ValueError('`version` must be one of {}'.format(', '.join(supported_versions)))
     with open(ein_filename) as f:
         n_atoms, derivatives, charge, spin = list(map(int, next(f).split()))
-        atoms = OrderedDict()
-        j = 0  # actual sequential index
-        atom_map = {}  # maps original indices to new sequential indices
-                       # only different if EmbedCharge == version
-        for i in range(n_atoms):  # original atom index
-            fields = next(f).strip().split()
-            atom_element = fields[0]
-            atom_type = fields[5] if len(fields) == 6 else None
-            if atom_type.startswith('#'):
-                continue
-            x, y, z, charge = list(map(float, fields[1:5]))
-            j += 1
-            atoms[j] = {'element': atom_element,
-                        'type': atom_type,
-                        'xyz': np.array([x, y, z]),
-                        'charge': charge}
-            atom_map[i+1] = j
-
-        line = next(f)  # Skip the "connectivity" header
-        has_bonds = False
+        elements, types, numbers = _parse_EIn_atoms([next(f) for _ in range(n_atoms)])
+        line = next(f, '')  # Skip the "connectivity" header
         if 'connectivity' in line.strip().lower():
-            line = next(f)
-            has_bonds = True
-        bonds = OrderedDict()
-        if version in ('09d', '16'):
-            bond_index_pos = 0
-            bond_list_pos = 1
-        elif version in ('03', '09a', '09b', '09c'):
-            bond_index_pos = 1
-            bond_list_pos = 6
-        else:
-            raise ValueError('`version` must be one of {}'.format(', '.join(supported_versions)))
+            line = next(f, '')
+        bond_lines = []
         while line.strip():
-            fields = line.strip().split()
-            frombondindex = int(fields[bond_index_pos])
-            if frombondindex not in atom_map:
-                line = next(f, '')
-                continue
-            bonds[atom_map[frombondindex]] = bond_list = []
-            for to_atom, bond_order in zip(fields[bond_list_pos::2], fields[bond_list_pos+1::2]):
-                to_atom_int = int(to_atom)
-                if to_atom_int in atom_map:
-                    bond_list.append((atom_map[to_atom_int], float(bond_order)))
+            bond_lines.append(line)
             line = next(f, '')
 
+    # maps original indices to new sequential indices (0 if left out);
+    # only different if EmbedCharge == version
+    keep = np.char.find(types, '#') != 0
+    atom_map = np.zeros(n_atoms + 1, dtype=int)
+    atom_map[1:][keep] = np.arange(1, keep.sum() + 1)
+    atoms = Atoms(elements[keep], types[keep], numbers[keep, :3], numbers[keep, 3])
+    bonds = _parse_EIn_bonds(bond_lines, atom_map, len(atoms), bond_index_pos, bond_list_pos)
+
     return {'n_atoms': n_atoms,
             'derivatives': derivatives,
             'charge': charge,
@@ -236,10 +299,71 @@ def parse_gaussian_EIn(ein_filename, version=default_version):
             'bonds': bonds}
 
 
-def prepare_gaussian_EOu(n_atoms, energy, dipole_moment, gradients=None, hessian=None,
-                         polarizability=None, dipole_polarizability=None):
+def _parse_EIn_atoms(lines):
+    """
+    Parse the atom lines of an EIn file: ``I10`` element followed by four
+    ``F20.12`` fields (x, y, z, charge) and the atom type. The numeric
+    block is converted at once; lines that do not follow that layout are
+    split field by field instead.
+
+    Returns
+    -------
+    elements, types : np.array of str
+    numbers : np.array with shape (n_atoms, 4)
+        Coordinates and charges
     """
-    Generate the ``*.EOu`` file Gaussian expects after ``external`` launch.
+    if all(len(line) > 90 and line[9] != ' ' and line[90] == ' ' for line in lines):
+        try:
+            numbers = np.frombuffer(''.join([line[10:90] for line in lines]).encode('ascii'),
+                                    dtype='S20').astype(float).reshape(-1, 4)
+        except (ValueError, UnicodeError):
+            pass
+        else:
+            elements = np.array([line[:10].strip() for line in lines], dtype=str)
+            types = np.array([line[90:].strip() for line in lines], dtype=str)
+            return elements, types, numbers
+    fields = [line.split() for line in lines]
+    elements = np.array([f[0] for f in fields], dtype=str)
+    types = np.array([f[5] if len(f) == 6 else '' for f in fields], dtype=str)
+    numbers = np.array([f[1:5] for f in fields], dtype=float).reshape(-1, 4)
+    return elements, types, numbers
+
+
+def _parse_EIn_bonds(lines, atom_map, n_atoms, bond_index_pos=0, bond_list_pos=1):
+    """
+    Parse the connectivity lines of an EIn file into CSR bonds, renumbering
+    atoms with ``atom_map`` and dropping bonds to atoms mapped to 0.
+    """
+    if not lines:
+        return Bonds([0], [], [])
+    fields = [line.split() for line in lines]
+    lengths = np.array([len(f) for f in fields])
+    tokens = np.array([token for f in fields for token in f], dtype=float)
+    starts = np.cumsum(lengths) - lengths
+    # position of each token in its line, and number of (atom, order) pairs per line
+    position = np.arange(tokens.size) - np.repeat(starts, lengths)
+    n_pairs = np.repeat(np.maximum(lengths - bond_list_pos, 0) // 2, lengths)
+    in_pairs = (position >= bond_list_pos) & (position < bond_list_pos + 2 * n_pairs)
+    from_atoms = np.repeat(tokens[starts + bond_index_pos].astype(int), lengths)[in_pairs][::2]
+    to_atoms = tokens[in_pairs][::2].astype(int)
+    orders = tokens[in_pairs][1::2]
+
+    def remap(indices):
+        mapped = np.zeros(indices.size, dtype=int)
+        valid = (indices > 0) & (indices < atom_map.size)
+        mapped[valid] = atom_map[indices[valid]]
+        return mapped
+
+    from_atoms, to_atoms = remap(from_atoms), remap(to_atoms)
+    kept = (from_atoms > 0) & (to_atoms > 0)
+    return Bonds.from_pairs(n_atoms, from_atoms[kept], to_atoms[kept], orders[kept])
+
+
+def write_gaussian_EOu(f, n_atoms, energy, dipole_moment, gradients=None, hessian=None,
+                       polarizability=None, dipole_polarizability=None):
+    """
+    Write the ``*.EOu`` file Gaussian expects after ``external`` launch
+    to the file object ``f``.
 
     After performing the MM calculations, Gaussian expects a file with the
     following information (all in atomic units; taken from
@@ -264,23 +388,56 @@ def prepare_gaussian_EOu(n_atoms, energy, dipole_moment, gradients=None, hessian
     In the latter case, the Hessian is given in lower triangular form: αij, i=1 to
     N, j=1 to i. The dipole moment, polarizability, and dipole derivatives can be
     zero if none are available.
+
+    ``hessian`` can be a :class:`garleek.hessian.PackedHessian` or a flat
+    array with the packed lower triangle.
+
+    Each section is formatted in blocks of rows with a single ``%`` operation
+    and written as it goes, so the whole file is never held in memory.
     """
-    lines = [[energy] + list(dipole_moment)]
-    template = '{: 20.12e}'
+    _write_EOu_rows(f, [energy] + list(dipole_moment), per_row=4)
     if gradients is not None:
-        for gradient in gradients:
-            lines.append(gradient)
+        _write_EOu_rows(f, gradients)
     if hessian is not None:
         if polarizability is None:
             polarizability = np.zeros(6)
         if dipole_polarizability is None:
             dipole_polarizability = np.zeros(9*n_atoms)
-        for i in range(0, polarizability.size, 3):
-            lines.append(polarizability[i:i+3])
-        for i in range(0, dipole_polarizability.size, 3):
-            lines.append(dipole_polarizability[i:i+3])
-
-        for i in range(0, hessian.size, 3):
-            lines.append(hessian[i:i+3])
-    lines.append([])  # Gaussian is very peculiar about blank lines
-    return '\n'.join([(template*len(line)).format(*line) for line in lines])
+        _write_EOu_rows(f, polarizability)
+        _write_EOu_rows(f, dipole_polarizability)
+        _write_EOu_rows(f, hessian)  # packed data, no copies
+
+
+def prepare_gaussian_EOu(n_atoms, energy, dipole_moment, gradients=None, hessian=None,
+                         polarizability=None, dipole_polarizability=None):
+    """
+    Generate the contents of the ``*.EOu`` file Gaussian expects after
+    ``external`` launch. See :func:`write_gaussian_EOu`, which should be
+    preferred to write big files.
+    """
+    f = StringIO()
+    write_gaussian_EOu(f, n_atoms, energy, dipole_moment, gradients=gradients,
+                       hessian=hessian, polarizability=polarizability,
+                       dipole_polarizability=dipole_polarizability)
+    return f.getvalue()
+
+
+def _write_EOu_rows(f, values, per_row=3, rows_per_block=4096):
+    """
+    Write ``values`` to ``f`` as ``D20.12`` fields, ``per_row`` per line.
+    The last line can be shorter. Every line ends with a newline, so the
+    file ends with the blank line Gaussian wants.
+    """
+    values = np.asarray(values, dtype=float).ravel()
+    field = '% 20.12e'
+    n_full = values.size - values.size % per_row
+    block = per_row * rows_per_block
+    template = (field * per_row + '\n') * rows_per_block
+    for start in range(0, n_full, block):
+        chunk = values[start:min(start + block, n_full)]
+        if chunk.size < block:
+            template = (field * per_row + '\n') * (chunk.size // per_row)
+        f.write(template % tuple(chunk.tolist()))
+    if n_full < values.size:
+        rest = values[n_full:]
+        f.write(field * rest.size % tuple(rest.tolist()) + '\n')
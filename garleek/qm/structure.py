@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+qm.structure.py
+===============
+
+Columnar, array-backed containers for the ``atoms`` and ``bonds``
+entries of the standardized object described in :mod:`garleek.qm`.
+
+Data is stored in contiguous NumPy arrays (one per property, plus a
+CSR-like layout for the connectivity), which is what the MM side needs
+to work in bulk. Both classes are also read-only mappings that follow
+the documented dict convention (``atoms[index]['xyz']``,
+``bonds[index] -> [(bonded_to, order), ...]``), so code written for
+plain dictionaries keeps working. Indices are 1-based in both cases.
+"""
+
+from __future__ import print_function, absolute_import, division
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+import numpy as np
+
+
+class Atoms(Mapping):
+
+    """
+    Atoms of a structure, stored column by column.
+
+    Parameters
+    ----------
+    elements : sequence of str
+        Chemical element of each atom
+    types : sequence of str
+        Atom type as expected by the MM part. Empty strings stand
+        for undefined types (reported as None by the mapping interface)
+    xyz : np.array with shape (n_atoms, 3)
+        Cartesian coordinates
+    charges : np.array with shape (n_atoms,)
+        Atom point charges for the MM part
+    """
+
+    def __init__(self, elements, types, xyz, charges):
+        self.elements = np.asarray(elements, dtype=str)
+        self.types = np.asarray(types, dtype=str)
+        self.xyz = np.ascontiguousarray(xyz, dtype=float).reshape(-1, 3)
+        self.charges = np.ascontiguousarray(charges, dtype=float)
+        n_atoms = self.xyz.shape[0]
+        if not (self.elements.shape == self.types.shape == self.charges.shape == (n_atoms,)):
+            raise ValueError('All atom properties must have the same length')
+
+    @classmethod
+    def from_dict(cls, atoms):
+        """
+        Build columnar atoms from a mapping of atom dicts, as documented
+        in :mod:`garleek.qm`. Indices are assumed to be sequential.
+        Missing elements and charges default to empty strings and zeros.
+        """
+        if isinstance(atoms, cls):
+            return atoms
+        values = list(atoms.values())
+        return cls([a.get('element', '') for a in values],
+                   [a['type'] or '' for a in values],
+                   np.array([a['xyz'] for a in values]).reshape(-1, 3),
+                   [a.get('charge', 0.0) for a in values])
+
+    def __len__(self):
+        return self.xyz.shape[0]
+
+    def __iter__(self):
+        return iter(range(1, len(self) + 1))
+
+    def __contains__(self, index):
+        return isinstance(index, (int, np.integer)) and 1 <= index <= len(self)
+
+    def __getitem__(self, index):
+        if index not in self:
+            raise KeyError(index)
+        i = index - 1
+        return {'element': str(self.elements[i]),
+                'type': str(self.types[i]) or None,
+                'xyz': self.xyz[i],
+                'charge': float(self.charges[i])}
+
+    def __repr__(self):
+        return '<{} with {} atoms>'.format(self.__class__.__name__, len(self))
+
+
+class Bonds(Mapping):
+
+    """
+    Connectivity of a structure, in compressed sparse row layout: the
+    atoms bonded to atom ``i`` are ``neighbors[indptr[i-1]:indptr[i]]``,
+    with bond orders ``orders[indptr[i-1]:indptr[i]]``.
+
+    Parameters
+    ----------
+    indptr : np.array with shape (n_atoms+1,)
+        Row pointers. An empty connectivity is a single ``[0]``.
+    neighbors : np.array of int
+        1-based indices of bonded atoms
+    orders : np.array of float
+        Bond orders
+    """
+
+    def __init__(self, indptr, neighbors, orders):
+        self.indptr = np.asarray(indptr, dtype=int)
+        self.neighbors = np.asarray(neighbors, dtype=int)
+        self.orders = np.asarray(orders, dtype=float)
+        if self.neighbors.shape != self.orders.shape or self.indptr[-1] != self.neighbors.size:
+            raise ValueError('Inconsistent CSR connectivity arrays')
+
+    @classmethod
+    def from_pairs(cls, n_atoms, atoms, neighbors, orders):
+        """
+        Build the CSR arrays from (unsorted) ``atom -> neighbor`` pairs,
+        keeping the original order of the pairs of each atom.
+        """
+        atoms = np.asarray(atoms, dtype=int)
+        order = np.argsort(atoms, kind='mergesort')
+        indptr = np.zeros(n_atoms + 1, dtype=int)
+        np.cumsum(np.bincount(atoms - 1, minlength=n_atoms), out=indptr[1:])
+        return cls(indptr, np.asarray(neighbors, dtype=int)[order],
+                   np.asarray(orders, dtype=float)[order])
+
+    @classmethod
+    def from_dict(cls, bonds, n_atoms=None):
+        """
+        Build CSR bonds from a mapping of lists of ``(bonded_to, order)``
+        tuples, as documented in :mod:`garleek.qm`.
+        """
+        if isinstance(bonds, cls):
+            return bonds
+        if n_atoms is None:
+            n_atoms = max(bonds) if bonds else 0
+        pairs = [(i, j, order) for i, bonded in bonds.items() for (j, order) in bonded]
+        atoms, neighbors, orders = zip(*pairs) if pairs else ((), (), ())
+        return cls.from_pairs(n_atoms, atoms, neighbors, orders)
+
+    def atoms(self):
+        """
+        1-based index of the first atom of each stored bond, aligned
+        with ``neighbors`` and ``orders``.
+        """
+        return np.repeat(np.arange(1, len(self) + 1), np.diff(self.indptr))
+
+    def __len__(self):
+        return self.indptr.size - 1
+
+    def __iter__(self):
+        return iter(range(1, len(self) + 1))
+
+    def __contains__(self, index):
+        return isinstance(index, (int, np.integer)) and 1 <= index <= len(self)
+
+    def __getitem__(self, index):
+        if index not in self:
+            raise KeyError(index)
+        start, end = self.indptr[index-1], self.indptr[index]
+        return list(zip(self.neighbors[start:end].tolist(), self.orders[start:end].tolist()))
+
+    def __repr__(self):
+        return '<{} with {} bonds>'.format(self.__class__.__name__, self.neighbors.size)
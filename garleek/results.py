@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+results.py
+==========
+
+On-disk cache of MM results, keyed by geometry.
+
+QM engines often ask for the same MM evaluation more than once: restarts,
+a frequency calculation at the last geometry of an optimization, or the
+same point requested first with gradients and then with the Hessian.
+Results are stored in the ``results`` namespace of the Garleek cache (see
+:mod:`garleek.cache`), in files named after a digest of the coordinates
+(rounded to ``RESOLUTION`` bohr), atom types, connectivity and the
+forcefield, together with the highest derivative level computed for them.
+A request is served from the cache if the stored level is at least the
+requested one; extra derivatives are dropped from the returned results.
+
+The cache is bounded to ``$GARLEEK_RESULTS_CACHE_SIZE`` megabytes (256 by
+default; 0 disables it). When a new entry makes it exceed that size, the
+least recently used entries are removed; entries larger than the whole
+cache are not stored at all. Writers (and eviction) hold an exclusive
+``flock`` on a lock file, so concurrent jobs can share the cache; entries
+are renamed into place, so readers do not need that lock. Hit and miss
+counters are kept in ``stats.json``, updated under a separate lock that is
+only held for the increment, so lookups never wait for writers.
+"""
+
+from __future__ import print_function, absolute_import, division
+import json
+import os
+import zipfile
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+import numpy as np
+from .cache import atomic_write, cache_dir, digest
+from .hessian import PackedHessian
+from .qm.structure import Atoms, Bonds
+
+#: Coordinates are rounded to this many bohr before hashing
+RESOLUTION = 1e-8
+DEFAULT_SIZE_MB = 256
+# Bump when the stored layout changes
+_FORMAT = 1
+_NAMESPACE = 'results'
+
+
+def max_size():
+    """
+    Maximum size of the cache in bytes, from ``$GARLEEK_RESULTS_CACHE_SIZE``
+    (megabytes). 0 means disabled.
+    """
+    value = os.environ.get('GARLEEK_RESULTS_CACHE_SIZE')
+    try:
+        megabytes = float(value) if value else DEFAULT_SIZE_MB
+    except ValueError:
+        megabytes = DEFAULT_SIZE_MB
+    return int(max(megabytes, 0) * 1024 * 1024)
+
+
+def geometry_key(atoms, bonds, forcefield, resolution=RESOLUTION):
+    """
+    Digest identifying an MM evaluation.
+
+    Parameters
+    ----------
+    atoms : garleek.qm.structure.Atoms or OrderedDict
+        Atoms, as described in :mod:`garleek.qm`. Coordinates in bohr.
+    bonds : garleek.qm.structure.Bonds or OrderedDict
+        Connectivity, as described in :mod:`garleek.qm`.
+    forcefield : str
+        Digest of everything else that determines the results: forcefield
+        and key contents, MM version...
+    resolution : float, optional
+        Coordinates closer than this (bohr) are considered the same.
+    """
+    atoms = Atoms.from_dict(atoms)
+    bonds = Bonds.from_dict(bonds or {}, n_atoms=len(atoms))
+    grid = np.round(atoms.xyz / resolution).astype(np.int64)
+    types = '\n'.join(np.char.strip(atoms.types).tolist())
+    return digest(_FORMAT, forcefield, resolution, types, grid.tobytes(),
+                  bonds.indptr.astype(np.int64).tobytes(),
+                  bonds.neighbors.astype(np.int64).tobytes(),
+                  bonds.orders.astype(np.float64).tobytes())
+
+
+def _entry(key):
+    return os.path.join(cache_dir(_NAMESPACE), key + '.npz')
+
+
+def _directory():
+    """
+    Directory of the cache, created if needed.
+    """
+    directory = cache_dir(_NAMESPACE)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    return directory
+
+
+@contextmanager
+def _flock(name):
+    """
+    Exclusive lock on the file ``name`` of the cache while the block runs
+    (a no-op where ``fcntl`` is not available). Yields the cache directory.
+    """
+    directory = _directory()
+    with open(os.path.join(directory, name), 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield directory
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _locked():
+    """
+    Exclusive lock on the cache entries, held by writers and eviction.
+    """
+    return _flock('.lock')
+
+
+def _count(field):
+    """
+    Increment a counter of ``stats.json``. The read-modify-write holds its
+    own lock, not the one of the entries, so it is short and never lost.
+    """
+    try:
+        with _flock('.stats.lock') as directory:
+            stats = statistics()
+            stats[field] += 1
+            atomic_write(os.path.join(directory, 'stats.json'), json.dumps(stats))
+    except (IOError, OSError):
+        pass
+
+
+def statistics():
+    """
+    Dict with the number of ``hits`` and ``misses`` recorded in the cache.
+    """
+    stats = {'hits': 0, 'misses': 0}
+    try:
+        with open(os.path.join(cache_dir(_NAMESPACE), 'stats.json')) as f:
+            stats.update(json.load(f))
+    except (IOError, OSError, ValueError):
+        pass
+    return stats
+
+
+def load(key, derivatives):
+    """
+    Results stored for ``key`` with at least ``derivatives`` (0: energy
+    and dipole, 1: gradients, 2: Hessian), or None. The hit or miss is
+    recorded in the statistics.
+
+    Returns
+    -------
+    results : dict or None
+        ``energy``, ``dipole_moment`` and, depending on ``derivatives``,
+        ``gradients`` and ``hessian`` (a :class:`garleek.hessian.PackedHessian`).
+    """
+    if not max_size():
+        return None
+    path = _entry(key)
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['derivatives']) < derivatives:
+                raise KeyError(key)
+            results = {'energy': float(data['energy']),
+                       'dipole_moment': data['dipole_moment']}
+            if derivatives > 0:
+                results['gradients'] = data['gradients']
+            if derivatives > 1:
+                results['hessian'] = PackedHessian(results['gradients'].size,
+                                                   data=data['hessian'])
+    except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+        _count('misses')
+        return None
+    try:
+        os.utime(path, None)  # most recently used
+    except OSError:  # evicted meanwhile
+        pass
+    _count('hits')
+    return results
+
+
+def store(key, derivatives, results):
+    """
+    Store ``results`` (as returned by :func:`load`) for ``key``, unless
+    an entry with the same or more derivatives exists, and evict the least
+    recently used entries if the cache grew too large. Entries that would
+    not fit in the cache on their own are skipped. Errors writing to the
+    cache are ignored.
+    """
+    limit = max_size()
+    if not limit:
+        return
+    path = _entry(key)
+    arrays = {'derivatives': derivatives, 'energy': results['energy'],
+              'dipole_moment': np.asarray(results['dipole_moment'], dtype=float)}
+    if derivatives > 0:
+        arrays['gradients'] = np.asarray(results['gradients'], dtype=float)
+    if derivatives > 1:
+        arrays['hessian'] = np.asarray(results['hessian'], dtype=float)
+    if sum(np.asarray(value).nbytes for value in arrays.values()) > limit:
+        return
+    try:
+        with _locked() as directory:
+            try:
+                with np.load(path, allow_pickle=False) as data:
+                    if int(data['derivatives']) >= derivatives:
+                        return
+            except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+                pass
+            with NamedTemporaryFile(dir=directory, prefix='.tmp-', suffix='.npz',
+                                    delete=False) as f:
+                tmp = f.name
+                np.savez(f, **arrays)
+            if os.path.getsize(tmp) > limit:  # the headers tipped it over
+                os.remove(tmp)
+                return
+            os.rename(tmp, path)
+            _evict(directory, limit, keep=os.path.basename(path))
+    except (IOError, OSError):
+        return
+
+
+def _evict(directory, limit, keep=None):
+    """
+    Remove the least recently used entries, other than ``keep``, until the
+    cache fits in ``limit`` bytes. Must be called with the lock held.
+    """
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith('.npz') and not name.startswith('.'):
+            stat = os.stat(os.path.join(directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for (_, size, _) in entries)
+    for _, size, name in sorted(entries):
+        if total <= limit:
+            break
+        if name == keep:
+            continue
+        os.remove(os.path.join(directory, name))
+        total -= size
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+scratch.py
+==========
+
+Per-job scratch directories for the temporary files of the MM step
+(TINKER XYZ and Hessian files, keys that cannot be cached...).
+
+Every step gets its own directory, so jobs sharing a working directory
+never race on the same files. Directories are created in
+``$GARLEEK_SCRATCH_DIR`` or, by default, in ``scratch`` inside
+:func:`garleek.staging.node_local_dir` (``/dev/shm`` when available), and
+named ``<host>.<pid>.<job>.<random>``. They are removed when the step
+finishes, unless ``$GARLEEK_KEEP_SCRATCH`` is set (or ``keep`` is passed),
+which is useful to inspect what was sent to the MM engine. Directories
+left behind by processes that died on this host are removed the next time
+a scratch directory is created; kept ones are marked and never removed.
+Only directories owned by the current user are removed, and only from
+roots that nobody else can write to.
+"""
+
+from __future__ import print_function, absolute_import, division
+import errno
+import os
+import re
+import shutil
+import socket
+import stat
+import tempfile
+from contextlib import contextmanager
+from .cache import private_dir
+from .staging import node_local_dir
+
+_KEEP_MARKER = '.keep'
+
+
+def scratch_root():
+    """
+    Directory where job scratch directories are created. Not created here.
+    """
+    return os.environ.get('GARLEEK_SCRATCH_DIR') or os.path.join(node_local_dir(), 'scratch')
+
+
+def _host():
+    return re.sub(r'[^\w\-]', '_', socket.gethostname().split('.')[0]) or 'localhost'
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _owned(path, writable_by_others=False):
+    """
+    Whether ``path`` is a directory (not a symbolic link) of the current
+    user that, unless ``writable_by_others``, only the user can write to.
+    """
+    if not hasattr(os, 'getuid'):  # Windows: no owners nor modes to check
+        return os.path.isdir(path)
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid()
+            and (writable_by_others or not st.st_mode & 0o022))
+
+
+def sweep(root=None):
+    """
+    Remove the scratch directories of dead processes of this host,
+    except those marked to be kept. Nothing is removed unless ``root``
+    belongs to the current user and only the user can write to it, and
+    then only directories owned by the user.
+    """
+    root = root or scratch_root()
+    prefix = _host() + '.'
+    if not _owned(os.path.realpath(root)):
+        return
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(prefix):
+            continue
+        try:
+            pid = int(name[len(prefix):].split('.', 1)[0])
+        except ValueError:
+            continue
+        path = os.path.join(root, name)
+        if pid != os.getpid() and not _alive(pid) and _owned(path, True) \
+                and not os.path.exists(os.path.join(path, _KEEP_MARKER)):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def job_scratch(job='garleek', keep=None):
+    """
+    Context manager creating a new scratch directory for ``job``
+    (usually the name of the QM input file for the step) and yielding
+    its absolute path. It is removed on exit, unless ``keep`` is true (it
+    defaults to ``$GARLEEK_KEEP_SCRATCH``).
+
+    The default root is created with mode 0700 and must belong to the
+    current user; ``$GARLEEK_SCRATCH_DIR`` is created with mode 0700 if
+    it does not exist.
+    """
+    if keep is None:
+        keep = bool(os.environ.get('GARLEEK_KEEP_SCRATCH'))
+    root = scratch_root()
+    if os.environ.get('GARLEEK_SCRATCH_DIR'):
+        if not os.path.isdir(root):
+            try:
+                os.makedirs(root, 0o700)
+            except OSError:
+                if not os.path.isdir(root):
+                    raise
+    elif not private_dir(root):
+        raise OSError(errno.EACCES, 'Scratch directory is not private', root)
+    sweep(root)
+    job = re.sub(r'[^\w\-]', '_', job or 'garleek')
+    prefix = '{}.{}.{}.'.format(_host(), os.getpid(), job)
+    path = os.path.abspath(tempfile.mkdtemp(prefix=prefix, dir=root))
+    try:
+        yield path
+    finally:
+        if keep:
+            open(os.path.join(path, _KEEP_MARKER), 'w').close()
+            print('Scratch files kept in', path)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+server.py
+=========
+
+Opt-in persistent ``garleek-backend`` server.
+
+Every ONIOM step makes the QM engine spawn a fresh ``garleek-backend``
+process, which has to import NumPy and Garleek, resolve the MM executables
+and prepare the force field before any MM work starts. When the backend
+is called with ``--server``, it becomes a thin client instead: the request
+(``qmargs`` and engine options) is forwarded through a Unix domain socket
+to a long-lived server process that keeps all that state warm, and the
+client just waits for the server to report the EOu file is written.
+
+The server is started on the first call and shuts itself down after
+``idle_timeout`` seconds without requests. One server is spawned per
+calculation (working directory, engines and forcefield), so requests are
+handled sequentially, exactly like the QM engine issues them. Before
+serving, it loads the forcefield and the MM engine (see :func:`warm_up`);
+module-level caches keep them, and the keys and topologies of each step,
+for its lifetime. If the server cannot be reached, or does not answer
+within ``response_timeout`` seconds (then it is terminated, so it cannot
+write a stale EOu file later), the client returns ``None`` and
+``garleek-backend`` falls back to the regular in-process path.
+
+Sockets live in a directory only the user can access (see
+:func:`runtime_dir`), next to the PID file written by the client that
+spawned the server and the server log, which collects the standard
+output and error streams of the server and of the MM programs it runs.
+Where the platform reports the credentials of the other end of a Unix
+socket (``SO_PEERCRED``), both sides also check it belongs to the same
+user. A client only terminates the server recorded in the PID file.
+
+Protocol
+--------
+
+Client and server exchange JSON documents, each one terminated by a
+newline. The request contains the working directory, the environment
+and the keyword arguments for :func:`garleek.cli.backend_app` (or
+``shutdown``). The
+server acknowledges it with its process ID before running it, and then
+sends the response: the return code and the captured standard output and
+error streams, which the client replays so they end up in the QM engine
+log as usual.
+"""
+
+from __future__ import print_function, absolute_import, division
+import errno
+import hashlib
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from io import StringIO
+from .cache import private_dir
+
+
+DEFAULT_IDLE_TIMEOUT = 600  # seconds
+DEFAULT_RESPONSE_TIMEOUT = 3600  # seconds
+STARTUP_TIMEOUT = 10  # seconds
+
+
+def runtime_dir():
+    """
+    Directory for the sockets, PID files and logs of the servers of the
+    current user: ``garleek`` in ``$XDG_RUNTIME_DIR`` or ``garleek-<uid>``
+    in the temporary directory, with mode 0700. None if it cannot be
+    created or belongs to someone else (see :func:`garleek.cache.private_dir`).
+    """
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        path = os.path.join(os.environ['XDG_RUNTIME_DIR'], 'garleek')
+    else:
+        path = os.path.join(tempfile.gettempdir(), 'garleek-{}'.format(os.getuid()))
+    return path if private_dir(path) else None
+
+
+def socket_path(cwd, qm, mm, ff):
+    """
+    Path to the Unix socket serving calculations run in ``cwd`` with
+    the given engines and forcefield, in :func:`runtime_dir`. It can be
+    overriden with the ``GARLEEK_SOCKET`` environment variable, but the
+    directory must be private all the same. None if it is not.
+    """
+    if os.environ.get('GARLEEK_SOCKET'):
+        path = os.path.abspath(os.environ['GARLEEK_SOCKET'])
+        return path if private_dir(os.path.dirname(path)) else None
+    directory = runtime_dir()
+    if directory is None:
+        return None
+    # Unix socket paths are limited to ~100 chars; use a short digest
+    digest = hashlib.sha1('\0'.join([os.path.abspath(cwd), str(qm), str(mm), str(ff)])
+                          .encode('utf-8')).hexdigest()[:16]
+    return os.path.join(directory, digest + '.sock')
+
+
+def _sibling(path, suffix):
+    """
+    PID file (``.pid``) or log (``.log``) of the server on socket ``path``.
+    """
+    return os.path.splitext(path)[0] + suffix
+
+
+def _peer(sock):
+    """
+    Process and user IDs of the other end of Unix socket ``sock``, as
+    reported by the kernel. None if the platform does not report them.
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    size = struct.calcsize('3i')
+    pid, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET,
+                                                      socket.SO_PEERCRED, size))
+    return pid, uid
+
+
+def _same_user(sock):
+    """
+    Whether the other end of ``sock`` runs as the current user. Where
+    the platform cannot tell, the private directory of the socket is
+    the only safeguard.
+    """
+    peer = _peer(sock)
+    return peer is None or peer[1] == os.getuid()
+
+
+def _send(sock, payload):
+    sock.sendall(json.dumps(payload).encode('utf-8') + b'\n')
+
+
+def _receive(stream):
+    """
+    Next document from ``stream``, a file object of the socket (reads
+    are bound by the socket timeout).
+    """
+    line = stream.readline()
+    if not line.endswith(b'\n'):
+        raise EOFError('Connection closed without response')
+    return json.loads(line.decode('utf-8'))
+
+
+###
+# CLIENT
+###
+
+
+def _connect(path, timeout=STARTUP_TIMEOUT):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        if not _same_user(sock):
+            raise socket.error(errno.EACCES, 'Server run by another user')
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def spawn_server(path, idle_timeout=DEFAULT_IDLE_TIMEOUT, ff=None, mm=None):
+    """
+    Launch a detached server listening on ``path``, warmed up for
+    forcefield ``ff`` and MM engine ``mm``, and wait until it accepts
+    connections. Returns True if it did within ``STARTUP_TIMEOUT``.
+
+    Its process ID is written to the PID file next to the socket, and its
+    output streams are appended to the log there.
+    """
+    command = [sys.executable, '-m', 'garleek.server', '--socket', path,
+               '--idle-timeout', str(idle_timeout)]
+    if ff:
+        command += ['--ff', ff, '--mm', mm or 'tinker']
+    with open(os.devnull, 'r') as devnull, open(_sibling(path, '.log'), 'ab') as log:
+        process = subprocess.Popen(command, stdin=devnull, stdout=log, stderr=log,
+                                   close_fds=True, preexec_fn=getattr(os, 'setsid', None))
+    with open(_sibling(path, '.pid'), 'w') as f:
+        f.write(str(process.pid))
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        try:
+            _connect(path, timeout=1).close()
+            return True
+        except socket.error:
+            time.sleep(0.05)
+    return False
+
+
+def request(cwd=None, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+            response_timeout=DEFAULT_RESPONSE_TIMEOUT, **kwargs):
+    """
+    Forward a ``garleek-backend`` call to the persistent server, starting it
+    if needed.
+
+    Parameters
+    ----------
+    cwd : str, optional
+        Directory the calculation runs in. Defaults to the current one.
+    idle_timeout : int, optional=DEFAULT_IDLE_TIMEOUT
+        Seconds without requests before a newly spawned server exits.
+    response_timeout : float, optional=DEFAULT_RESPONSE_TIMEOUT
+        Seconds to wait for the server to finish the calculation. When
+        they expire, the server is terminated if it is the one recorded in
+        the PID file.
+    kwargs :
+        Keyword arguments for :func:`garleek.cli.backend_app`.
+
+    Returns
+    -------
+    response : dict or None
+        Server response, with ``returncode``, ``stdout`` and ``stderr``
+        keys. None if the server could not be reached or timed out.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    cwd = os.path.abspath(cwd or os.getcwd())
+    path = socket_path(cwd, kwargs.get('qm'), kwargs.get('mm'), kwargs.get('ff'))
+    if path is None:
+        return None
+    try:
+        sock = _connect(path)
+    except socket.error:
+        if not spawn_server(path, idle_timeout=idle_timeout, ff=kwargs.get('ff'),
+                            mm=kwargs.get('mm')):
+            return None
+        try:
+            sock = _connect(path)
+        except socket.error:
+            return None
+    stream = sock.makefile('rb')
+    peer = _peer(sock)
+    pid = None
+    try:
+        _send(sock, {'cwd': cwd, 'env': dict(os.environ), 'kwargs': kwargs})
+        pid = _receive(stream)['pid']
+        if peer is not None:  # the kernel knows better
+            pid = peer[0]
+        sock.settimeout(response_timeout)
+        return _receive(stream)
+    except socket.timeout:
+        if pid is not None:  # busy for too long, maybe hung
+            _terminate(path, pid)
+        return None
+    except (socket.error, EOFError, ValueError, KeyError):
+        return None
+    finally:
+        stream.close()
+        sock.close()
+
+
+def shutdown(path):
+    """
+    Ask the server listening on ``path`` to exit once the current request
+    is done. Returns True if a server answered.
+    """
+    try:
+        sock = _connect(path)
+    except socket.error:
+        return False
+    stream = sock.makefile('rb')
+    try:
+        _send(sock, {'shutdown': True})
+        _receive(stream)
+        return True
+    except (socket.error, EOFError, ValueError):
+        return False
+    finally:
+        stream.close()
+        sock.close()
+
+
+def _recorded_pid(path):
+    """
+    Process ID in the PID file of the server on socket ``path``, or None.
+    """
+    try:
+        with open(_sibling(path, '.pid')) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _terminate(path, pid):
+    """
+    Terminate the server on socket ``path`` with process ID ``pid``, only
+    if a client spawned it (so it is in the PID file).
+    """
+    if pid != _recorded_pid(path):
+        return
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:  # already gone
+        pass
+
+
+###
+# SERVER
+###
+
+
+def _handle(payload):
+    """
+    Run one backend call in the server process, capturing its output.
+    """
+    from .cli import backend_app_run
+
+    stdout, stderr = StringIO(), StringIO()
+    old_cwd, old_stdout, old_stderr = os.getcwd(), sys.stdout, sys.stderr
+    old_environ = dict(os.environ)
+    returncode = 0
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        if payload.get('env') is not None:  # that of the client, not the first one
+            os.environ.clear()
+            os.environ.update(payload['env'])
+        os.chdir(payload['cwd'])
+        backend_app_run(**payload['kwargs'])
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            returncode = e.code
+        elif e.code is not None:
+            print(e.code, file=stderr)
+            returncode = 1
+    except Exception:
+        traceback.print_exc(file=stderr)
+        returncode = 1
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+        os.chdir(old_cwd)
+        os.environ.clear()
+        os.environ.update(old_environ)
+    return {'returncode': returncode, 'stdout': stdout.getvalue(),
+            'stderr': stderr.getvalue()}
+
+
+def _bind(path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+    except socket.error as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+        # Stale socket file? If nobody answers, take over (but only sockets)
+        try:
+            _connect(path, timeout=1).close()
+        except socket.error:
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                server.close()
+                raise
+            os.remove(path)
+            server.bind(path)
+        else:
+            server.close()
+            raise
+    server.listen(8)
+    return server
+
+
+def warm_up(ff=None, mm='tinker'):
+    """
+    Load everything the requests for forcefield ``ff`` and MM engine ``mm``
+    need, so not even the first one pays for it: the connectors (NumPy
+    and the parsers), the compiled forcefield database, its point-charge
+    model and, depending on the engine, the TINKER executables, the class
+    I forcefield terms or OpenMM. Failures are left for the requests to
+    report.
+    """
+    from . import connectors  # noqa
+    if not ff:
+        return
+    from .cli import _extant_file_prm, _parse_engine_string
+    from .mm import numpyff, openmm, prm, tinker
+    engine = _parse_engine_string(mm or 'tinker')[0]
+    try:
+        path = _extant_file_prm(ff, abspath=True)
+        prm.fixed_charge_model(path)
+        if engine == 'tinker':
+            for program in ('analyze', 'testgrad', 'testhess'):
+                tinker.tinker_executable(program)
+        elif engine in ('numpyff', 'openmm'):
+            numpyff.read_forcefield(path)
+            if engine == 'openmm':
+                openmm._import_openmm()
+    except Exception:
+        pass
+
+
+def serve(path, idle_timeout=DEFAULT_IDLE_TIMEOUT, ff=None, mm=None):
+    """
+    Serve ``garleek-backend`` requests on Unix socket ``path`` until
+    no request has been received for ``idle_timeout`` seconds, or a
+    ``shutdown`` request is received. See :func:`warm_up` for ``ff`` and
+    ``mm``. Connections from other users are rejected.
+    """
+    if not private_dir(os.path.dirname(os.path.abspath(path))):
+        raise OSError(errno.EACCES, 'Socket directory is not private', path)
+    server = _bind(path)
+    # Clients can already connect; they wait in the backlog meanwhile
+    warm_up(ff, mm)
+    server.settimeout(idle_timeout)
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            if not _same_user(conn):
+                print('Rejected connection from another user', file=sys.stderr)
+                conn.close()
+                continue
+            stream = conn.makefile('rb')
+            try:
+                conn.settimeout(STARTUP_TIMEOUT)
+                payload = _receive(stream)
+                # If the client gave up waiting, this fails and the request is dropped
+                _send(conn, {'pid': os.getpid()})
+                if payload.get('shutdown'):
+                    break
+                conn.settimeout(None)
+                _send(conn, _handle(payload))
+            except (socket.error, EOFError, ValueError) as e:
+                print('Dropped request: {}'.format(e), file=sys.stderr)
+            finally:
+                stream.close()
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+        if _recorded_pid(path) == os.getpid():
+            os.remove(_sibling(path, '.pid'))
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    p = ArgumentParser(description='Persistent garleek-backend server. Started '
+                                   'automatically by `garleek-backend --server`.')
+    p.add_argument('--socket', required=True, help='Unix socket path to listen on')
+    p.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                   help='Seconds without requests before shutting down')
+    p.add_argument('--ff', default=None, help='Forcefield to load before serving')
+    p.add_argument('--mm', default='tinker', help='MM engine to load before serving')
+    args = p.parse_args(argv)
+    serve(args.socket, idle_timeout=args.idle_timeout, ff=args.ff, mm=args.mm)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+staging.py
+==========
+
+Node-local copies of the files TINKER reads on every step.
+
+When forcefields live on a network filesystem, every TINKER program
+launched on every step reads them over the network. :func:`stage_file`
+copies a file once into a node-local directory (``$GARLEEK_STAGE_DIR``,
+or ``/dev/shm/garleek-<user>`` if available, or the temporary directory)
+and returns the path of the copy, which is named after the digest of its
+contents. A small sidecar file records the size, modification time and
+inode of the source together with that digest, so later calls only
+``stat`` the source: it is hashed (and copied) again only if it changed.
+
+The default directory has a predictable name in a world-writable place,
+so it is only used if it is private to the user (see
+:func:`garleek.cache.private_dir`); otherwise files are staged in a new
+private directory for the rest of the process.
+"""
+
+from __future__ import print_function, absolute_import, division
+import getpass
+import json
+import os
+import tempfile
+from .cache import atomic_write, digest, private_dir
+
+# Private directories used instead of squatted ones, by base
+_fallback = {}
+
+
+def node_local_dir(base=None):
+    """
+    Per-user directory in node-local storage: ``garleek-<user>`` in
+    ``base``, which defaults to ``/dev/shm`` if it is writable, else the
+    temporary directory.
+
+    The directory is created with mode 0700. If it exists but belongs to
+    someone else (or is not a directory), a new private directory made
+    with :func:`tempfile.mkdtemp` in ``base`` is returned instead, and
+    reused by later calls of the same process.
+    """
+    try:
+        user = getpass.getuser()
+    except Exception:  # no user name for this uid
+        user = str(os.getuid())
+    if base is None:
+        base = '/dev/shm'
+        if not (os.path.isdir(base) and os.access(base, os.W_OK)):
+            base = tempfile.gettempdir()
+    path = os.path.join(base, 'garleek-' + user)
+    if private_dir(path):
+        return path
+    if base not in _fallback:
+        _fallback[base] = tempfile.mkdtemp(prefix='garleek-{}-'.format(user), dir=base)
+    return _fallback[base]
+
+
+def stage_dir():
+    """
+    Directory holding staged files: ``$GARLEEK_STAGE_DIR`` (not created
+    here) or :func:`node_local_dir`.
+    """
+    return os.environ.get('GARLEEK_STAGE_DIR') or node_local_dir()
+
+
+def stage_file(path):
+    """
+    Path to an up-to-date, node-local copy of ``path``.
+
+    Returns ``path`` itself (made absolute) if the copy cannot be written.
+    """
+    path = os.path.abspath(path)
+    directory = os.path.abspath(stage_dir())
+    if os.path.dirname(path) == directory:  # already staged
+        return path
+    sidecar = os.path.join(directory, digest(path) + '.json')
+    try:
+        stat = os.stat(path)
+        fingerprint = [stat.st_size, stat.st_mtime, stat.st_ino]
+        try:
+            with open(sidecar) as f:
+                index = json.load(f)
+            staged = os.path.join(directory, index['staged'])
+            if index['source'] == fingerprint and os.path.getsize(staged) == stat.st_size:
+                return staged
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        with open(path, 'rb') as f:
+            contents = f.read()
+        name = '{}-{}'.format(digest(contents), os.path.basename(path))
+        staged = os.path.join(directory, name)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        if not os.path.isfile(staged):
+            atomic_write(staged, contents)
+        atomic_write(sidecar, json.dumps({'source': fingerprint, 'staged': name}))
+        return staged
+    except (IOError, OSError):
+        return path
@@ -34,3 +34,9 @@ KCALMOLEANGSTROMSQ_TO_HARTREEBOHRSQ = 1/HARTREEBOHRSQ_TO_KCALMOLEANGSTROMSQ
 # Dipole units conversion
 DEBYES_TO_EBOHR = 0.393430307
 EBOHR_TO_DEBYES = 1/DEBYES_TO_EBOHR
+EANGSTROM_TO_DEBYES = 4.80321  # same value used by TINKER
+
+# OpenMM units (kJ/mol and nm) conversion
+KJMOL_TO_KCALMOL = 1/4.184
+NM_TO_ANGSTROM = 10.0
+ANGSTROM_TO_NM = 1/NM_TO_ANGSTROM
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Compare the ``files`` and ``memory`` exchange modes of
+:func:`garleek.mm.tinker.run_tinker` for the Hessian step.
+
+    python tests/benchmarks/bench_exchange.py [n_atoms ...]
+
+TINKER is replaced by a script that writes a synthetic ``.hes`` file (see
+``bench_testhess.py``) in chunks, pausing between them to mimic the time
+``testhess`` spends computing. With ``files``, the Hessian is parsed
+after the program exits; with ``memory``, it is parsed from a named pipe
+while it is written. The script also reports how many bytes of Hessian
+data reached the scratch directory.
+"""
+
+from __future__ import print_function, division, absolute_import
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from garleek.mm import tinker
+from bench_testhess import write_hes
+
+WRITER = """#!{python}
+import sys, time
+with open({source!r}) as f:
+    data = f.read()
+chunk = len(data) // 20 + 1
+with open(sys.argv[1][:-4] + '.hes', 'w') as out:
+    for i in range(0, len(data), chunk):
+        time.sleep({pause})
+        out.write(data[i:i+chunk])
+"""
+
+
+def main(sizes, pause=0.02):
+    print('{:>8} {:>10} {:>12} {:>12}'.format('n_atoms', 'mode', 'time (s)', 'disk (MB)'))
+    for n_atoms in sizes:
+        tmp = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmp, 'source.hes')
+            write_hes(source, n_atoms)
+            script = os.path.join(tmp, 'testhess')
+            with open(script, 'w') as f:
+                f.write(WRITER.format(python=sys.executable, source=source, pause=pause))
+            os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+            tinker._executables['testhess'] = script
+            key = os.path.join(tmp, 'dummy.key')
+            open(key, 'w').close()
+            scratch = os.path.join(tmp, 'scratch')
+            os.mkdir(scratch)
+            for mode in ('files', 'memory'):
+                written = [0]
+                remove = os.remove
+
+                def measured_remove(path):
+                    if os.path.isfile(path) and not os.path.islink(path):
+                        written[0] += os.path.getsize(path)
+                    remove(path)
+
+                os.remove = measured_remove
+                try:
+                    t0 = time.time()
+                    tinker.run_tinker('', n_atoms, key, energy=False, dipole_moment=False,
+                                      gradients=False, hessian=True, scratch=scratch,
+                                      exchange=mode)
+                    elapsed = time.time() - t0
+                finally:
+                    os.remove = remove
+                print('{:8d} {:>10} {:12.3f} {:12.1f}'.format(n_atoms, mode, elapsed,
+                                                              written[0] / 1e6))
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [300, 1000])
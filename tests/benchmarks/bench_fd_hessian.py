@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""
+Measure finite-difference Hessians over process pools of several sizes.
+
+    python tests/benchmarks/bench_fd_hessian.py [n_atoms [processes ...]]
+
+N-methylacetamide with AMBER99SB types is replicated (see
+``bench_numpyff.py``) until it has at least ``n_atoms`` atoms (240 by
+default). Gradients come from :func:`garleek.mm.numpyff.run_numpyff`, so
+the timings show the overhead and scaling of
+:func:`garleek.hessian.finite_difference_hessian` rather than those of
+``testgrad``. The script reports the wall time with each pool size (1, 2
+and 4 processes by default) and the largest difference with the analytic
+Hessian (kcal/mol/A^2).
+"""
+
+from __future__ import print_function, division, absolute_import
+import sys
+from functools import partial
+import numpy as np
+from garleek import units as u
+from garleek.hessian import finite_difference_hessian
+from garleek.mm import numpyff
+from garleek.qm.structure import Atoms
+from bench_numpyff import PRM, replicate, timed
+
+
+def gradients(atoms, bonds, xyz):
+    atoms = Atoms(atoms.elements, atoms.types, xyz * u.ANGSTROM_TO_RBOHR, atoms.charges)
+    return numpyff.run_numpyff(atoms, bonds, PRM, energy=False, dipole_moment=False,
+                               gradients=True)['gradients']
+
+
+def main(size=240, pools=(1, 2, 4)):
+    atoms, bonds = replicate(size)
+    analytic, elapsed = timed(numpyff.run_numpyff, atoms, bonds, PRM, dipole_moment=False,
+                              hessian=True)
+    print('{:>8} {:>10} {:>10} {:>12}'.format('n_atoms', 'processes', 'time (s)', 'max |dH|'))
+    print('{:8d} {:>10} {:10.2f} {:>12}'.format(len(atoms), 'analytic', elapsed, ''))
+    xyz = atoms.xyz * u.RBOHR_TO_ANGSTROM
+    for processes in pools:
+        hessian, elapsed = timed(finite_difference_hessian, partial(gradients, atoms, bonds),
+                                 xyz, processes=processes)
+        print('{:8d} {:>10} {:10.2f} {:12.4e}'.format(
+              len(atoms), processes, elapsed,
+              np.abs(hessian.data - analytic['hessian'].data).max()))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(*(args[:1] + ([args[1:]] if args[1:] else [])))
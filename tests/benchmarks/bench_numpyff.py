@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Measure the NumPy class I evaluator against the TINKER programs.
+
+    python tests/benchmarks/bench_numpyff.py [n_atoms ...]
+
+N-methylacetamide with AMBER99SB types is replicated on a cubic grid
+(4 A apart) until it has at least each ``n_atoms`` atoms (120, 1200 and
+6000 by default). For each size, the script reports the wall time of an
+energy, a gradient and a Hessian evaluation with
+:func:`garleek.mm.numpyff.run_numpyff` (terms already assigned, as in every
+step but the first one) and, if TINKER is available, with ``analyze``,
+``testgrad`` and ``testhess``, along with the largest gradient difference
+(kcal/mol/A) between both. Hessians are skipped above 3000 atoms for
+TINKER, whose text output grows quadratically.
+"""
+
+from __future__ import print_function, division, absolute_import
+import os
+import sys
+import time
+import numpy as np
+from garleek import units as u
+from garleek.mm import numpyff, tinker
+from garleek.qm.structure import Atoms, Bonds
+
+here = os.path.abspath(os.path.dirname(__file__))
+PRM = os.path.join(here, '..', '..', 'garleek', 'data', 'prm', 'amber99sb.prm')
+SPACING = 4.0
+NMA_XYZ = [[0.00, 0.00, 0.00], [-0.36, 1.02, 0.05], [-0.38, -0.52, 0.88],
+           [-0.37, -0.50, -0.90], [1.52, 0.00, 0.00], [2.12, 1.06, 0.02],
+           [2.20, -1.16, -0.03], [1.70, -2.03, -0.05], [3.66, -1.24, 0.01],
+           [4.02, -2.27, 0.05], [4.05, -0.70, 0.88], [4.04, -0.73, -0.89]]
+NMA_TYPES = ['340', '341', '341', '341', '342', '343', '346', '347', '348', '349', '349', '349']
+NMA_BONDS = [(1, 2), (1, 3), (1, 4), (1, 5), (5, 6), (5, 7), (7, 8), (7, 9), (9, 10),
+             (9, 11), (9, 12)]
+
+
+def replicate(min_atoms):
+    xyz = np.array(NMA_XYZ)
+    n = len(xyz)
+    side = int(np.ceil((min_atoms / n) ** (1 / 3)))
+    size = np.ptp(xyz, axis=0) + SPACING
+    offsets = np.array([(i, j, k) for i in range(side) for j in range(side)
+                        for k in range(side)]) * size
+    copies = len(offsets)
+    all_xyz = (xyz[None] + offsets[:, None]).reshape(-1, 3) / u.RBOHR_TO_ANGSTROM
+    atoms = Atoms(['6'] * n * copies, NMA_TYPES * copies, all_xyz, np.zeros(n * copies))
+    first = np.array([i for (i, _) in NMA_BONDS] + [j for (_, j) in NMA_BONDS])
+    second = np.array([j for (_, j) in NMA_BONDS] + [i for (i, _) in NMA_BONDS])
+    shift = np.repeat(np.arange(copies) * n, len(first))
+    bonds = Bonds.from_pairs(n * copies, np.tile(first, copies) + shift,
+                             np.tile(second, copies) + shift, np.ones(shift.size))
+    return atoms, bonds
+
+
+def timed(function, *args, **kwargs):
+    t0 = time.time()
+    results = function(*args, **kwargs)
+    return results, time.time() - t0
+
+
+def main(sizes=(120, 1200, 6000)):
+    with_tinker = bool(tinker.tinker_executable('testgrad'))
+    if not with_tinker:
+        print('TINKER could not be found; timing numpyff only')
+    print('{:>8} {:>8} {:>10} {:>10} {:>10} {:>12}'.format(
+          'n_atoms', 'engine', 'energy (s)', 'grad (s)', 'hess (s)', 'max |dg|'))
+    for size in sizes:
+        atoms, bonds = replicate(size)
+        numpyff.run_numpyff(atoms, bonds, PRM, dipole_moment=False)  # assign terms
+        times, gradients = [], None
+        for properties in ({}, {'gradients': True}, {'hessian': True}):
+            results, elapsed = timed(numpyff.run_numpyff, atoms, bonds, PRM,
+                                     dipole_moment=False, **properties)
+            gradients = results.get('gradients', gradients)
+            times.append(elapsed)
+        print('{:8d} {:>8} {:10.2f} {:10.2f} {:10.2f} {:>12}'.format(
+              len(atoms), 'numpyff', times[0], times[1], times[2], ''))
+        if not with_tinker:
+            continue
+        key = tinker.prepare_tinker_key(PRM)
+        xyz = tinker.prepare_tinker_xyz(atoms, bonds)
+        times, reference = [], None
+        for properties in ({}, {'gradients': True}, {'hessian': True}):
+            if 'hessian' in properties and len(atoms) > 3000:
+                times.append(float('nan'))
+                continue
+            results, elapsed = timed(tinker.run_tinker, xyz, len(atoms), key, energy=True,
+                                     dipole_moment=False, **properties)
+            reference = results.get('gradients', reference)
+            times.append(elapsed)
+        print('{:8d} {:>8} {:10.2f} {:10.2f} {:10.2f} {:12.4e}'.format(
+              len(atoms), 'tinker', times[0], times[1], times[2],
+              np.abs(np.asarray(reference) - gradients).max()))
+
+
+if __name__ == '__main__':
+    main(*([[int(a) for a in sys.argv[1:]]] if sys.argv[1:] else []))
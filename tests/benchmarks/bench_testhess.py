@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the TINKER ``.hes`` parser against the previous dense,
+line-by-line implementation, using ``moredata/parsers/tinker_testhess.out``
+scaled up to larger systems.
+
+    python tests/benchmarks/bench_testhess.py [n_atoms ...]
+"""
+
+from __future__ import print_function, division, absolute_import
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from garleek.mm.tinker import _parse_tinker_testhess
+
+here = os.path.abspath(os.path.dirname(__file__))
+SAMPLE = os.path.join(here, '..', 'moredata', 'parsers', 'tinker_testhess.out')
+
+
+def legacy_parse_tinker_testhess(hesfile, n_atoms):
+    """
+    Parser shipped before the packed, vectorized one (dense matrix,
+    per-element assignment), followed by the lower triangle extraction
+    the connector used to do.
+    """
+    hessian = np.zeros((n_atoms * 3, n_atoms * 3))
+    xyz_to_int = {'X': 0, 'Y': 1, 'Z': 2}
+    with open(hesfile) as lines:
+        for line in lines:
+            if not line.strip():
+                continue
+            elif line.startswith(' Diagonal'):
+                _, line = next(lines), next(lines).rstrip()
+                nums = []
+                while line.strip():
+                    nums.extend(filter(bool, [line[:12], line[12:24], line[24:36],
+                                              line[36:48], line[48:60], line[60:72]]))
+                    line = next(lines).rstrip()
+                for i, num in enumerate(map(float, nums)):
+                    hessian[i, i] = num
+            elif line.startswith(' Off-diagonal'):
+                atom_pos, axis_pos = int(line[39:45])-1, xyz_to_int[line[46:47]]
+                _, line = next(lines), next(lines).rstrip()
+                nums = []
+                while line.strip():
+                    nums.extend(filter(bool, [line[:12], line[12:24], line[24:36],
+                                              line[36:48], line[48:60], line[60:72]]))
+                    try:
+                        line = next(lines).rstrip()
+                    except StopIteration:
+                        break
+                j = 3*atom_pos+axis_pos
+                for i, num in enumerate(map(float, nums)):
+                    hessian[i+j+1, j] = num
+    return hessian[np.tril_indices(n_atoms*3)]
+
+
+def write_hes(path, n_atoms, seed=0):
+    """
+    Write a synthetic ``.hes`` file for ``n_atoms``, formatted like
+    TINKER's ``testhess`` (6f12.4) with values sampled from the sample file.
+    """
+    sample = _parse_tinker_testhess(SAMPLE, 11)
+    rng = np.random.RandomState(seed)
+    size = 3 * n_atoms
+
+    def block(values):
+        out = []
+        for i in range(0, len(values), 6):
+            out.append(''.join('{:12.4f}'.format(v) for v in values[i:i+6]))
+        return '\n'.join(out)
+
+    with open(path, 'w') as f:
+        f.write('\n Diagonal Hessian Elements  (3 per Atom)\n\n')
+        f.write(block(rng.choice(sample, size)) + '\n')
+        for j in range(size - 1):
+            atom, axis = divmod(j, 3)
+            f.write('\n Off-diagonal Hessian Elements for Atom{:6d} {}\n\n'.format(atom + 1, 'XYZ'[axis]))
+            f.write(block(rng.choice(sample, size - j - 1)) + '\n')
+
+
+def peak_memory(function, *args):
+    """
+    Peak memory (MB) allocated while running ``function(*args)``.
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def main(sizes):
+    print('{:>8} {:>12} {:>12} {:>8} {:>12} {:>12}'.format(
+          'n_atoms', 'legacy (s)', 'packed (s)', 'speedup', 'legacy (MB)', 'packed (MB)'))
+    for n_atoms in sizes:
+        fd, path = tempfile.mkstemp(suffix='.hes')
+        os.close(fd)
+        try:
+            write_hes(path, n_atoms)
+            t0 = time.time()
+            legacy = legacy_parse_tinker_testhess(path, n_atoms)
+            t1 = time.time()
+            packed = _parse_tinker_testhess(path, n_atoms)
+            t2 = time.time()
+            legacy_mb = peak_memory(legacy_parse_tinker_testhess, path, n_atoms)
+            packed_mb = peak_memory(_parse_tinker_testhess, path, n_atoms)
+        finally:
+            os.remove(path)
+        assert np.array_equal(legacy, packed)
+        print('{:8d} {:12.3f} {:12.3f} {:8.1f} {:12.1f} {:12.1f}'.format(
+              n_atoms, t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), legacy_mb, packed_mb))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [11, 100, 300, 1000])
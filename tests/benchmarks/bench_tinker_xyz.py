@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the TINKER XYZ writer against the previous line-by-line
+implementation, on synthetic chain-like systems.
+
+    python tests/benchmarks/bench_tinker_xyz.py [n_atoms ...]
+
+``cold`` includes rendering the topology template (first step of a job);
+``warm`` is every subsequent step, when only coordinates are formatted.
+"""
+
+from __future__ import print_function, division, absolute_import
+import sys
+import time
+import numpy as np
+from garleek import units as u
+from garleek.mm import tinker
+from garleek.qm.structure import Atoms, Bonds
+
+
+def legacy_prepare_tinker_xyz(atoms, bonds=None):
+    """
+    Writer shipped before the topology-cached one.
+    """
+    out = [str(len(atoms))]
+    for index, atom in atoms.items():
+        if not bonds:
+            atom_bonds = ''
+        else:
+            atom_bonds = ' '.join([str(bonded_to) for (bonded_to, bond_index) in bonds[index]
+                                   if bond_index >= 0.5])
+        line = '{index} E{element} {xyz[0]} {xyz[1]} {xyz[2]} {type} {bonds}'
+        line = line.format(index=index, element=atom['element'], type=atom['type'],
+                           xyz=atom['xyz'] * u.RBOHR_TO_ANGSTROM, bonds=atom_bonds)
+        out.append(line)
+    return '\n'.join(out)
+
+
+def system(n_atoms, seed=0):
+    """
+    Atoms along a chain, each one bonded to the previous and next ones.
+    Returned as dicts (what the legacy writer got) and columnar objects.
+    """
+    rng = np.random.RandomState(seed)
+    atoms = Atoms(['6'] * n_atoms, ['C_3'] * n_atoms, rng.randn(n_atoms, 3) * 20,
+                  np.zeros(n_atoms))
+    first = np.arange(1, n_atoms)
+    bonds = Bonds.from_pairs(n_atoms, np.concatenate([first, first + 1]),
+                             np.concatenate([first + 1, first]), np.ones(2 * (n_atoms - 1)))
+    as_dicts = (dict((i, dict(atoms[i], xyz=atoms[i]['xyz'].copy())) for i in atoms),
+                dict(bonds))
+    return as_dicts, (atoms, bonds)
+
+
+def main(sizes):
+    print('{:>8} {:>12} {:>12} {:>12} {:>8}'.format('n_atoms', 'legacy (s)', 'cold (s)',
+                                                    'warm (s)', 'speedup'))
+    for n_atoms in sizes:
+        (atoms_dict, bonds_dict), (atoms, bonds) = system(n_atoms)
+        tinker._xyz_templates.clear()
+        t0 = time.time()
+        legacy_prepare_tinker_xyz(atoms_dict, bonds_dict)
+        t1 = time.time()
+        tinker.prepare_tinker_xyz(atoms, bonds)
+        t2 = time.time()
+        atoms.xyz += 0.01  # next optimization step
+        tinker.prepare_tinker_xyz(atoms, bonds)
+        t3 = time.time()
+        print('{:8d} {:12.4f} {:12.4f} {:12.4f} {:8.1f}'.format(
+              n_atoms, t1 - t0, t2 - t1, t3 - t2, (t1 - t0) / (t3 - t2)))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+Measure the effect of forcefield trimming on the bundled forcefields.
+
+    python tests/benchmarks/bench_trim_prm.py [n_types]
+
+For each forcefield, the first ``n_types`` atom types (20 by default) are
+taken as the system composition. The script reports file sizes and the
+time needed to read all records (a proxy for TINKER's own parsing). If
+TINKER's ``analyze`` can be found (see :func:`garleek.mm.tinker.tinker_executable`),
+it also times ``analyze`` on a dummy system with one isolated atom per type,
+which is dominated by reading the forcefield.
+"""
+
+from __future__ import print_function, division, absolute_import
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from garleek.mm.prm import iter_tinker_records, trim_tinker_parameters
+from garleek.mm.tinker import tinker_executable
+
+here = os.path.abspath(os.path.dirname(__file__))
+PRMS = os.path.join(here, '..', '..', 'garleek', 'data', 'prm')
+
+
+def timed(function, *args, **kwargs):
+    repeat = kwargs.pop('repeat', 5)
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.time()
+        function(*args)
+        best = min(best, time.time() - t0)
+    return best
+
+
+def run_analyze(analyze, xyz, prm):
+    key = os.path.splitext(xyz)[0] + '.key'
+    with open(key, 'w') as f:
+        f.write('parameters {}\n'.format(prm))
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([analyze, xyz, '-k', key, 'E'], stdout=devnull, stderr=devnull)
+
+
+def main(n_types=20):
+    analyze = tinker_executable('analyze')
+    print('{:>14} {:>10} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+          'forcefield', 'full (KB)', 'trim (KB)', 'full (ms)', 'trim (ms)',
+          'analyze (ms)', 'trimmed (ms)'))
+    tmp = tempfile.mkdtemp()
+    try:
+        for name in sorted(os.listdir(PRMS)):
+            if not name.endswith('.prm'):
+                continue
+            path = os.path.join(PRMS, name)
+            types = [f[0] for (k, f) in iter_tinker_records(path) if k == 'atom'][:n_types]
+            contents = trim_tinker_parameters(path, types)
+            if contents is None:
+                print('{:>14} {:>10.0f} {:>10}'.format(name, os.path.getsize(path) / 1024, 'n/a'))
+                continue
+            trimmed = os.path.join(tmp, 'trimmed.prm')
+            with open(trimmed, 'w') as f:
+                f.write(contents)
+            parse_full = timed(lambda p: list(iter_tinker_records(p)), path)
+            parse_trim = timed(lambda p: list(iter_tinker_records(p)), trimmed)
+            row = [name, os.path.getsize(path) / 1024, os.path.getsize(trimmed) / 1024,
+                   parse_full * 1000, parse_trim * 1000]
+            if analyze:
+                xyz = os.path.join(tmp, 'dummy.xyz')
+                with open(xyz, 'w') as f:
+                    f.write('{}\n'.format(len(types)))
+                    for i, t in enumerate(types, 1):
+                        f.write('{} X {:.1f} 0.0 0.0 {}\n'.format(i, 100.0 * i, t))
+                row += [timed(run_analyze, analyze, xyz, path, repeat=3) * 1000,
+                        timed(run_analyze, analyze, xyz, trimmed, repeat=3) * 1000]
+                print('{:>14} {:10.0f} {:10.0f} {:10.1f} {:10.1f} {:12.1f} {:12.1f}'.format(*row))
+            else:
+                print('{:>14} {:10.0f} {:10.0f} {:10.1f} {:10.1f} {:>12} {:>12}'.format(
+                      *(row + ['n/a', 'n/a'])))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*[int(n) for n in sys.argv[1:2]])
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+Generate ``reference.json``, the energies and gradients that
+``tests/test_numpyff.py`` checks :mod:`garleek.mm.numpyff` against.
+
+    python tests/moredata/numpyff/make_reference.py
+
+Requires OpenMM. For each bundled forcefield (``amber99sb.prm``,
+``charmm22.prm`` and ``oplsaa.prm``) and its test system, an OpenMM
+``System`` is built term by term from the PRM records, independently of
+:mod:`garleek.mm.numpyff` and following TINKER's conventions:
+
+- ``bond``, ``angle`` (radians) and ``ureybrad``: ``k (x - x0)^2``
+- ``torsion`` and ``imptors`` (center third): ``V (1 + cos(n phi - d))``,
+  ``0`` classes being wildcards of the terminal atoms; an ``imptors``
+  record matching several orderings of the neighbors is shared equally
+  between them
+- ``improper`` (center first): ``k (phi - phi0)^2``, in radians
+- Lennard-Jones pairs from ``radiusrule``, ``radiustype`` (``R-MIN`` or
+  ``SIGMA``) and ``radiussize`` (``RADIUS`` or ``DIAMETER``), with
+  ``vdw14`` parameters for 1-4 pairs
+- charges scaled by ``electric`` (OpenMM's own constant is divided out)
+- ``*-1n-scale`` values above 1 being divisors
+- ``bondunit``, ``angleunit``, ``torsionunit``, ``imptorunit``... factors
+  (``oplsaa.prm`` halves its torsion amplitudes)
+
+Every pair is an explicit exception of a ``NonbondedForce`` without
+cutoff, so that OpenMM's Reference platform only evaluates the
+functional forms. With OpenMM's ``amber99sb.xml``, which assigns its
+parameters from residue templates instead, the AMBER system is also
+checked to within the parameters that differ between both sources.
+
+Since both implementations follow the same reading of TINKER's conventions,
+agreement does not show parity with TINKER; ``record_tinker.py`` records
+TINKER's own energies and gradients for that.
+"""
+
+from __future__ import print_function, division, absolute_import
+import json
+import os
+import sys
+from itertools import combinations, permutations
+import numpy as np
+import openmm
+from openmm import app, unit
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path[:0] = [os.path.join(here, '..', '..'), os.path.join(here, '..', '..', '..')]
+from test_numpyff import NMA_BONDS, SYSTEMS, _system, prms  # noqa: E402
+from garleek import units as u  # noqa: E402
+
+KCAL = 4.184  # kJ
+ONE_4PI_EPS0 = 138.93545764438198  # OpenMM's Coulomb constant, kJ nm/mol/e^2
+TINKER_SCALES = {'vdw-12-scale': 0.0, 'vdw-13-scale': 0.0, 'vdw-14-scale': 1.0,
+                 'chg-12-scale': 0.0, 'chg-13-scale': 0.0, 'chg-14-scale': 1.0}
+# Energy unit factors, per squared degree for angles and impropers
+TINKER_UNITS = {'bondunit': 1.0, 'angleunit': (np.pi / 180)**2, 'ureyunit': 1.0,
+                'torsionunit': 1.0, 'imptorunit': 1.0, 'impropunit': (np.pi / 180)**2}
+
+
+def read_prm(path):
+    records = {'settings': dict(TINKER_SCALES, **TINKER_UNITS)}
+    for name in ('atom', 'charge', 'vdw', 'vdw14', 'bond', 'angle', 'ureybrad', 'torsion',
+                 'imptors', 'improper'):
+        records[name] = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split('!!')[0].split('#')[0].split()
+            if not fields:
+                continue
+            keyword, fields = fields[0].lower(), fields[1:]
+            if keyword == 'atom':
+                records['atom'][int(fields[0])] = int(fields[1])
+            elif keyword in ('charge', 'vdw', 'vdw14'):
+                records[keyword][int(fields[0])] = [float(f) for f in fields[1:3]]
+            elif keyword in ('bond', 'angle', 'ureybrad', 'improper'):
+                n = {'bond': 2, 'angle': 3, 'ureybrad': 3, 'improper': 4}[keyword]
+                records[keyword][tuple(int(f) for f in fields[:n])] = \
+                    [float(f) for f in fields[n:n+2]]
+            elif keyword in ('torsion', 'imptors'):
+                records[keyword][tuple(int(f) for f in fields[:4])] = \
+                    [[float(f) for f in fields[i:i+3]] for i in range(4, len(fields), 3)]
+            elif len(fields) == 1:
+                records['settings'][keyword] = fields[0].upper()
+    return records
+
+
+def find(table, key, wildcards=()):
+    for positions in ((),) + tuple(wildcards):
+        candidate = tuple(0 if i in positions else k for (i, k) in enumerate(key))
+        for candidate in (candidate, candidate[::-1]):
+            if candidate in table:
+                return table[candidate]
+
+
+def out_of_plane(table, center, neighbors, classes, position):
+    matches = {}
+    for ordering in permutations(neighbors):
+        atoms = list(ordering)
+        atoms.insert(position, center)
+        for key, parameters in table.items():
+            if all(k in (0, classes[a]) for (k, a) in zip(key, atoms)) \
+                    and key[position] == classes[center]:
+                matches.setdefault(key.count(0), {})[tuple(atoms)] = key
+    if not matches:
+        return []
+    best = matches[min(matches)]
+    return [(atoms, table[key], 1 / len(best)) for (atoms, key) in best.items()]
+
+
+def build_system(forcefield, types, pairs):
+    prm = read_prm(os.path.join(prms, forcefield))
+    settings = prm['settings']
+    scales = dict((name, float(settings[name])) for name in TINKER_SCALES)
+    for name, value in scales.items():
+        scales[name] = 1 / value if value > 1 else value
+    units = dict((name, float(settings[name])) for name in TINKER_UNITS)
+    for name in ('angleunit', 'impropunit'):  # to radians
+        units[name] *= (180 / np.pi)**2
+    electric = float(settings['electric'])
+    n = len(types)
+    classes = [prm['atom'][t] for t in types]
+    neighbors = [[] for _ in range(n)]
+    for (i, j) in pairs:
+        neighbors[i - 1].append(j - 1)
+        neighbors[j - 1].append(i - 1)
+    system = openmm.System()
+    for _ in range(n):
+        system.addParticle(12.0)
+    springs, angles = openmm.HarmonicBondForce(), openmm.HarmonicAngleForce()
+    torsions = openmm.PeriodicTorsionForce()
+    impropers = openmm.CustomTorsionForce('k*theta^2')  # phi0 is 0 in both CHARMM records
+    impropers.addPerTorsionParameter('k')
+    separation = {}
+    for (i, j) in pairs:
+        i, j = i - 1, j - 1
+        k, r0 = find(prm['bond'], (classes[i], classes[j]))
+        springs.addBond(i, j, r0 / 10, 2 * units['bondunit'] * k * KCAL * 100)
+        separation[frozenset((i, j))] = 12
+    for b in range(n):
+        for a, c in combinations(neighbors[b], 2):
+            k, theta0 = find(prm['angle'], (classes[a], classes[b], classes[c]))
+            angles.addAngle(a, b, c, np.radians(theta0), 2 * units['angleunit'] * k * KCAL)
+            urey = find(prm['ureybrad'], (classes[a], classes[b], classes[c]))
+            if urey:
+                springs.addBond(a, c, urey[1] / 10,
+                                2 * units['ureyunit'] * urey[0] * KCAL * 100)
+            separation.setdefault(frozenset((a, c)), 13)
+    for (b, c) in combinations(range(n), 2):
+        if c not in neighbors[b]:
+            continue
+        for a in neighbors[b]:
+            for d in neighbors[c]:
+                if len(set((a, b, c, d))) < 4:
+                    continue
+                terms = find(prm['torsion'], [classes[x] for x in (a, b, c, d)],
+                             wildcards=((0,), (3,), (0, 3)))
+                for (v, phase, periodicity) in terms:
+                    torsions.addTorsion(a, b, c, d, int(periodicity), np.radians(phase),
+                                        units['torsionunit'] * v * KCAL)
+                separation.setdefault(frozenset((a, d)), 14)
+    for center in range(n):
+        if len(neighbors[center]) != 3:
+            continue
+        for (atoms, terms, weight) in out_of_plane(prm['imptors'], center, neighbors[center],
+                                                   classes, 2):
+            for (v, phase, periodicity) in terms:
+                torsions.addTorsion(*(atoms + (int(periodicity), np.radians(phase),
+                                               weight * units['imptorunit'] * v * KCAL)))
+        for (atoms, (k, phi0), weight) in out_of_plane(prm['improper'], center,
+                                                       neighbors[center], classes, 0):
+            assert phi0 == 0
+            k *= weight * units['impropunit'] * KCAL
+            impropers.addTorsion(*(atoms + ([k],)))
+    # TINKER stores R-min radii; Lennard-Jones sigma is R-min / 2^(1/6)
+    to_rmin = 2**(1 / 6) if settings['radiustype'] == 'SIGMA' else 1.0
+    if settings['radiussize'] == 'DIAMETER':
+        to_rmin /= 2
+
+    def rmin_eps(i, one_four):
+        vdw_index = types[i] if settings.get('vdwindex') == 'TYPE' else classes[i]
+        radius, epsilon = prm['vdw14' if one_four and vdw_index in prm['vdw14'] else 'vdw'][
+            vdw_index]
+        return radius * to_rmin, abs(epsilon)
+
+    coulomb = openmm.NonbondedForce()
+    coulomb.setNonbondedMethod(openmm.NonbondedForce.NoCutoff)
+    charges = [prm['charge'].get(t, [0.0])[0] for t in types]
+    for i in range(n):
+        coulomb.addParticle(0.0, 0.1, 0.0)
+    to_openmm = electric / (ONE_4PI_EPS0 / KCAL * 10)
+    for (i, j) in combinations(range(n), 2):
+        order = separation.get(frozenset((i, j)))
+        (ri, ei), (rj, ej) = rmin_eps(i, order == 14), rmin_eps(j, order == 14)
+        if settings['radiusrule'] == 'GEOMETRIC':
+            rmin = 2 * np.sqrt(ri * rj)
+        else:
+            rmin = ri + rj
+        vdw_scale = scales['vdw-{}-scale'.format(order)] if order else 1.0
+        chg_scale = scales['chg-{}-scale'.format(order)] if order else 1.0
+        coulomb.addException(i, j, charges[i] * charges[j] * chg_scale * to_openmm,
+                             rmin / 10 / 2**(1 / 6), vdw_scale * np.sqrt(ei * ej) * KCAL)
+    for force in (springs, angles, torsions, impropers, coulomb):
+        system.addForce(force)
+    return system
+
+
+def evaluate(system, xyz):
+    context = openmm.Context(system, openmm.VerletIntegrator(0.001),
+                             openmm.Platform.getPlatformByName('Reference'))
+    context.setPositions(xyz / 10)
+    state = context.getState(getEnergy=True, getForces=True)
+    energy = state.getPotentialEnergy().value_in_unit(unit.kilojoule_per_mole) / KCAL
+    forces = state.getForces(asNumpy=True).value_in_unit(unit.kilojoule_per_mole /
+                                                         unit.nanometer)
+    return energy, -forces / KCAL / 10
+
+
+def check_amber_xml(xyz, reference):
+    """
+    Energy of the AMBER test system with OpenMM's ``amber99sb.xml``, with
+    the parameters that differ from ``amber99sb.prm`` set to the latter's:
+    the ``X-X-N-H`` improper (1.1 kcal/mol, 1.0 in the PRM) and the Coulomb
+    constant (332.0637 kcal A/mol, 332.0522173 in the PRM).
+    """
+    topology = app.Topology()
+    chain = topology.addChain()
+    residues = [topology.addResidue(name, chain) for name in ('ACE', 'NME')]
+    elements = [app.element.carbon, app.element.hydrogen, app.element.oxygen,
+                app.element.nitrogen]
+    atoms = [topology.addAtom(name, elements['CHON'.index(name[0])], residues[i > 5])
+             for (i, name) in enumerate(['CH3', 'HH31', 'HH32', 'HH33', 'C', 'O', 'N', 'H',
+                                         'CH3', 'HH31', 'HH32', 'HH33'])]
+    for (i, j) in NMA_BONDS:
+        topology.addBond(atoms[i - 1], atoms[j - 1])
+    system = app.ForceField('amber99sb.xml').createSystem(topology,
+                                                         nonbondedMethod=app.NoCutoff)
+    scale = np.sqrt(332.0522173 / (ONE_4PI_EPS0 / KCAL * 10))
+    for force in system.getForces():
+        if isinstance(force, openmm.PeriodicTorsionForce):
+            for k in range(force.getNumTorsions()):
+                parameters = force.getTorsionParameters(k)
+                if sorted(parameters[:4]) == [4, 6, 7, 8]:  # C, N, H and CH3 of NME
+                    force.setTorsionParameters(*([k] + parameters[:6] + [1.0 * KCAL]))
+        elif isinstance(force, openmm.NonbondedForce):
+            for i in range(force.getNumParticles()):
+                q, sigma, epsilon = force.getParticleParameters(i)
+                force.setParticleParameters(i, q * scale, sigma, epsilon)
+            for k in range(force.getNumExceptions()):
+                i, j, qq, sigma, epsilon = force.getExceptionParameters(k)
+                force.setExceptionParameters(k, i, j, qq * scale**2, sigma, epsilon)
+    energy, gradients = evaluate(system, xyz)
+    print('amber99sb.xml: energy difference {:.2e} kcal/mol, gradients {:.2e} '
+          'kcal/mol/A'.format(energy - reference[0], abs(gradients - reference[1]).max()))
+
+
+def main():
+    results = {}
+    for forcefield in sorted(SYSTEMS):
+        atoms, bonds = _system(forcefield)
+        xyz = atoms.xyz * u.RBOHR_TO_ANGSTROM
+        types = [int(t) for t in atoms.types]
+        pairs = [(i, j) for (i, j) in zip(bonds.atoms(), bonds.neighbors) if i < j]
+        energy, gradients = evaluate(build_system(forcefield, types, pairs), xyz)
+        print('{}: {:.6f} kcal/mol'.format(forcefield, energy))
+        if forcefield == 'amber99sb.prm':
+            check_amber_xml(xyz, (energy, gradients))
+        results[forcefield] = {'types': types, 'bonds': [[int(i), int(j)] for (i, j) in pairs],
+                               'xyz': xyz.tolist(), 'energy': energy,
+                               'gradients': gradients.tolist()}
+    with open(os.path.join(here, 'reference.json'), 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+Record the output of TINKER's ``analyze`` and ``testgrad`` for the
+:mod:`garleek.mm.numpyff` test systems, which ``tests/test_numpyff.py``
+checks numpyff against.
+
+    python tests/moredata/numpyff/record_tinker.py
+
+Requires TINKER (see :func:`garleek.mm.tinker.tinker_executable`). For each
+bundled forcefield (``amber99sb.prm``, ``charmm22.prm`` and ``oplsaa.prm``),
+the TINKER XYZ file of its test system and the unmodified output of both
+programs, run exactly as :func:`garleek.mm.tinker.run_tinker` does, are
+written to ``tinker/<forcefield>.{xyz,analyze,testgrad}``. Unlike
+``reference.json``, which comes from an independent implementation of the
+same conventions, these are the energies and gradients TINKER itself gives.
+"""
+
+from __future__ import print_function, division, absolute_import
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path[:0] = [os.path.join(here, '..', '..'), os.path.join(here, '..', '..', '..')]
+from test_numpyff import SYSTEMS, _system, prms  # noqa: E402
+from garleek.mm.tinker import prepare_tinker_xyz, tinker_executable  # noqa: E402
+
+OUTPUT = os.path.join(here, 'tinker')
+COMMANDS = {
+    'analyze': ['E'],
+    'testgrad': ['y', 'n', '0.1D-04'],
+}
+
+
+def main():
+    missing = [program for program in COMMANDS if not tinker_executable(program)]
+    if missing:
+        sys.exit('TINKER {} could not be found'.format(', '.join(missing)))
+    if not os.path.isdir(OUTPUT):
+        os.makedirs(OUTPUT)
+    workdir = tempfile.mkdtemp()
+    try:
+        for forcefield in sorted(SYSTEMS):
+            atoms, bonds = _system(forcefield)
+            xyz_data = prepare_tinker_xyz(atoms, bonds)
+            xyz = os.path.join(workdir, 'system.xyz')
+            key = os.path.join(workdir, 'system.key')
+            with open(xyz, 'w') as f:
+                f.write(xyz_data)
+            with open(key, 'w') as f:
+                f.write('parameters {}\n'.format(os.path.abspath(os.path.join(prms, forcefield))))
+            with open(os.path.join(OUTPUT, forcefield + '.xyz'), 'w') as f:
+                f.write(xyz_data)
+            for program, arguments in sorted(COMMANDS.items()):
+                output = subprocess.check_output(
+                    [tinker_executable(program), xyz, '-k', key] + arguments)
+                with open(os.path.join(OUTPUT, '{}.{}'.format(forcefield, program)), 'wb') as f:
+                    f.write(output)
+            print('Recorded', forcefield)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
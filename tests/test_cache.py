@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+from garleek import cache
+
+
+def test_cache_dir(monkeypatch):
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', '/some/where')
+    assert cache.cache_dir('keys') == os.path.join('/some/where', 'keys')
+    monkeypatch.delenv('GARLEEK_CACHE_DIR')
+    monkeypatch.setenv('XDG_CACHE_HOME', '/xdg')
+    assert cache.cache_dir() == os.path.join('/xdg', 'garleek')
+
+
+def test_digest():
+    assert cache.digest('a', 1) == cache.digest('a', '1')
+    assert cache.digest('ab', 'c') != cache.digest('a', 'bc')
+    assert cache.digest(b'\x00') != cache.digest(b'\x00\x00')
+
+
+def test_cached_file(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir))
+    calls = []
+
+    def contents():
+        calls.append(1)
+        return 'data\n'
+
+    key = cache.digest('test')
+    path = cache.cached_file('things', key, contents, suffix='.txt')
+    assert path == str(tmpdir.join('things', key + '.txt'))
+    assert cache.cached_file('things', key, contents, suffix='.txt') == path
+    assert len(calls) == 1
+    with open(path) as f:
+        assert f.read() == 'data\n'
+    # no temporary leftovers
+    assert os.listdir(str(tmpdir.join('things'))) == [key + '.txt']
+
+
+def test_cached_file_unwritable(tmpdir, monkeypatch):
+    tmpdir.join('file').write('')
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir.join('file')))
+    assert cache.cached_file('things', 'abc', lambda: 'data') is None
+
+
+def test_private_dir(tmpdir, monkeypatch):
+    path = str(tmpdir.join('private'))
+    assert cache.private_dir(path)
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    os.chmod(path, 0o777)
+    assert cache.private_dir(path)
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    assert not cache.private_dir(str(tmpdir.join('missing', 'private')))
+    link = str(tmpdir.join('link'))
+    os.symlink(path, link)
+    assert not cache.private_dir(link)
+    tmpdir.join('file').write('')
+    assert not cache.private_dir(str(tmpdir.join('file')))
+    uid = os.getuid()
+    monkeypatch.setattr(os, 'getuid', lambda: uid + 1)  # someone else's
+    assert not cache.private_dir(path)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+import sys
+import subprocess
+import time
+import pytest
+import garleek
+from garleek import cli, server
+
+
+# Per-call floor of `garleek-backend`: modules that must NOT be imported
+# before dispatching to the connector
+IMPORT_FORBIDDEN = {
+    'garleek.cli': ['numpy', 'garleek.connectors', 'garleek._version', 'distutils',
+                    'subprocess'],
+    'garleek.connectors': ['garleek._version', 'distutils'],
+}
+
+
+def _importtime(module):
+    """
+    Run ``python -X importtime -c "import <module>"`` and return a dict
+    mapping every imported module to its cumulative import time (us).
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    output = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                              stderr=subprocess.PIPE, env=env).communicate()[1]
+    timings = {}
+    for line in output.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split(':', 1)[1].split('|')
+        timings[name.strip()] = int(cumulative)
+    return timings
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='Needs -X importtime')
+@pytest.mark.parametrize("module", sorted(IMPORT_FORBIDDEN))
+def test_import_floor(module):
+    timings = _importtime(module)
+    assert module in timings
+    for forbidden in IMPORT_FORBIDDEN[module]:
+        assert forbidden not in timings, '{} imports {}'.format(module, forbidden)
+
+
+def test_backend_app_run_floor(monkeypatch, capsys):
+    # The banner must not ask git (through versioneer) for the version
+    def popen(*args, **kwargs):
+        raise AssertionError('backend_app_run started a subprocess')
+    monkeypatch.setattr(subprocess, 'Popen', popen)
+    monkeypatch.setattr(garleek, '_static_version_string', None)
+    monkeypatch.setattr(cli, 'backend_app', lambda **kwargs: None)
+    cli.backend_app_run(qmargs=['R', 'a.EIn', 'a.EOu'])
+    assert 'Entering Garleek v' in capsys.readouterr().out
+
+def test_backend_args_processors():
+    args = cli._backend_args(['--nproc', '4', '--cpus', '8,0-2', 'R', 'a.EIn', 'a.EOu'])
+    assert args.nproc == 4
+    assert args.cpus == [0, 1, 2, 8]
+    assert args.qmargs == ['R', 'a.EIn', 'a.EOu']
+    with pytest.raises(SystemExit):
+        cli._backend_args(['--cpus', '0-x'])
+
+
+def test_backend_args_phva():
+    args = cli._backend_args(['--phva-radius', '6', '--qm-atoms', '1-4,9',
+                              '--phva-atoms', '12', 'R', 'a.EIn', 'a.EOu'])
+    assert args.phva_radius == 6.0
+    assert args.qm_atoms == [1, 2, 3, 4, 9]
+    assert args.phva_atoms == [12]
+    with pytest.raises(SystemExit):
+        cli._backend_args(['--qm-atoms', 'all'])
+
+
+needs_unix_sockets = pytest.mark.skipif(not hasattr(server.socket, 'AF_UNIX'),
+                                        reason='Needs Unix sockets')
+
+
+@pytest.fixture
+def socket_path(tmpdir, monkeypatch):
+    path = str(tmpdir.join('garleek.sock'))
+    monkeypatch.setenv('GARLEEK_SOCKET', path)
+    yield path
+    # Never leave spawned servers behind
+    if server.shutdown(path):
+        deadline = time.time() + 10
+        while os.path.exists(path) and time.time() < deadline:
+            time.sleep(0.05)
+        assert not os.path.exists(path)
+
+
+@needs_unix_sockets
+def test_server_roundtrip(tmpdir, socket_path):
+    kwargs = dict(qmargs=['R', 'input.EIn', 'input.EOu'], qm='nonexistent', mm='tinker',
+                  ff='mm3.prm')
+    response = server.request(cwd=str(tmpdir), idle_timeout=5, **kwargs)
+    assert response is not None
+    assert response['returncode'] == 1
+    assert 'is not available' in response['stderr']
+    assert 'Entering Garleek' in response['stdout']
+    # The server stays alive and serves the next request
+    response = server.request(cwd=str(tmpdir), idle_timeout=5, **kwargs)
+    assert response['returncode'] == 1
+    assert os.path.exists(socket_path)
+
+
+# Server that binds a socket, acknowledges one request with a process ID
+# (its own, or the one given) and never answers
+SILENT_SERVER = """
+import os, socket, sys, time
+listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+listener.bind(sys.argv[1])
+listener.listen(1)
+conn, _ = listener.accept()
+conn.makefile('rb').readline()
+pid = os.getpid() if sys.argv[2] == 'self' else int(sys.argv[2])
+conn.sendall(('{"pid": %d}\\n' % pid).encode())
+time.sleep(60)
+"""
+
+
+def _silent_server(path, pid='self'):
+    process = subprocess.Popen([sys.executable, '-c', SILENT_SERVER, path, str(pid)])
+    deadline = time.time() + 10
+    while not os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.01)
+    return process
+
+
+@needs_unix_sockets
+@pytest.mark.parametrize('case', ['spawned', 'unrecorded', 'forged'])
+def test_server_response_timeout(tmpdir, socket_path, case):
+    # A server that does not answer in time is terminated, and the caller
+    # falls back to in-process. Only the server in the PID file is terminated,
+    # never the process another one claims to be.
+    bystander = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    silent = _silent_server(socket_path, bystander.pid if case == 'forged' else 'self')
+    recorded = {'spawned': silent.pid, 'unrecorded': None, 'forged': bystander.pid}[case]
+    if recorded is not None:
+        with open(server._sibling(socket_path, '.pid'), 'w') as f:
+            f.write(str(recorded))
+    try:
+        start = time.time()
+        assert server.request(cwd=str(tmpdir), response_timeout=0.5, qmargs=[],
+                              qm='gaussian') is None
+        assert time.time() - start < 5
+        if case == 'spawned':
+            assert silent.wait(5) != 0
+        else:
+            time.sleep(0.2)
+            assert silent.poll() is None
+        if case == 'forged' and hasattr(server.socket, 'SO_PEERCRED'):
+            assert bystander.poll() is None
+    finally:
+        for process in (silent, bystander):
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+    os.remove(socket_path)
+
+
+@needs_unix_sockets
+def test_server_private_socket(tmpdir, monkeypatch):
+    monkeypatch.delenv('GARLEEK_SOCKET', raising=False)
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmpdir))
+    path = server.socket_path(str(tmpdir), 'gaussian', 'tinker', 'mm3.prm')
+    assert os.path.dirname(path) == str(tmpdir.join('garleek'))
+    assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
+    uid = os.getuid()
+    monkeypatch.setattr(os, 'getuid', lambda: uid + 1)  # owned by someone else
+    assert server.socket_path(str(tmpdir), 'gaussian', 'tinker', 'mm3.prm') is None
+    assert server.request(cwd=str(tmpdir), qmargs=[], qm='gaussian') is None
+
+
+@needs_unix_sockets
+@pytest.mark.skipif(not hasattr(server.socket, 'SO_PEERCRED'), reason='Needs SO_PEERCRED')
+def test_server_peer(tmpdir):
+    a, b = server.socket.socketpair()
+    try:
+        assert server._peer(a) == (os.getpid(), os.getuid())
+        assert server._same_user(a)
+    finally:
+        a.close()
+        b.close()
+
+
+@needs_unix_sockets
+def test_server_environment_and_log(tmpdir, socket_path, monkeypatch):
+    # Each request runs with the environment of its client, and the server
+    # output goes to its log
+    kwargs = dict(qmargs=['R', 'input.EIn', 'input.EOu'], qm='nonexistent', mm='tinker',
+                  ff='mm3.prm')
+    monkeypatch.setenv('GARLEEK_TEST_VARIABLE', 'first')
+    assert server.request(cwd=str(tmpdir), idle_timeout=5, **kwargs)['returncode'] == 1
+    monkeypatch.setenv('GARLEEK_TEST_VARIABLE', 'second')
+    payload = {'cwd': str(tmpdir), 'env': dict(os.environ),
+               'kwargs': dict(kwargs, qm='gaussian', qmargs=['R', 'missing.EIn', None])}
+    monkeypatch.setattr('garleek.cli.backend_app', lambda **kw: print(
+        os.environ['GARLEEK_TEST_VARIABLE']))
+    response = server._handle(payload)
+    assert 'second' in response['stdout']
+    with open(server._sibling(socket_path, '.pid')) as f:
+        assert int(f.read())
+    assert os.path.isfile(server._sibling(socket_path, '.log'))
+
+
+def test_server_warm_up():
+    from garleek.mm import numpyff, prm
+    ff = os.path.join(os.path.dirname(cli.__file__), 'data', 'prm', 'oplsaa.prm')
+    server.warm_up(ff, 'numpyff')
+    assert os.path.abspath(ff) in [path for (path, _) in numpyff._forcefields]
+    assert os.path.abspath(ff) in [path for (path, _) in prm._charge_models]
+
+
+def test_server_unreachable(tmpdir, monkeypatch):
+    monkeypatch.setattr(server, 'spawn_server', lambda *a, **kw: False)
+    monkeypatch.setenv('GARLEEK_SOCKET', str(tmpdir.join('missing', 'garleek.sock')))
+    assert server.request(cwd=str(tmpdir), qmargs=[], qm='gaussian') is None
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+from functools import partial
+import pytest
+import numpy as np
+from garleek.hessian import (PackedHessian, packed_size, finite_difference_hessian,
+                             partial_hessian_atoms)
+
+
+def _symmetric(n):
+    matrix = np.random.RandomState(0).rand(n, n)
+    return matrix + matrix.T
+
+
+def test_packed_layout():
+    matrix = _symmetric(6)
+    hessian = PackedHessian.from_dense(matrix)
+    assert hessian.size == packed_size(6) == 21
+    # row-major lower triangle, as written in Gaussian EOu files
+    assert (np.asarray(hessian) == matrix[np.tril_indices(6)]).all()
+    assert np.asarray(hessian) is hessian.data
+    assert (hessian.dense() == matrix).all()
+    assert hessian[1, 4] == hessian[4, 1] == matrix[4, 1]
+    assert (hessian.row(2) == matrix[2]).all()
+    assert (hessian.diagonal() == np.diag(matrix)).all()
+
+
+def test_setters():
+    hessian = PackedHessian(6)
+    hessian.set_diagonal([1, 2, 3, 4, 5, 6])
+    hessian.set_lower_column(2, [7, 8])
+    hessian[5, 0] = 9
+    dense = hessian.dense()
+    assert (np.diag(dense) == [1, 2, 3, 4, 5, 6]).all()
+    assert dense[3, 2] == dense[2, 3] == 7
+    assert dense[4, 2] == 8 and dense[5, 2] == 0
+    assert dense[0, 5] == 9
+
+
+def test_add_columns():
+    matrix = np.random.RandomState(1).rand(7, 7)  # not symmetric
+    hessian = PackedHessian(7)
+    for column in np.random.RandomState(2).permutation(7):
+        hessian.add_column(column, matrix[:, column])
+    assert np.allclose(hessian.dense(), (matrix + matrix.T) / 2)
+
+
+def test_scaling_in_place():
+    hessian = PackedHessian.from_dense(_symmetric(6))
+    data = hessian.data
+    expected = data * 0.5
+    hessian *= 0.5
+    assert hessian.data is data
+    assert (hessian.data == expected).all()
+    assert ((2 * hessian).data == data * 2).all()
+
+
+def test_zero_atoms():
+    hessian = PackedHessian.from_dense(_symmetric(9))
+    hessian.zero_atoms([3])
+    dense = hessian.dense()
+    assert (dense[6:] == 0).all() and (dense[:, 6:] == 0).all()
+    assert (dense[:6, :6] != 0).all()
+
+
+def test_wrong_size():
+    with pytest.raises(ValueError):
+        PackedHessian(6, np.zeros(36))
+
+
+class _Interrupted(Exception):
+    pass
+
+
+def _quadratic_gradients(matrix, xyz):
+    return matrix.dot(xyz.ravel())
+
+
+def _quadratic(n_atoms=4):
+    matrix = _symmetric(3 * n_atoms)
+    xyz = np.random.RandomState(3).rand(n_atoms, 3)
+    return matrix, xyz, partial(_quadratic_gradients, matrix)
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_finite_difference_hessian(processes):
+    matrix, xyz, gradients = _quadratic()
+    hessian = finite_difference_hessian(gradients, xyz, processes=processes)
+    assert np.allclose(hessian.dense(), matrix)
+    # Only the rows and columns of the displaced atoms
+    hessian = finite_difference_hessian(gradients, xyz, atoms=[1, 3]).dense()
+    active = np.zeros(matrix.shape[0], dtype=bool)
+    active[3:6] = active[9:12] = True
+    assert np.allclose(hessian[active], matrix[active])
+    assert np.allclose(hessian[:, active], matrix[:, active])
+    assert (hessian[~active][:, ~active] == 0).all()
+    # Partial Hessian: only the block of the displaced atoms
+    hessian = finite_difference_hessian(gradients, xyz, atoms=[1, 3], couplings=False).dense()
+    block = np.outer(active, active)
+    assert np.allclose(hessian[block], matrix[block])
+    assert (hessian[~block] == 0).all()
+
+
+def test_finite_difference_hessian_checkpoint(tmpdir):
+    matrix, xyz, gradients = _quadratic()
+    checkpoint = str(tmpdir.join('fd.hes'))
+    calls = []
+
+    def interrupted(displaced, after=None):
+        if len(calls) == after:
+            raise _Interrupted
+        calls.append(1)
+        return gradients(displaced)
+
+    with pytest.raises(_Interrupted):
+        finite_difference_hessian(partial(interrupted, after=10), xyz, checkpoint=checkpoint)
+    with open(checkpoint, 'ab') as f:
+        f.write(b'\0' * 12)  # incomplete record, as left by a killed process
+    del calls[:]
+    hessian = finite_difference_hessian(interrupted, xyz, checkpoint=checkpoint)
+    assert len(calls) == 2 * (matrix.shape[0] - 5)  # 5 columns were saved
+    assert np.allclose(hessian.dense(), matrix)
+    assert not os.path.exists(checkpoint)
+    # Checkpoints of other calculations are ignored
+    del calls[:]
+    with pytest.raises(_Interrupted):
+        finite_difference_hessian(partial(interrupted, after=10), xyz, checkpoint=checkpoint)
+    del calls[:]
+    finite_difference_hessian(interrupted, xyz, step=0.001, checkpoint=checkpoint)
+    assert len(calls) == 2 * matrix.shape[0]
+
+
+def test_partial_hessian_atoms():
+    grid = np.mgrid[0:10, 0:10, 0:10].reshape(3, -1).T * 1.5
+    qm_atoms = [0, 555]
+    expected = np.flatnonzero(
+        (np.linalg.norm(grid[:, None] - grid[qm_atoms], axis=2) < 4.0).any(axis=1))
+    assert (partial_hessian_atoms(grid, qm_atoms, radius=4.0) == expected).all()
+    selected = partial_hessian_atoms(grid, qm_atoms, radius=4.0, atoms=[999])
+    assert (selected == np.append(expected, 999)).all()
+    assert (partial_hessian_atoms(grid, [7], atoms=[5, 2, 5]) == [2, 5, 7]).all()
+    with pytest.raises(ValueError, match='QM atoms'):
+        partial_hessian_atoms(grid, [], radius=4.0)
+    with pytest.raises(ValueError, match='QM atoms'):
+        partial_hessian_atoms(grid, [], atoms=[3])
+    with pytest.raises(ValueError):
+        partial_hessian_atoms(grid, [0], atoms=[1000])
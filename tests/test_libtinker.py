@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import ctypes
+import os
+import subprocess
+import numpy as np
+import pytest
+from garleek import connectors, units as u
+from garleek.mm import libtinker
+from garleek.qm.gaussian import parse_gaussian_EIn
+from garleek.qm.structure import Atoms, Bonds
+
+here = os.path.abspath(os.path.dirname(__file__))
+eins = os.path.join(here, 'moredata', 'EIns')
+prms = os.path.join(here, '..', 'garleek', 'data', 'prm')
+
+# Stand-in for a TINKER library implementing the Garleek interface:
+# unit springs (E = (r - 1)^2, in kcal/mol and A) along every bond and
+# a "dipole" weighting coordinates by atom types.
+STANDIN = r"""
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+static int n = 0, n_bonds = 0, setups = 0;
+static int *types = NULL, *first = NULL, *second = NULL;
+static char error[256] = "";
+
+int garleek_abi_version(void) { return 1; }
+const char *garleek_last_error(void) { return error; }
+int standin_setups(void) { return setups; }
+
+void garleek_release(void) {
+    free(types); free(first); free(second);
+    types = first = second = NULL;
+    n = n_bonds = 0;
+}
+
+int garleek_setup(const char *keyfile, int n_atoms, const int *t, const int *indptr,
+                  const int *neighbors) {
+    FILE *f = fopen(keyfile, "r");
+    if (!f) {
+        snprintf(error, sizeof error, "cannot open %s", keyfile);
+        return 1;
+    }
+    fclose(f);
+    n = n_atoms;
+    types = malloc(n * sizeof(int));
+    memcpy(types, t, n * sizeof(int));
+    first = malloc(indptr[n] * sizeof(int));
+    second = malloc(indptr[n] * sizeof(int));
+    for (int i = 0; i < n; i++)
+        for (int k = indptr[i]; k < indptr[i+1]; k++)
+            if (neighbors[k] - 1 > i) {
+                first[n_bonds] = i;
+                second[n_bonds++] = neighbors[k] - 1;
+            }
+    setups++;
+    return 0;
+}
+
+static void add(double *hessian, int i, int j, double value) {
+    if (j > i) { int k = i; i = j; j = k; }
+    hessian[(long) i * (i + 1) / 2 + j] += value;
+}
+
+int garleek_evaluate(const double *xyz, int derivatives, double *energy, double *dipole,
+                     double *gradients, double *hessian) {
+    *energy = 0;
+    if (dipole)
+        for (int c = 0; c < 3; c++) {
+            dipole[c] = 0;
+            for (int i = 0; i < n; i++) dipole[c] += types[i] * xyz[3*i+c];
+        }
+    if (gradients && derivatives > 0) memset(gradients, 0, 3 * n * sizeof(double));
+    for (int b = 0; b < n_bonds; b++) {
+        int i = first[b], j = second[b];
+        double d[3], r = 0;
+        for (int c = 0; c < 3; c++) { d[c] = xyz[3*i+c] - xyz[3*j+c]; r += d[c] * d[c]; }
+        r = sqrt(r);
+        *energy += (r - 1) * (r - 1);
+        for (int c = 0; c < 3; c++) {
+            d[c] /= r;
+            if (gradients && derivatives > 0) {
+                gradients[3*i+c] += 2 * (r - 1) * d[c];
+                gradients[3*j+c] -= 2 * (r - 1) * d[c];
+            }
+        }
+        if (!hessian || derivatives < 2) continue;
+        for (int a = 0; a < 3; a++)
+            for (int c = 0; c < 3; c++) {
+                double h = 2 * d[a] * d[c] + 2 * (r - 1) / r * ((a == c) - d[a] * d[c]);
+                if (c <= a) {
+                    add(hessian, 3*i+a, 3*i+c, h);
+                    add(hessian, 3*j+a, 3*j+c, h);
+                }
+                add(hessian, 3*i+a, 3*j+c, -h);
+            }
+    }
+    return 0;
+}
+"""
+
+
+@pytest.fixture(scope='module')
+def standin(tmpdir_factory):
+    directory = tmpdir_factory.mktemp('libtinker')
+    source, library = directory.join('standin.c'), directory.join('libstandin.so')
+    source.write(STANDIN)
+    try:
+        subprocess.check_call(['cc', '-shared', '-fPIC', '-O2', '-o', str(library),
+                               str(source), '-lm'])
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip('no C compiler to build the stand-in TINKER library')
+    return str(library)
+
+
+def _setups(path):
+    return ctypes.CDLL(path).standin_setups()
+
+
+def _reference(atoms, bonds):
+    xyz = atoms.xyz * u.RBOHR_TO_ANGSTROM
+    energy, gradients = 0, np.zeros_like(xyz)
+    hessian = np.zeros((xyz.size, xyz.size))
+    for i, j in zip(bonds.atoms() - 1, bonds.neighbors - 1):
+        if j <= i:
+            continue
+        d = xyz[i] - xyz[j]
+        r = np.linalg.norm(d)
+        d /= r
+        energy += (r - 1)**2
+        gradients[i] += 2 * (r - 1) * d
+        gradients[j] -= 2 * (r - 1) * d
+        block = 2 * np.outer(d, d) + 2 * (r - 1) / r * (np.eye(3) - np.outer(d, d))
+        for (a, b, sign) in ((i, i, 1), (j, j, 1), (i, j, -1), (j, i, -1)):
+            hessian[3*a:3*a+3, 3*b:3*b+3] += sign * block
+    types = np.array(atoms.types, dtype=float)
+    return energy, np.dot(types, xyz), gradients, hessian
+
+
+def test_run_libtinker(standin, tmpdir):
+    atoms = Atoms(['6', '1', '1'], ['1', '5', '5'],
+                  [[0, 0, 0], [0, 0, 2.1], [1.9, 0.3, -0.5]], [0, 0, 0])
+    bonds = Bonds.from_pairs(3, [1, 2, 1, 3], [2, 1, 3, 1], [1, 1, 1, 1])
+    key = str(tmpdir.join('standin.key'))
+    open(key, 'w').close()
+    results = libtinker.run_libtinker(atoms, bonds, key, library=standin, gradients=True,
+                                      hessian=True)
+    energy, dipole, gradients, hessian = _reference(atoms, bonds)
+    assert results['energy'] == pytest.approx(energy)
+    assert np.allclose(results['dipole_moment'], dipole)
+    assert np.allclose(results['gradients'], gradients)
+    assert np.allclose(results['hessian'].dense(), hessian)
+    # New coordinates do not set the system up again
+    atoms.xyz[1, 2] += 0.1
+    results = libtinker.run_libtinker(atoms, bonds, key, library=standin, dipole_moment=False)
+    assert set(results) == set(['energy'])
+    assert results['energy'] == pytest.approx(_reference(atoms, bonds)[0])
+    assert _setups(standin) == 1
+    # Neither do other paths to the same library
+    libtinker.run_libtinker(atoms, bonds, key, library=os.path.relpath(standin))
+    assert _setups(standin) == 1
+    bonds = Bonds.from_pairs(3, [1, 2], [2, 1], [1, 1])
+    libtinker.run_libtinker(atoms, bonds, key, library=standin)
+    assert _setups(standin) == 2
+
+
+def test_run_libtinker_errors(standin, tmpdir, monkeypatch):
+    atoms = Atoms(['6'], ['1'], [[0, 0, 0]], [0])
+    with pytest.raises(RuntimeError, match='cannot open'):
+        libtinker.run_libtinker(atoms, None, str(tmpdir.join('missing.key')), library=standin)
+    monkeypatch.delenv('GARLEEK_TINKER_LIBRARY', raising=False)
+    monkeypatch.setattr(libtinker.ctypes.util, 'find_library', lambda name: None)
+    with pytest.raises(RuntimeError, match='GARLEEK_TINKER_LIBRARY'):
+        libtinker.default_library()
+    monkeypatch.setenv('GARLEEK_TINKER_LIBRARY', standin)
+    assert libtinker.default_library() == standin
+
+
+def test_gaussian_libtinker(standin, tmpdir, monkeypatch):
+    # Same system with MM3 types, as garleek-prepare would leave it
+    with open(os.path.join(eins, 'A_1.EIn')) as f:
+        lines = f.read().splitlines()
+    for i, mm3 in enumerate(['1', '5', '5', '5', '5'], 1):
+        lines[i] = lines[i].rsplit(None, 1)[0] + ' ' + mm3
+    ein_filename = str(tmpdir.join('A_1.EIn'))
+    with open(ein_filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    ein = parse_gaussian_EIn(ein_filename)
+    monkeypatch.setenv('GARLEEK_TINKER_LIBRARY', standin)
+    eou_filename = connectors.EOU_WRITERS['gaussian']['libtinker'](
+        ['R', ein_filename, None], forcefield=os.path.join(prms, 'mm3.prm'),
+        cache_results=False)
+    assert eou_filename == str(tmpdir.join('A_1.EOu'))
+    with open(eou_filename) as f:
+        eou = f.read()
+    energy = _reference(ein['atoms'], ein['bonds'])[0] * u.KCALMOL_TO_HARTREE
+    assert float(eou.split()[0].replace('D', 'E')) == pytest.approx(energy)
@@ -1,16 +1,180 @@
 #!/usr/bin/env python
 
 from __future__ import print_function, division, absolute_import
+import os
+import stat
+import sys
+import threading
+from subprocess import CalledProcessError
 import pytest
-from garleek.mm.tinker import _parse_tinker_testgrad, _parse_tinker_analyze, _parse_tinker_testhess
+import numpy as np
+from garleek.mm import tinker
+from garleek import units as u
+from garleek.hessian import PackedHessian
+from garleek.qm.structure import Atoms, Bonds
+from garleek.mm import prm as prm_module, prmdb
+from garleek.mm.prm import (fixed_charge_model, iter_tinker_records, trim_tinker_parameters,
+                            CLASS_INDEXED_RECORDS, VDW_INDEXED_RECORDS,
+                            EITHER_INDEXED_RECORDS)
+from garleek.mm.tinker import (_parse_tinker_testgrad, _parse_tinker_analyze, _parse_tinker_testhess,
+                               _run_tinker_programs, run_tinker)
 
+here = os.path.abspath(os.path.dirname(__file__))
+parsers = os.path.join(here, 'moredata', 'parsers')
+prms = os.path.join(here, '..', 'garleek', 'data', 'prm')
 
-def test_prepare_tinker_xyz():
-    pass
 
+@pytest.fixture
+def fake_tinker(tmpdir, monkeypatch):
+    """
+    Replace TINKER programs with shell scripts that replay the outputs
+    stored in moredata/parsers.
+    """
+    scripts = {
+        'analyze': 'cat "{}"'.format(os.path.join(parsers, 'tinker_analyze.out')),
+        # gradients of the first 11 atoms, as many as in the Hessian
+        'testgrad': 'head -n 90 "{}"'.format(os.path.join(parsers, 'tinker_testgrad.out')),
+        'testhess': 'cp "{}" "${{1%.xyz}}.hes"'.format(os.path.join(parsers, 'tinker_testhess.out')),
+    }
+    executables = {}
+    for program, script in scripts.items():
+        path = tmpdir.join(program)
+        path.write('#!/bin/sh\n' + script + '\n')
+        path.chmod(path.stat().mode | stat.S_IEXEC)
+        executables[program] = str(path)
+    monkeypatch.setattr(tinker, '_executables', executables)
+    key = tmpdir.join('garleek.key')
+    key.write('parameters mm3\n')
+    return str(key)
 
-def test_prepare_tinker_inpkey():
-    pass
+
+def test_prepare_tinker_xyz(monkeypatch):
+    monkeypatch.setattr(tinker, '_xyz_templates', tinker.OrderedDict())
+    atoms = Atoms(['6', '1', '1'], ['C_3', 'H_', ''], np.eye(3), np.zeros(3))
+    bonds = Bonds.from_pairs(3, [1, 1, 2, 3], [2, 3, 1, 1], [1.0, 0.2, 1.0, 0.2])
+    xyz = tinker.prepare_tinker_xyz(atoms, bonds).splitlines()
+    assert xyz[0] == '3'
+    x = '{:.12f}'.format(u.RBOHR_TO_ANGSTROM)
+    assert xyz[1] == '1 E6 {} 0.000000000000 0.000000000000 C_3 2'.format(x)
+    assert xyz[2] == '2 E1 0.000000000000 {} 0.000000000000 H_ 1'.format(x)
+    assert xyz[3] == '3 E1 0.000000000000 0.000000000000 {} None '.format(x)
+    # same topology, new coordinates: the cached template is reused
+    atoms.xyz[:] = -atoms.xyz
+    xyz = tinker.prepare_tinker_xyz(dict(atoms), dict(bonds)).splitlines()
+    assert xyz[1].split()[2] == '-' + x
+    assert len(tinker._xyz_templates) == 1
+
+
+def test_prepare_tinker_key(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir.join('cache')))
+    prm = os.path.abspath(os.path.join(prms, 'mm3.prm'))
+    key = tinker.prepare_tinker_key(prm)
+    assert key.startswith(str(tmpdir.join('cache', 'keys')))
+    with open(key) as f:
+        assert f.read() == 'parameters {}\n'.format(prm)
+    # reused without rewriting
+    mtime = os.path.getmtime(key)
+    assert tinker.prepare_tinker_key(prm) == key
+    assert os.path.getmtime(key) == mtime
+    # key files are used as is
+    keyfile = tmpdir.join('custom.key')
+    keyfile.write('parameters mm3\nvdwindex class\n')
+    assert tinker.prepare_tinker_key(str(keyfile)) == str(keyfile)
+
+
+def test_prepare_tinker_key_threads(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir.join('cache')))
+    prm = os.path.abspath(os.path.join(prms, 'mm3.prm'))
+    key = tinker.prepare_tinker_key(prm, threads=4)
+    with open(key) as f:
+        assert f.read() == 'parameters {}\nopenmp-threads 4\n'.format(prm)
+    assert tinker.prepare_tinker_key(prm, threads=2) != key
+    # key files are not used as is, and never overwritten
+    keyfile = tmpdir.join('custom.key')
+    keyfile.write('parameters mm3\nvdwindex class\n')
+    cache = tmpdir.join('unwritable')
+    cache.write('')
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(cache))
+    key = tinker.prepare_tinker_key(str(keyfile), threads=2)
+    assert key == str(tmpdir.join('custom.garleek.key'))
+    with open(key) as f:
+        assert f.read() == 'parameters {}\nvdwindex class\nopenmp-threads 2\n'.format(
+            os.path.abspath(os.path.join(prms, 'mm3.prm')))
+    assert keyfile.read() == 'parameters mm3\nvdwindex class\n'
+
+
+def test_prepare_tinker_key_stage(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.setenv('GARLEEK_STAGE_DIR', str(tmpdir.join('stage')))
+    shared = tmpdir.mkdir('shared')
+    with open(os.path.join(prms, 'mm3.prm')) as f:
+        shared.join('mm3.prm').write(f.read())
+    keyfile = shared.join('custom.key')
+    keyfile.write('parameters mm3\nvdwindex class\n')
+    for forcefield in (shared.join('mm3.prm'), keyfile):
+        key = tinker.prepare_tinker_key(str(forcefield), stage=True)
+        assert key.startswith(str(tmpdir.join('stage')))
+        with open(key) as f:
+            lines = f.read().splitlines()
+        assert lines[0].split()[1].startswith(str(tmpdir.join('stage')))
+        assert lines[0].split()[1].endswith('-mm3.prm')
+        assert tinker.prepare_tinker_key(str(forcefield), stage=True) == key
+
+
+def test_prepare_tinker_key_qmcharges(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('local.prm').write('atom 1 1 C "C" 6 12.0 4\n')
+    keyfile = tmpdir.join('custom.key')
+    keyfile.write('parameters local\nvdwindex class')
+    atoms = Atoms(['6', '1'], ['1', '1'], np.zeros((2, 3)), [0.5, -0.25])
+    key = tinker.prepare_tinker_key(str(keyfile), atoms=atoms, version='qmcharges')
+    with open(key) as f:
+        assert f.read() == ('parameters {}\nvdwindex class\n\n'
+                            'CHARGE -1 0.5\nCHARGE -2 -0.25\n').format(tmpdir.join('local.prm'))
+    assert tinker.prepare_tinker_key(str(keyfile), atoms=atoms, version='qmcharges') == key
+    atoms.charges[0] = 0.4
+    assert tinker.prepare_tinker_key(str(keyfile), atoms=atoms, version='qmcharges') != key
+
+
+def test_prepare_tinker_key_trim(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir.join('cache')))
+    prm = os.path.abspath(os.path.join(prms, 'amber99sb.prm'))
+    atoms = Atoms(['6', '1'], ['1', '3'], np.zeros((2, 3)), [0, 0])
+    key = tinker.prepare_tinker_key(prm, atoms=atoms, trim=True)
+    with open(key) as f:
+        trimmed = f.read().split()[1]
+    assert trimmed.startswith(str(tmpdir.join('cache', 'prm')))
+    assert os.path.getsize(trimmed) < os.path.getsize(prm) / 10
+    model, full = fixed_charge_model(trimmed), fixed_charge_model(prm)
+    assert model['charges'] == dict((t, full['charges'][t]) for t in ('1', '3'))
+    assert tinker.prepare_tinker_key(prm, atoms=atoms, trim=True) == key
+    # undefined types: no trimming
+    atoms = Atoms(['6', '1'], ['1', '99999'], np.zeros((2, 3)), [0, 0])
+    key = tinker.prepare_tinker_key(prm, atoms=atoms, trim=True)
+    with open(key) as f:
+        assert f.read().split()[1] == prm
+
+
+def test_prepare_tinker_key_no_cache(tmpdir, monkeypatch):
+    cache = tmpdir.join('cache')
+    cache.write('not a directory')
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(cache))
+    monkeypatch.chdir(tmpdir)
+    prm = os.path.join(prms, 'mm3.prm')
+    atoms = Atoms(['6'], ['1'], np.zeros((1, 3)), [0.5])
+    assert tinker.prepare_tinker_key(prm) == str(tmpdir.join('garleek.key'))
+    key = tinker.prepare_tinker_key(prm, atoms=atoms, version='qmcharges')
+    assert key == str(tmpdir.join('garleek.charges.key'))
+    assert tmpdir.join('garleek.charges.key').read().endswith('CHARGE -1 0.5\n')
+    # With a scratch directory, nothing is written to the working directory
+    scratch = tmpdir.mkdir('scratch')
+    key = tinker.prepare_tinker_key(prm, atoms=atoms, version='qmcharges', scratch=str(scratch))
+    assert key == str(scratch.join('garleek.charges.key'))
+    keyfile = tmpdir.join('custom.key')
+    keyfile.write('parameters mm3\n')
+    key = tinker.prepare_tinker_key(str(keyfile), atoms=atoms, threads=2, scratch=str(scratch))
+    assert key == str(scratch.join('custom.key'))
 
 
 @pytest.mark.parametrize("path, energy, dipole", [
@@ -30,18 +194,310 @@ def test__parse_tinker_testgrad(path, last_value):
     with open(path) as f:
         data = _parse_tinker_testgrad(f.read())
         assert data[-1][-1] == last_value
+    # Streaming, preallocated
+    with open(path) as f:
+        streamed = _parse_tinker_testgrad(f, n_atoms=148)
+        assert (streamed == data).all()
+        # stops reading after the gradients block
+        assert next(f).startswith(' Total Gradient Norm')
 
 
 @pytest.mark.parametrize("path, natoms, last_diagonal, last_off_diagonal", [
     ["moredata/parsers/tinker_testhess.out", 11, 85.5836, -0.4860]
 ])
 def test__parse_tinker_testhess(path, natoms, last_diagonal, last_off_diagonal):
-    data = _parse_tinker_testhess(path, natoms)
-    print(data)
-    assert data[-1][-1] == last_diagonal
-    assert data[-1][-2] == last_off_diagonal
+    hessian = _parse_tinker_testhess(path, natoms)
+    data = np.asarray(hessian)
+    size = 3 * natoms
+    assert hessian.n_coords == size
+    assert data.shape == (size * (size + 1) // 2,)
+    # packed lower triangle, row-major: H[0,0], H[1,0], H[1,1], H[2,0]...
+    assert data[0] == 1293.5738
+    assert data[1] == -65.8964
+    assert data[2] == 1227.6764
+    assert data[3] == -114.1621
+    assert data[-1] == last_diagonal
+    assert data[-2] == last_off_diagonal
+    with open(path) as f:
+        assert (np.asarray(_parse_tinker_testhess(f, natoms)) == data).all()
+
+
+@pytest.mark.parametrize("digits, fmt", [(4, '{:12.4f}'), (6, '{:14.6f}'), (8, '{:16.8f}')])
+def test__decode_fixed_width(digits, fmt):
+    values = [1.5, -123456.25, -0.5, 1234567.5]  # fields can run together
+    block = '\n{}{}\n{}{}\n'.format(*[fmt.format(v) for v in values])
+    assert np.allclose(tinker._decode_fixed_width(block), values)
+
+
+def test_run_tinker(fake_tinker, tmpdir):
+    scratch = tmpdir.mkdir('scratch')
+    results = run_tinker('', 11, fake_tinker, energy=True, dipole_moment=True,
+                         gradients=True, hessian=True, jobs=2, scratch=str(scratch))
+    assert scratch.listdir() == []
+    assert results['energy'] == -2.6773
+    assert results['gradients'][-1][-1] == 3.5223
+    assert results['hessian'][32, 32] == 85.5836
+
+
+def test_run_tinker_fd_hessian(fake_tinker, tmpdir, monkeypatch):
+    atoms = Atoms(['6'] * 11, ['1'] * 11, np.random.RandomState(0).rand(11, 3), np.zeros(11))
+    xyz = tinker.prepare_tinker_xyz(atoms)
+    template, coordinates = tinker._coordinates_template(xyz, 11)
+    assert (template % tuple(coordinates.ravel())).split() == xyz.split()
+    assert np.allclose(coordinates, atoms.xyz * u.RBOHR_TO_ANGSTROM)
+    # testhess is not run; the replayed gradients never change
+    os.remove(tinker._executables['testhess'])
+    monkeypatch.setattr(tinker, '_make_fifo', None)  # no pipe for it either
+    scratch, checkpoints = tmpdir.mkdir('scratch'), tmpdir.join('checkpoints')
+    results = run_tinker(xyz, 11, fake_tinker, energy=True, dipole_moment=False,
+                         gradients=True, hessian=True, scratch=str(scratch),
+                         hessian_method='fd', hessian_processes=1,
+                         hessian_checkpoint=str(checkpoints), exchange='memory')
+    assert results['hessian'].n_coords == 33
+    assert (results['hessian'].data == 0).all()
+    assert results['gradients'].shape == (11, 3)
+    assert scratch.listdir() == [] and checkpoints.listdir() == []
+    with pytest.raises(ValueError):
+        run_tinker(xyz, 11, fake_tinker, hessian_method='guess')
+
+
+@pytest.mark.skipif(not hasattr(os, 'sched_getaffinity'), reason='Needs CPU affinity')
+def test_run_tinker_programs_affinity():
+    before = os.sched_getaffinity(0)
+    cpus = sorted(before)[:1]
+    command = [sys.executable, '-c', 'import os; print(sorted(os.sched_getaffinity(0)))']
+    results = _run_tinker_programs([(command, lambda out, cmd: {'cpus': ''.join(out).strip()})],
+                                   cpus=cpus)
+    assert results['cpus'] == str(cpus)
+    assert os.sched_getaffinity(0) == before  # only the launching threads are pinned
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='Needs named pipes')
+@pytest.mark.parametrize("hes_suffix", ['.hes', '.hes_2'])
+def test_run_tinker_memory(fake_tinker, tmpdir, monkeypatch, hes_suffix):
+    monkeypatch.setattr(tinker, '_fifo_unsupported', set())
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir.join('cache')))
+    scratch = tmpdir.mkdir('scratch')
+    kwargs = dict(energy=True, dipole_moment=True, gradients=True, hessian=True,
+                  scratch=str(scratch))
+    expected = run_tinker('11\n', 11, fake_tinker, **kwargs)
+    executables = dict(tinker._executables)
+    # Programs read the XYZ through its path; testhess writes to the pipe
+    # or, like some builds do if the file exists, to a new version
+    xyz = tmpdir.join('xyz.out')
+    script = tmpdir.join('analyze-xyz')
+    script.write('#!/bin/sh\ncat "$1" > "{}"\n{}\n'.format(
+                 xyz, open(executables['analyze']).read().splitlines()[1]))
+    script.chmod(0o755)
+    executables['analyze'] = str(script)
+    script = tmpdir.join('testhess-version')
+    script.write('#!/bin/sh\ncp "{}" "${{1%.xyz}}{}"\n'.format(
+                 os.path.join(parsers, 'tinker_testhess.out'), hes_suffix))
+    script.chmod(0o755)
+    executables['testhess'] = str(script)
+    monkeypatch.setattr(tinker, '_executables', executables)
+    results = run_tinker('11\n', 11, fake_tinker, exchange='memory', **kwargs)
+    assert xyz.read() == '11\n'
+    assert np.array_equal(results['hessian'].data, expected['hessian'].data)
+    assert results['energy'] == expected['energy']
+    assert scratch.listdir() == []
+    assert bool(tinker._fifo_unsupported) == (hes_suffix != '.hes')
+    # Later processes do not try pipes with that testhess either
+    monkeypatch.setattr(tinker, '_fifo_unsupported', set())
+    assert tinker._fifo_supported(str(script)) == (hes_suffix == '.hes')
+    monkeypatch.setattr(tinker, '_fifo_unsupported', set())
+    script.setmtime(script.mtime() - 10)  # rebuilt
+    assert tinker._fifo_supported(str(script))
+    with pytest.raises(ValueError):
+        run_tinker('11\n', 11, fake_tinker, exchange='carrier-pigeon', **kwargs)
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='Needs named pipes')
+def test_read_hessian_fifo_early_exit(tmpdir):
+    # testhess exits (here, immediately) before anything opens the pipe
+    class Exited(object):
+        process = type('Process', (), {'returncode': 0})
+
+        def wait(self):
+            return 0
+
+        def tail(self):
+            return ''
+
+    hesfile = str(tmpdir.join('early.hes'))
+    os.mkfifo(hesfile)
+    outcomes = []
+
+    def read():
+        for _ in range(200):
+            outcomes.append(tinker._read_hessian_fifo(hesfile, 11, Exited(), ['testhess']))
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    reader.join(60)
+    assert not reader.is_alive(), 'Reading the Hessian pipe blocked'
+    assert outcomes == [None] * 200
+
+
+def test_patch_tinker_output_for_inactive_atoms():
+    n_atoms = 3
+    hessian = PackedHessian.from_dense(np.arange(81.).reshape(9, 9) + 1)
+    results = {'gradients': np.ones((2, 3)), 'hessian': hessian}
+    results = tinker.patch_tinker_output_for_inactive_atoms(results, [2], n_atoms)
+    assert (results['gradients'][1] == 0).all()
+    assert results['gradients'].sum() == 6
+    dense = results['hessian'].dense()
+    assert (dense[3:6] == 0).all() and (dense[:, 3:6] == 0).all()
+    assert dense[8, 0] == 73
+
+
+@pytest.mark.parametrize("derivatives, dipole, programs", [
+    [0, True, ['analyze']],
+    [0, False, ['analyze']],
+    [1, True, ['analyze', 'testgrad']],
+    [1, False, ['testgrad']],
+    [2, False, ['testgrad', 'testhess']],
+])
+def test_plan_tinker_programs(derivatives, dipole, programs):
+    plan = tinker.plan_tinker_programs(energy=True, dipole_moment=dipole,
+                                       gradients=derivatives > 0, hessian=derivatives == 2)
+    assert [program for (program, _) in plan] == programs
+    provided = set(p for (_, provides) in plan for p in provides)
+    assert 'energy' in provided
+    assert ('dipole_moment' in provided) == dipole
+
+
+def test__parse_tinker_energy():
+    with open(os.path.join(parsers, 'tinker_testgrad.out')) as f:
+        assert tinker._parse_tinker_energy(f.read()) == 34773.4951
+
+
+@pytest.mark.parametrize("qmcharges", [False, True])
+def test_tinker_dipole_moment(tmpdir, qmcharges):
+    key = tmpdir.join('test.key')
+    key.write('parameters {}\n'.format(os.path.join(prms, 'amber99sb.prm')))
+    if qmcharges:
+        key.write('CHARGE -1 0.5\n', mode='a')
+    atoms = {1: {'type': '1', 'xyz': np.array([0.0, 0.0, 0.0]), 'charge': 0.5},
+             2: {'type': '3', 'xyz': np.array([2.0, 1.0, 0.0]), 'charge': 0.0}}
+    xyz = np.array([[0.0, 0.0, 0.0], [2.0, 1.0, 0.0]]) * u.RBOHR_TO_ANGSTROM
+    charges = np.array([0.5 if qmcharges else -0.4157, 0.5973])
+    masses = np.array([14.010, 12.010])
+    com = np.dot(masses, xyz) / masses.sum()
+    expected = np.dot(charges, xyz - com) * u.EANGSTROM_TO_DEBYES
+    assert np.allclose(tinker.tinker_dipole_moment(str(key), atoms), expected)
+
+
+@pytest.mark.parametrize("forcefield, types", [
+    ('amber99sb.prm', ['1', '3', '34']),
+    ('mm3.prm', ['1', '5', '7']),
+    ('oplsaa.prm', ['1', '2', '3']),  # vdwindex type
+    ('charmm22.prm', ['1', '3']),
+])
+def test_trim_tinker_parameters(tmpdir, forcefield, types):
+    path = os.path.join(prms, forcefield)
+    trimmed = tmpdir.join('trimmed.prm')
+    trimmed.write(trim_tinker_parameters(path, types))
+    full = list(iter_tinker_records(path))
+    kept = list(iter_tinker_records(str(trimmed)))
+    classes = set(f[1] for (k, f) in full if k == 'atom' and f[0] in types) | set(['0'])
+    vdw = types if ('vdwindex', ['TYPE']) in full else classes
+    expected = []
+    for keyword, fields in full:
+        n = CLASS_INDEXED_RECORDS.get(keyword, VDW_INDEXED_RECORDS.get(keyword))
+        if keyword in ('atom', 'charge', 'biotype'):
+            if (fields[-1] if keyword == 'biotype' else fields[0]) not in types:
+                continue
+        elif keyword in VDW_INDEXED_RECORDS:
+            if not set(fields[:n]).issubset(vdw):
+                continue
+        elif keyword in EITHER_INDEXED_RECORDS:
+            if not set(fields[:2]).issubset(classes | set(types)):
+                continue
+        elif n is not None and not set(fields[:n]).issubset(classes):
+            continue
+        expected.append((keyword, fields))
+    assert kept == expected
+    assert len([k for (k, _) in kept if k == 'atom']) == len(types)
+    assert trimmed.size() < os.path.getsize(path) / 10
+
+
+@pytest.mark.parametrize("forcefield, types", [('mmff.prm', ['1']), ('mm3.prm', ['99999'])])
+def test_trim_tinker_parameters_unsafe(forcefield, types):
+    assert trim_tinker_parameters(os.path.join(prms, forcefield), types) is None
+
+
+def test_parameter_database(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.setattr(prmdb, '_databases', {})
+    path = os.path.join(prms, 'amber99sb.prm')
+    db = prmdb.parameter_database(path)
+    assert db.path.startswith(str(tmpdir.join('cache', 'prmdb')))
+    assert prmdb.parameter_database(path) is db
+    records = list(iter_tinker_records(path))
+    atoms = [f for (k, f) in records if k == 'atom']
+    assert db.atom('1') == (atoms[0][1], float(atoms[0][-2]))
+    assert db.atom('99999') is None
+    assert db.charge('1') == [float(f[1]) for (k, f) in records if k == 'charge'][0]
+    bond = [f for (k, f) in records if k == 'bond'][0]
+    assert db.records('bond', *bond[:2]) == [bond]
+    assert db.keywords['atom'] == len(atoms)
+    assert [(k, line.split()[1:]) for (k, _, _, line) in db.lines()] == records
+    # Rebuilt when the contents change
+    copy = tmpdir.join('copy.prm')
+    copy.write('atom 1 1 C "Carbon" 6 12.000 4\ncharge 1 0.5\n')
+    assert prmdb.parameter_database(str(copy)).charge('1') == 0.5
+    copy.write('atom 1 1 C "Carbon" 6 12.000 4\ncharge 1 -0.25\n')
+    os.utime(str(copy), (0, 0))
+    assert prmdb.parameter_database(str(copy)).charge('1') == -0.25
+    assert len(tmpdir.join('cache', 'prmdb').listdir()) == 3
+
+
+@pytest.mark.parametrize("forcefield", ['amber99sb.prm', 'mm3.prm', 'amoeba09.prm'])
+def test_fixed_charge_model_database(tmpdir, monkeypatch, forcefield):
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir.join('cache')))
+    key = tmpdir.join('ff.key')
+    key.write('parameters {}\ncharge -2 0.125\natom 1 1 C "Carbon" 6 13.000 4\n'.format(
+              os.path.join(prms, forcefield)))
+    monkeypatch.setattr(prm_module, '_charge_models', {})
+    compiled = fixed_charge_model(str(key))
+    assert prm_module.atom_classes(str(key))['1'] == '1'
+    monkeypatch.setattr(prm_module, '_charge_models', {})
+    monkeypatch.setattr(prmdb, 'sqlite3', None)
+    assert fixed_charge_model(str(key)) == compiled
+    if compiled is not None:
+        assert compiled['atom_charges'] == {2: 0.125}
+        assert compiled['masses']['1'] == 13.0
+
+
+@pytest.mark.parametrize("forcefield", ['mm3.prm', 'amoeba09.prm', 'mmff.prm'])
+def test_tinker_dipole_moment_fallback(forcefield):
+    atoms = {1: {'type': '1', 'xyz': np.zeros(3), 'charge': 0.0}}
+    assert tinker.tinker_dipole_moment(os.path.join(prms, forcefield), atoms) is None
+
+
+def test_run_tinker_programs_errors():
+    # Like TINKER, die of SIGPIPE if the output is closed before the end
+    ok = [sys.executable, '-c', 'import signal; signal.signal(signal.SIGPIPE, signal.SIG_DFL); '
+                                'print("fine")']
+    fail = [sys.executable, '-c', 'import sys; sys.exit(3)']
+    results = _run_tinker_programs([(ok, lambda out, cmd: {'a': ''.join(out).strip()}),
+                                    (ok, lambda out, cmd: {'b': 1})])
+    assert results == {'a': 'fine', 'b': 1}
+    # A parser not finding its data in a failed program reports the exit status
+    with pytest.raises(CalledProcessError):
+        _run_tinker_programs([(fail, lambda out, cmd: tinker._parse_tinker_analyze(out)[0] + 1)])
+    # Data reported by a program that failed afterwards is not trusted
+    crash = [sys.executable, '-c', 'print("partial"); import sys; sys.stdout.flush(); sys.exit(2)']
+    with pytest.raises(CalledProcessError):
+        _run_tinker_programs([(crash, lambda out, cmd: {'a': next(iter(out))})])
 
 
-def test_run_tinker():
-    pass
+def test_run_tinker_truncated_gradients(fake_tinker):
+    with open(tinker._executables['testgrad'], 'w') as f:
+        f.write('#!/bin/sh\nhead -n 85 "{}"\n'.format(os.path.join(parsers, 'tinker_testgrad.out')))
+    with pytest.raises(ValueError, match='gradients'):
+        run_tinker('', 11, fake_tinker, energy=True, dipole_moment=False, gradients=True,
+                   hessian=False)
 
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import numpy as np
+import pytest
+from garleek.mm.neighbors import all_pairs, pairs, within
+
+
+def _points(n, seed=0, size=20.0):
+    return np.random.RandomState(seed).uniform(0, size, (n, 3))
+
+
+@pytest.mark.parametrize('cutoff', [None, 0.5, 3.0, 100.0])
+def test_pairs(cutoff):
+    xyz = _points(500)
+    i, j = pairs(xyz, cutoff)
+    expected_i, expected_j = np.triu_indices(len(xyz), 1)
+    if cutoff is not None:
+        close = np.linalg.norm(xyz[expected_i] - xyz[expected_j], axis=1) < cutoff
+        expected_i, expected_j = expected_i[close], expected_j[close]
+    assert np.array_equal(i, expected_i)
+    assert np.array_equal(j, expected_j)
+
+
+def test_pairs_few_points():
+    assert [len(a) for a in pairs(np.zeros((0, 3)), 1.0)] == [0, 0]
+    assert [len(a) for a in pairs(np.zeros((1, 3)), 1.0)] == [0, 0]
+    i, j = pairs([[0, 0, 0], [0, 0, 0.5], [0, 0, 2]], 1.0)
+    assert list(i) == [0] and list(j) == [1]
+
+
+@pytest.mark.parametrize('n, chunk', [(0, 10), (1, 10), (2, 10), (50, 1), (50, 100), (50, 5000)])
+def test_all_pairs(n, chunk):
+    blocks = list(all_pairs(n, chunk))
+    expected_i, expected_j = np.triu_indices(n, 1)
+    assert np.array_equal(np.concatenate([i for (i, _) in blocks] or [[]]), expected_i)
+    assert np.array_equal(np.concatenate([j for (_, j) in blocks] or [[]]), expected_j)
+    assert all(len(i) <= max(chunk, n - 1) for (i, _) in blocks)
+
+
+def test_within():
+    xyz = _points(500)
+    centers = _points(3, seed=1)
+    distances = np.linalg.norm(xyz[:, None] - centers[None], axis=2)
+    assert np.array_equal(within(xyz, centers, 4.0), np.nonzero((distances < 4.0).any(1))[0])
+    assert not len(within(xyz, [], 4.0))
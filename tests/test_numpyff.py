@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import json
+import os
+import numpy as np
+import pytest
+from garleek import connectors, units as u
+from garleek.hessian import PackedHessian
+from garleek.mm import numpyff
+from garleek.mm.tinker import (_parse_tinker_analyze, _parse_tinker_testgrad,
+                               prepare_tinker_key, prepare_tinker_xyz, run_tinker,
+                               tinker_executable)
+from garleek.qm.gaussian import parse_gaussian_EIn
+from garleek.qm.structure import Atoms, Bonds
+
+here = os.path.abspath(os.path.dirname(__file__))
+eins = os.path.join(here, 'moredata', 'EIns')
+prms = os.path.join(here, '..', 'garleek', 'data', 'prm')
+
+# N-methylacetamide, CH3-C(=O)-NH-CH3, with AMBER and CHARMM types
+NMA_XYZ = [[0.00, 0.00, 0.00], [-0.36, 1.02, 0.05], [-0.38, -0.52, 0.88],
+           [-0.37, -0.50, -0.90], [1.52, 0.00, 0.00], [2.12, 1.06, 0.02],
+           [2.20, -1.16, -0.03], [1.70, -2.03, -0.05], [3.66, -1.24, 0.01],
+           [4.02, -2.27, 0.05], [4.05, -0.70, 0.88], [4.04, -0.73, -0.89]]
+NMA_BONDS = [(1, 2), (1, 3), (1, 4), (1, 5), (5, 6), (5, 7), (7, 8), (7, 9), (9, 10),
+             (9, 11), (9, 12)]
+# Acetic acid, CH3-C(=O)-O-H, with OPLS-AA types
+ACETIC_XYZ = [[0.0, 0.0, 0.0], [1.52, 0.0, 0.0], [2.12, 1.05, 0.03], [2.20, -1.15, -0.02],
+              [3.15, -1.05, 0.05], [-0.36, 1.02, 0.05], [-0.38, -0.52, 0.88],
+              [-0.37, -0.50, -0.90]]
+ACETIC_BONDS = [(1, 2), (2, 3), (2, 4), (4, 5), (1, 6), (1, 7), (1, 8)]
+SYSTEMS = {
+    'amber99sb.prm': (NMA_XYZ, [340, 341, 341, 341, 342, 343, 346, 347, 348, 349, 349, 349],
+                      NMA_BONDS),
+    'charmm22.prm': (NMA_XYZ, [27, 1, 1, 1, 20, 74, 63, 3, 27, 1, 1, 1], NMA_BONDS),
+    'oplsaa.prm': (ACETIC_XYZ, [80, 209, 210, 211, 212, 85, 85, 85], ACETIC_BONDS),
+}
+
+
+def _system(forcefield, copies=1, spacing=4.0, seed=1):
+    """
+    Atoms and bonds of the test system for ``forcefield``, slightly
+    distorted, replicated ``copies`` times along z.
+    """
+    xyz, types, bonds = SYSTEMS[forcefield]
+    n = len(types)
+    rng = np.random.RandomState(seed)
+    xyz = np.concatenate([np.array(xyz) + [0, 0, spacing * c] for c in range(copies)])
+    xyz += rng.uniform(-0.05, 0.05, xyz.shape)
+    first = [i + c * n for c in range(copies) for (i, j) in bonds]
+    second = [j + c * n for c in range(copies) for (i, j) in bonds]
+    atoms = Atoms(['6'] * n * copies, [str(t) for t in types] * copies,
+                  xyz / u.RBOHR_TO_ANGSTROM, np.zeros(n * copies))
+    return atoms, Bonds.from_pairs(n * copies, first + second, second + first,
+                                   np.ones(2 * len(first)))
+
+
+def _check_derivatives(model, xyz, step=1e-5):
+    energy, gradients, hessian = numpyff.evaluate(model, xyz, derivatives=2)
+    fd_gradients = np.zeros(xyz.size)
+    fd_hessian = np.zeros((xyz.size, xyz.size))
+    for k in range(xyz.size):
+        displaced = []
+        for sign in (1, -1):
+            moved = xyz.copy()
+            moved.flat[k] += sign * step
+            displaced.append(numpyff.evaluate(model, moved, derivatives=1))
+        fd_gradients[k] = (displaced[0][0] - displaced[1][0]) / (2 * step)
+        fd_hessian[k] = (displaced[0][1] - displaced[1][1]).ravel() / (2 * step)
+    assert np.allclose(gradients.ravel(), fd_gradients, atol=1e-5)
+    assert np.allclose(hessian.dense(), fd_hessian, atol=1e-5)
+    assert numpyff.evaluate(model, xyz)[0] == pytest.approx(energy)
+    return energy
+
+
+@pytest.mark.parametrize('forcefield', sorted(SYSTEMS))
+def test_numpyff_derivatives(forcefield):
+    atoms, bonds = _system(forcefield)
+    ff = numpyff.read_forcefield(os.path.join(prms, forcefield))
+    model = numpyff.build_model(ff, atoms, bonds)
+    assert len(model['springs'][0]) >= len(bonds.neighbors) // 2
+    assert len(model['angles'][0]) and len(model['torsions'][0])
+    _check_derivatives(model, atoms.xyz * u.RBOHR_TO_ANGSTROM)
+
+
+def test_numpyff_cutoff(tmpdir):
+    atoms, bonds = _system('amber99sb.prm', copies=4)
+    xyz = atoms.xyz * u.RBOHR_TO_ANGSTROM
+    energies = {}
+    for cutoff in (None, 100.0, 6.0):
+        key = tmpdir.join('{}.key'.format(cutoff))
+        key.write('parameters {}\n'.format(os.path.join(prms, 'amber99sb.prm')) +
+                  ('cutoff {}\n'.format(cutoff) if cutoff else ''))
+        model = numpyff.build_model(numpyff.read_forcefield(str(key)), atoms, bonds)
+        energies[cutoff] = _check_derivatives(model, xyz)
+    # Pairs closer than where switching starts are not affected
+    assert energies[100.0] == pytest.approx(energies[None])
+    assert energies[6.0] != pytest.approx(energies[None], abs=1e-6)
+
+
+def test_numpyff_unsupported(tmpdir):
+    with pytest.raises(ValueError, match='not a class I forcefield'):
+        numpyff.read_forcefield(os.path.join(prms, 'mm3.prm'))
+    key = tmpdir.join('buffered.key')
+    key.write('parameters {}\nvdwtype buffered-14-7\n'.format(
+              os.path.join(prms, 'amber99sb.prm')))
+    with pytest.raises(ValueError, match='vdwtype BUFFERED-14-7'):
+        numpyff.read_forcefield(str(key))
+    # Interactions between inactive atoms would be computed anyway
+    key = tmpdir.join('inactive.key')
+    key.write('parameters {}\ninactive 1 2 3\n'.format(os.path.join(prms, 'amber99sb.prm')))
+    with pytest.raises(ValueError, match='`inactive` atoms'):
+        numpyff.read_forcefield(str(key))
+
+
+def test_run_numpyff():
+    atoms, bonds = _system('oplsaa.prm')
+    key = os.path.join(prms, 'oplsaa.prm')
+    results = numpyff.run_numpyff(atoms, bonds, key, gradients=True, hessian=True)
+    energy, gradients, hessian = numpyff.evaluate(
+        numpyff.build_model(numpyff.read_forcefield(key), atoms, bonds),
+        atoms.xyz * u.RBOHR_TO_ANGSTROM, derivatives=2)
+    assert results['energy'] == pytest.approx(energy)
+    assert np.allclose(results['gradients'], gradients)
+    assert np.allclose(results['hessian'].data, hessian.data)
+    assert results['dipole_moment'].shape == (3,)
+    # The model is reused for new coordinates
+    n_models = len(numpyff._models)
+    atoms.xyz[0, 0] += 0.1
+    assert numpyff.run_numpyff(atoms, bonds, key)['energy'] != pytest.approx(energy)
+    assert len(numpyff._models) == n_models
+
+
+def _methane_ein(tmpdir, derivatives=1):
+    """
+    Copy of a methane EIn file with AMBER types (alanine CB and HB),
+    requesting up to the given ``derivatives``.
+    """
+    with open(os.path.join(eins, 'A_1.EIn')) as f:
+        lines = f.read().splitlines()
+    lines[0] = '{:>10}{:>10}{:>10}{:>10}'.format(5, derivatives, 0, 1)
+    for i, amber in enumerate(['13', '14', '14', '14', '14'], 1):
+        lines[i] = lines[i].rsplit(None, 1)[0] + ' ' + amber
+    ein_filename = str(tmpdir.join('A_1.EIn'))
+    with open(ein_filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return ein_filename
+
+
+def test_gaussian_numpyff(tmpdir):
+    ein_filename = _methane_ein(tmpdir)
+    forcefield = os.path.join(prms, 'amber99sb.prm')
+    ein = parse_gaussian_EIn(ein_filename)
+    eou = connectors.CONNECTORS['gaussian']['numpyff'](
+        ['R', ein_filename, None], forcefield=forcefield, write_file=False,
+        cache_results=False)
+    energy = numpyff.run_numpyff(ein['atoms'], ein['bonds'], forcefield)['energy']
+    assert float(eou.split()[0].replace('D', 'E')) == pytest.approx(
+        energy * u.KCALMOL_TO_HARTREE)
+
+
+def test_gaussian_numpyff_fd_hessian(tmpdir):
+    ein_filename = _methane_ein(tmpdir, derivatives=2)
+    forcefield = os.path.join(prms, 'amber99sb.prm')
+    hessians = []
+    for method in ('analytic', 'fd'):
+        eou = connectors.gaussian_tinker(
+            ['R', ein_filename, None], forcefield=forcefield, write_file=False, engine='numpyff',
+            cache_results=False, hessian_method=method, hessian_processes=1)
+        hessians.append(np.array([float(v.replace('D', 'E')) for v in eou.split()[-45:]]))
+    assert np.allclose(hessians[0], hessians[1], atol=1e-5)
+
+
+@pytest.mark.parametrize('layer', ['R', 'M'])
+def test_gaussian_numpyff_phva(tmpdir, layer):
+    ein_filename = _methane_ein(tmpdir, derivatives=2)
+    forcefield = os.path.join(prms, 'amber99sb.prm')
+    hessians = []
+    for phva in (None, [3]):
+        eou = connectors.gaussian_tinker(
+            [layer, ein_filename, None], forcefield=forcefield, write_file=False, engine='numpyff',
+            cache_results=False, phva_atoms=phva, qm_atoms=[1], hessian_processes=1)
+        packed = np.array([float(v.replace('D', 'E')) for v in eou.split()[-120:]])
+        hessians.append(PackedHessian(15, packed).dense())
+    if layer == 'M':  # only the real system
+        assert np.array_equal(hessians[0], hessians[1])
+        return
+    active = np.zeros(15, dtype=bool)
+    active[0:3] = active[6:9] = True
+    block = np.outer(active, active)
+    assert np.allclose(hessians[1][block], hessians[0][block], atol=1e-5)
+    assert (hessians[1][~block] == 0).all()
+
+
+
+@pytest.mark.parametrize('forcefield', sorted(SYSTEMS))
+def test_numpyff_reference(forcefield):
+    # Generated once with moredata/numpyff/make_reference.py, an OpenMM build
+    # of the same conventions (imptors weights, 1-4 divisors, R-MIN, SIGMA and
+    # DIAMETER radii, electric, unit factors). It catches mistakes in reading
+    # the PRM files, not departures from TINKER: see test_numpyff_recorded_tinker
+    with open(os.path.join(here, 'moredata', 'numpyff', 'reference.json')) as f:
+        reference = json.load(f)[forcefield]
+    n = len(reference['types'])
+    first, second = np.array(reference['bonds']).T
+    atoms = Atoms(['6'] * n, [str(t) for t in reference['types']],
+                  np.array(reference['xyz']) / u.RBOHR_TO_ANGSTROM, np.zeros(n))
+    bonds = Bonds.from_pairs(n, np.concatenate([first, second]),
+                             np.concatenate([second, first]), np.ones(2 * len(first)))
+    results = numpyff.run_numpyff(atoms, bonds, os.path.join(prms, forcefield),
+                                  dipole_moment=False, gradients=True)
+    assert results['energy'] == pytest.approx(reference['energy'], abs=1e-6)
+    assert np.allclose(results['gradients'], reference['gradients'], atol=1e-6)
+
+@pytest.mark.parametrize('forcefield', sorted(SYSTEMS))
+def test_numpyff_recorded_tinker(forcefield):
+    # Output of TINKER itself, recorded with moredata/numpyff/record_tinker.py
+    recorded = os.path.join(here, 'moredata', 'numpyff', 'tinker', forcefield)
+    if not os.path.isfile(recorded + '.testgrad'):
+        pytest.skip('TINKER output not recorded; run moredata/numpyff/record_tinker.py')
+    atoms, bonds = _system(forcefield)
+    with open(recorded + '.xyz') as f:
+        assert f.read() == prepare_tinker_xyz(atoms, bonds)
+    with open(recorded + '.analyze') as f:
+        energy = _parse_tinker_analyze(f.read())[0]
+    with open(recorded + '.testgrad') as f:
+        gradients = _parse_tinker_testgrad(f.read(), len(atoms))
+    results = numpyff.run_numpyff(atoms, bonds, os.path.join(prms, forcefield),
+                                  dipole_moment=False, gradients=True)
+    # TINKER prints energies with 4 decimals and gradients with 4-6
+    assert results['energy'] == pytest.approx(energy, abs=1e-3)
+    assert np.allclose(results['gradients'], gradients, atol=1e-3)
+
+
+@pytest.mark.skipif(not tinker_executable('testgrad'), reason='Needs TINKER')
+@pytest.mark.parametrize('forcefield', sorted(SYSTEMS))
+def test_numpyff_against_tinker(forcefield):
+    atoms, bonds = _system(forcefield)
+    key = prepare_tinker_key(os.path.join(prms, forcefield))
+    xyz = prepare_tinker_xyz(atoms, bonds)
+    reference = run_tinker(xyz, n_atoms=len(atoms), key=key, energy=True,
+                           dipole_moment=False, gradients=True, hessian=True)
+    results = numpyff.run_numpyff(atoms, bonds, key, dipole_moment=False, gradients=True,
+                                  hessian=True)
+    # TINKER prints energies with 4 decimals and gradients with 4-6
+    assert results['energy'] == pytest.approx(reference['energy'], abs=1e-3)
+    assert np.allclose(results['gradients'], reference['gradients'], atol=1e-3)
+    assert np.allclose(results['hessian'].data, reference['hessian'].data, atol=1e-2)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+import numpy as np
+import pytest
+from garleek import connectors
+from garleek.mm import numpyff
+from garleek.mm import openmm as openmm_engine
+from test_numpyff import SYSTEMS, _system, _methane_ein, prms
+
+pytest.importorskip('openmm')
+
+
+def _in_tinker_units(results):
+    return connectors._openmm_to_tinker_units(dict(results))
+
+
+@pytest.mark.parametrize('forcefield', sorted(SYSTEMS))
+@pytest.mark.parametrize('cutoff', [None, 6.0])
+def test_run_openmm(forcefield, cutoff, tmpdir):
+    atoms, bonds = _system(forcefield, copies=3)
+    key = str(tmpdir.join('openmm.key'))
+    with open(key, 'w') as f:
+        f.write('parameters {}\n'.format(os.path.join(prms, forcefield)))
+        if cutoff:
+            f.write('cutoff {}\n'.format(cutoff))
+    reference = numpyff.run_numpyff(atoms, bonds, key, gradients=True, hessian=True)
+    # Double precision platform: same energy expression as numpyff
+    results = _in_tinker_units(openmm_engine.run_openmm(
+        atoms, bonds, key, gradients=True, hessian=True, platform='Reference'))
+    assert results['energy'] == pytest.approx(reference['energy'], abs=1e-8)
+    assert np.allclose(results['gradients'], reference['gradients'], atol=1e-8)
+    assert np.allclose(results['dipole_moment'], reference['dipole_moment'])
+    # Finite-difference Hessian
+    assert np.allclose(results['hessian'].data, reference['hessian'].data, atol=1e-2)
+    # Default CPU platform, in mixed precision
+    results = _in_tinker_units(openmm_engine.run_openmm(atoms, bonds, key, gradients=True))
+    assert results['energy'] == pytest.approx(reference['energy'], abs=1e-3)
+    assert np.allclose(results['gradients'], reference['gradients'], atol=1e-3)
+
+
+def test_openmm_context_reuse():
+    atoms, bonds = _system('amber99sb.prm')
+    key = os.path.join(prms, 'amber99sb.prm')
+    energy = openmm_engine.run_openmm(atoms, bonds, key, threads=1)['energy']
+    contexts = dict(openmm_engine._contexts)
+    atoms.xyz[0, 0] += 0.1
+    assert openmm_engine.run_openmm(atoms, bonds, key, threads=1)['energy'] != \
+        pytest.approx(energy)
+    assert openmm_engine._contexts == contexts
+
+
+def test_gaussian_openmm(tmpdir):
+    ein_filename = _methane_ein(tmpdir)
+    forcefield = os.path.join(prms, 'amber99sb.prm')
+    eous = [connectors.CONNECTORS['gaussian'][engine](
+            ['R', ein_filename, None], forcefield=forcefield, write_file=False,
+            cache_results=False, nproc=1) for engine in ('openmm', 'numpyff')]
+    energies = [float(eou.split()[0].replace('D', 'E')) for eou in eous]
+    assert energies[0] == pytest.approx(energies[1], abs=1e-8)
+
+
+def test_gaussian_openmm_fd_hessian(tmpdir):
+    ein_filename = _methane_ein(tmpdir, derivatives=2)
+    forcefield = os.path.join(prms, 'amber99sb.prm')
+    hessians = []
+    for engine, method in (('numpyff', 'analytic'), ('openmm', 'fd')):
+        eou = connectors.CONNECTORS['gaussian'][engine](
+            ['R', ein_filename, None], forcefield=forcefield, write_file=False,
+            cache_results=False, nproc=1, hessian_method=method, hessian_processes=2)
+        hessians.append(np.array([float(v.replace('D', 'E')) for v in eou.split()[-45:]]))
+    assert np.allclose(hessians[0], hessians[1], atol=1e-3)
@@ -1,17 +1,159 @@
 #!/usr/bin/env python
 
 from __future__ import print_function, division, absolute_import
+import os
+from collections import OrderedDict
 import pytest
+import numpy as np
+from garleek.hessian import PackedHessian
+from garleek.atom_types import parse as parse_atom_types
+from garleek.qm.gaussian import (prepare_gaussian_EOu, write_gaussian_EOu, parse_gaussian_EIn,
+                                 patch_gaussian_input)
+from garleek.qm.structure import Atoms, Bonds
+
+here = os.path.abspath(os.path.dirname(__file__))
+eous = os.path.join(here, 'moredata', 'EOs')
+eins = os.path.join(here, 'moredata', 'EIns')
+data = os.path.join(here, 'data')
+
+
+def _legacy_EOu(n_atoms, energy, dipole_moment, gradients=None, hessian=None):
+    # Line by line formatting, as done before the streaming writer
+    lines = [[energy] + list(dipole_moment)]
+    if gradients is not None:
+        lines.extend(gradients)
+    if hessian is not None:
+        polarizability, dipole_polarizability = np.zeros(6), np.zeros(9*n_atoms)
+        for data in (polarizability, dipole_polarizability, hessian):
+            lines.extend(data[i:i+3] for i in range(0, data.size, 3))
+    lines.append([])
+    return '\n'.join([('{: 20.12e}'*len(line)).format(*line) for line in lines])
 
 
 def test_patch_gaussian_input():
     pass
 
 
-def test_parse_gaussian_EIn():
-    pass
+@pytest.mark.parametrize("link0, options", [
+    ('%nprocshared=8\n', ' --nproc 8'),
+    ('%NProc=4\n%cpu=0-3,8\n', ' --nproc 4 --cpus 0-3,8'),
+    ('%mem=1GB\n', ''),
+])
+def test_patch_gaussian_input_processors(tmpdir, link0, options):
+    with open(os.path.join(data, 'A_1', 'A_1.in')) as f:
+        lines = f.readlines()
+    inp = tmpdir.join('A_1.in')
+    inp.write(link0 + ''.join(lines[1:]))
+    types = parse_atom_types(os.path.join(data, 'A_1', 'atom.types'))
+    patched = patch_gaussian_input(str(inp), types, forcefield='mm3.prm')
+    assert patched.count(link0) == 1
+    assert "--ff 'mm3.prm'{}\"".format(options) in patched
 
 
-def test_prepare_gaussian_EOu():
-    pass
+@pytest.mark.parametrize("high, radius, options", [
+    ('H', 3.0, ' --phva-atoms 10-11,14 --phva-radius 3.0 --qm-atoms 1-4"'),
+    ('H', None, ' --phva-atoms 10-11,14 --qm-atoms 1-4"'),
+    ('L', 3.0, '--nproc 8"'),  # no QM atoms, no partial Hessian
+])
+def test_patch_gaussian_input_phva(tmpdir, high, radius, options):
+    with open(os.path.join(data, 'A_5_freq', 'A_5_freq.in')) as f:
+        contents = f.read()
+    inp = tmpdir.join('A_5_freq.in')
+    inp.write(contents.replace(' H\n', ' {}\n'.format(high)))
+    types = parse_atom_types(os.path.join(data, 'A_5_freq', 'atom.types'))
+    patched = patch_gaussian_input(str(inp), types, phva_radius=radius,
+                                   phva_atoms=[14, 10, 11])
+    assert options in patched
+
+
+def _split_EIn(path):
+    # Straightforward field by field parse, for comparison
+    with open(path) as f:
+        header = list(map(int, next(f).split()))
+        atoms = [next(f).split() for _ in range(header[0])]
+        next(f)
+        bonds = [list(map(float, line.split())) for line in f if line.strip()]
+    return header, atoms, bonds
+
+
+@pytest.mark.parametrize("name", sorted(os.listdir(eins)))
+def test_parse_gaussian_EIn(name):
+    path = os.path.join(eins, name)
+    header, atoms, bonds = _split_EIn(path)
+    ein = parse_gaussian_EIn(path)
+    assert [ein[k] for k in ('n_atoms', 'derivatives', 'charge', 'spin')] == header
+    assert ein['atoms'].xyz.shape == (header[0], 3)
+    for i, fields in enumerate(atoms, 1):
+        atom = ein['atoms'][i]
+        assert atom['element'] == fields[0]
+        assert atom['type'] == fields[5]
+        assert (atom['xyz'] == np.array(fields[1:4], dtype=float)).all()
+        assert atom['charge'] == float(fields[4])
+    for fields in bonds:
+        expected = list(zip(map(int, fields[1::2]), fields[2::2]))
+        assert ein['bonds'][int(fields[0])] == expected
+    assert len(ein['bonds']) == header[0]
+
+
+@pytest.mark.parametrize("version", ['16', '09c'])
+def test_parse_gaussian_EIn_embedcharge(tmpdir, version):
+    atom_line = '{:>10}{:20.12f}{:20.12f}{:20.12f}{:20.12f} {}\n'
+    bond_prefix = '' if version == '16' else ' 0 {} 0 0 0 0'
+    lines = ['         3         2         1         1\n',
+             atom_line.format(6, 0, 0, 0, 0.1, 'C_3'),
+             atom_line.format(1, 1, 0, 0, -0.2, '#H_'),
+             # last one not fixed-width
+             '  8 0.5 0.5 0.5 0.3 O_2\n',
+             'Connectivity\n']
+    for bonds in (' 1 2 1.000 3 2.000', ' 2 1 1.000', ' 3 1 2.000'):
+        if bond_prefix:
+            bonds = bond_prefix.format(bonds.split()[0]) + ' ' + bonds.split(' ', 2)[2]
+        lines.append(bonds + '\n')
+    path = tmpdir.join('embed.EIn')
+    path.write(''.join(lines) + ' \n')
+    ein = parse_gaussian_EIn(str(path), version=version)
+    assert ein['n_atoms'] == 3 and ein['charge'] == 1
+    atoms, bonds = ein['atoms'], ein['bonds']
+    assert list(atoms) == [1, 2]
+    assert list(atoms.types) == ['C_3', 'O_2']
+    assert (atoms.xyz[1] == 0.5).all() and atoms[2]['charge'] == 0.3
+    assert dict(bonds) == {1: [(2, 2.0)], 2: [(1, 2.0)]}
+    assert (bonds.atoms() == [1, 2]).all()
+
+
+def test_structure_from_dict():
+    atoms = OrderedDict([(1, {'element': 'C', 'type': 'C_3', 'xyz': np.zeros(3), 'charge': 0.1}),
+                         (2, {'element': 'H', 'type': None, 'xyz': np.ones(3), 'charge': -0.1})])
+    columnar = Atoms.from_dict(atoms)
+    assert columnar[2]['type'] is None and (columnar[2]['xyz'] == 1).all()
+    bonds = Bonds.from_dict(OrderedDict([(1, [(2, 1.0)]), (2, [(1, 1.0)])]))
+    assert dict(bonds) == {1: [(2, 1.0)], 2: [(1, 1.0)]}
+    assert (bonds.indptr == [0, 1, 2]).all()
+
+
+@pytest.mark.parametrize("name", sorted(os.listdir(eous)))
+def test_prepare_gaussian_EOu(name):
+    with open(os.path.join(eins, name[:-4] + '.EIn')) as f:
+        n_atoms = int(f.readline().split()[0])
+    with open(os.path.join(eous, name)) as f:
+        original = f.read()
+    values = np.array(original.split(), dtype=float)
+    gradients = values[4:].reshape(-1, 3)
+    assert gradients.shape == (n_atoms, 3)
+    eou = prepare_gaussian_EOu(n_atoms, values[0], values[1:4], gradients=gradients)
+    assert eou == original
+
 
+def test_prepare_gaussian_EOu_hessian(tmpdir):
+    n_atoms = 7
+    rng = np.random.RandomState(0)
+    energy, dipole, gradients = -1.5, rng.randn(3), rng.randn(n_atoms, 3)
+    hessian = rng.randn(3*n_atoms, 3*n_atoms) * 1e-3
+    packed = PackedHessian.from_dense(hessian + hessian.T)
+    eou = prepare_gaussian_EOu(n_atoms, energy, dipole, gradients=gradients, hessian=packed)
+    assert eou == _legacy_EOu(n_atoms, energy, dipole, gradients, np.asarray(packed))
+    assert len(eou.splitlines()) == 1 + n_atoms + 2 + 3*n_atoms + packed.size // 3
+    path = tmpdir.join('out.EOu')
+    with open(str(path), 'w') as f:
+        write_gaussian_EOu(f, n_atoms, energy, dipole, gradients=gradients, hessian=packed)
+    assert path.read() == eou
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+from garleek import connectors, results
+from garleek.hessian import PackedHessian
+from garleek.qm.structure import Atoms, Bonds
+
+here = os.path.abspath(os.path.dirname(__file__))
+eins = os.path.join(here, 'moredata', 'EIns')
+prms = os.path.join(here, '..', 'garleek', 'data', 'prm')
+
+
+@pytest.fixture
+def cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.delenv('GARLEEK_RESULTS_CACHE_SIZE', raising=False)
+    return tmpdir.join('cache', 'results')
+
+
+def _results(n_atoms, derivatives, seed=0):
+    rng = np.random.RandomState(seed)
+    values = {'energy': rng.rand(), 'dipole_moment': rng.rand(3)}
+    if derivatives > 0:
+        values['gradients'] = rng.rand(n_atoms, 3)
+    if derivatives > 1:
+        values['hessian'] = PackedHessian.from_dense(rng.rand(3 * n_atoms, 3 * n_atoms))
+    return values
+
+
+def test_geometry_key():
+    atoms = Atoms(['6', '1'], ['1', '5'], [[0, 0, 0], [0, 0, 2.0]], [0, 0])
+    bonds = Bonds.from_pairs(2, [1, 2], [2, 1], [1, 1])
+    key = results.geometry_key(atoms, bonds, 'ff')
+    atoms.xyz[1, 2] += results.RESOLUTION / 10
+    assert results.geometry_key(atoms, bonds, 'ff') == key
+    assert results.geometry_key(atoms, dict(bonds), 'ff') == key
+    assert results.geometry_key(atoms, None, 'ff') != key
+    assert results.geometry_key(atoms, bonds, 'other ff') != key
+    atoms.xyz[1, 2] += 1e-4
+    assert results.geometry_key(atoms, bonds, 'ff') != key
+
+
+def test_load_store(cache):
+    assert results.load('a', 0) is None
+    stored = _results(3, 1)
+    results.store('a', 1, stored)
+    loaded = results.load('a', 1)
+    assert loaded['energy'] == stored['energy']
+    assert np.array_equal(loaded['gradients'], stored['gradients'])
+    # Lower levels are served by higher ones, without the extra derivatives
+    assert set(results.load('a', 0)) == set(['energy', 'dipole_moment'])
+    assert results.load('a', 2) is None
+    stored = _results(3, 2, seed=1)
+    results.store('a', 2, stored)
+    loaded = results.load('a', 2)
+    assert isinstance(loaded['hessian'], PackedHessian)
+    assert np.array_equal(loaded['hessian'].dense(), stored['hessian'].dense())
+    # Lower levels do not replace higher ones
+    results.store('a', 1, _results(3, 1, seed=2))
+    assert results.load('a', 2)['energy'] == stored['energy']
+    assert results.statistics() == {'hits': 4, 'misses': 2}
+
+
+def test_load_without_lock(cache, monkeypatch):
+    results.store('a', 0, _results(1, 0))
+
+    def locked():
+        raise AssertionError('lookups must not wait for the cache lock')
+    monkeypatch.setattr(results, '_locked', locked)
+    assert results.load('a', 0) is not None
+    assert results.load('b', 0) is None
+    assert results.statistics() == {'hits': 1, 'misses': 1}
+    assert not cache.listdir('.tmp-*')
+
+def test_eviction(cache, monkeypatch):
+    for i, key in enumerate('abc'):
+        results.store(key, 1, _results(1000, 1))
+        os.utime(str(cache.join(key + '.npz')), (i, i))
+    size = cache.join('a.npz').size()
+    monkeypatch.setenv('GARLEEK_RESULTS_CACHE_SIZE', str(3.5 * size / 1024 / 1024))
+    assert results.load('a', 1) is not None  # a is now the most recently used
+    results.store('d', 1, _results(1000, 1))
+    assert sorted(p.basename for p in cache.listdir('*.npz')) == ['a.npz', 'c.npz', 'd.npz']
+
+
+def test_oversized_entry(cache, monkeypatch):
+    results.store('a', 1, _results(10, 1))
+    size = cache.join('a.npz').size()
+    monkeypatch.setenv('GARLEEK_RESULTS_CACHE_SIZE', str(2.5 * size / 1024 / 1024))
+    results.store('b', 1, _results(1000, 1))
+    assert [p.basename for p in cache.listdir('*.npz')] == ['a.npz']
+    assert not cache.listdir('.tmp-*')
+
+
+def test_concurrent_statistics(cache):
+    script = ('import sys; sys.path.insert(0, {!r}); from garleek import results\n'
+              'for _ in range(50): results.load("missing", 0)').format(os.path.join(here, '..'))
+    processes = [subprocess.Popen([sys.executable, '-c', script]) for _ in range(4)]
+    assert [p.wait() for p in processes] == [0] * 4
+    assert results.statistics() == {'hits': 0, 'misses': 200}
+
+
+def test_disabled(cache, monkeypatch):
+    monkeypatch.setenv('GARLEEK_RESULTS_CACHE_SIZE', '0')
+    results.store('a', 0, _results(1, 0))
+    assert results.load('a', 0) is None
+    assert not cache.check()
+
+
+def test_gaussian_tinker_cache(cache, monkeypatch):
+    calls = []
+
+    def run_tinker(xyz, n_atoms, key, gradients=False, hessian=False, **kwargs):
+        calls.append((gradients, hessian))
+        return _results(n_atoms, 2 if hessian else int(gradients))
+
+    monkeypatch.setattr(connectors, 'run_tinker', run_tinker)
+    ein = os.path.join(eins, 'A_1.EIn')
+    kwargs = dict(forcefield=os.path.join(prms, 'mm3.prm'), write_file=False, mm_version='8')
+    first = connectors.gaussian_tinker(['R', ein, None], **kwargs)
+    assert connectors.gaussian_tinker(['R', ein, None], **kwargs) == first
+    assert len(calls) == 1
+    connectors.gaussian_tinker(['R', ein, None], cache_results=False, **kwargs)
+    assert len(calls) == 2
+    assert results.statistics() == {'hits': 1, 'misses': 1}
+
+
+def test_gaussian_tinker_writes_eou(cache, monkeypatch, tmpdir):
+    def run_tinker(xyz, n_atoms, key, gradients=False, hessian=False, **kwargs):
+        return _results(n_atoms, 2 if hessian else int(gradients))
+
+    monkeypatch.setattr(connectors, 'run_tinker', run_tinker)
+    ein = os.path.join(eins, 'A_1.EIn')
+    eou = str(tmpdir.join('A_1.EOu'))
+    kwargs = dict(forcefield=os.path.join(prms, 'mm3.prm'), mm_version='8')
+    contents = connectors.gaussian_tinker(['R', ein, eou], **kwargs)
+    with open(eou) as f:
+        assert f.read() == contents
+    os.remove(eou)
+    assert connectors.gaussian_tinker(['R', ein, eou], write_file=False, **kwargs) == contents
+    assert not os.path.exists(eou)
+    assert connectors.gaussian_tinker_eou(['R', ein, eou], **kwargs) == eou
+    with open(eou) as f:
+        assert f.read() == contents
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+import subprocess
+import sys
+import pytest
+from garleek import scratch
+
+
+@pytest.fixture
+def root(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_SCRATCH_DIR', str(tmpdir.join('scratch')))
+    monkeypatch.delenv('GARLEEK_KEEP_SCRATCH', raising=False)
+    return tmpdir.join('scratch')
+
+
+def test_scratch_root(monkeypatch):
+    monkeypatch.setenv('GARLEEK_SCRATCH_DIR', '/some/where')
+    assert scratch.scratch_root() == '/some/where'
+    monkeypatch.delenv('GARLEEK_SCRATCH_DIR')
+    assert os.path.basename(scratch.scratch_root()) == 'scratch'
+
+
+def test_job_scratch(root):
+    with scratch.job_scratch('Gau-123') as first, scratch.job_scratch('Gau-123') as second:
+        assert first != second
+        assert os.path.basename(first).split('.')[1:3] == [str(os.getpid()), 'Gau-123']
+        open(os.path.join(first, 'garleek.key'), 'w').close()
+    assert root.listdir() == []
+    with pytest.raises(RuntimeError):
+        with scratch.job_scratch('Gau-123') as path:
+            raise RuntimeError
+    assert not os.path.exists(path)
+
+
+def test_job_scratch_keep(root, monkeypatch):
+    monkeypatch.setenv('GARLEEK_KEEP_SCRATCH', '1')
+    with scratch.job_scratch('Gau-123') as path:
+        pass
+    assert os.path.isdir(path)
+    with scratch.job_scratch('Gau-123', keep=False) as other:
+        pass
+    assert not os.path.exists(other)
+
+
+def test_sweep(root):
+    dead = subprocess.Popen([sys.executable, '-c', ''])
+    dead.wait()
+    root.ensure_dir('{}.{}.Gau-1.abc'.format(scratch._host(), dead.pid))
+    kept = root.ensure_dir('{}.{}.Gau-2.abc'.format(scratch._host(), dead.pid))
+    kept.ensure('.keep')
+    alive = root.ensure_dir('{}.{}.Gau-3.abc'.format(scratch._host(), os.getppid()))
+    other_host = root.ensure_dir('otherhost.{}.Gau-4.abc'.format(dead.pid))
+    with scratch.job_scratch('Gau-5'):
+        pass
+    assert sorted(root.listdir()) == sorted([kept, alive, other_host])
+
+
+def test_sweep_checks_owners(root):
+    dead = subprocess.Popen([sys.executable, '-c', ''])
+    dead.wait()
+    name = '{}.{}.Gau-{{}}.abc'.format(scratch._host(), dead.pid)
+    root.ensure_dir()
+    target = root.dirpath().ensure_dir('target')
+    target.ensure('data')
+    os.symlink(str(target), str(root.join(name.format(1))))
+    if os.getuid() == 0:  # can plant a directory of another user
+        planted = root.ensure_dir(name.format(2))
+        os.chown(str(planted), 65534, 65534)
+    leftover = root.ensure_dir(name.format(3))
+    # Roots that others can write to are left alone
+    root.chmod(0o777)
+    scratch.sweep(str(root))
+    assert leftover.check()
+    root.chmod(0o755)
+    scratch.sweep(str(root))
+    assert not leftover.check()
+    assert target.join('data').check()
+    assert sorted(p.basename for p in root.listdir()) == sorted(
+        name.format(i) for i in ((1, 2) if os.getuid() == 0 else (1,)))
+
+
+def test_default_root_private(tmpdir, monkeypatch):
+    monkeypatch.delenv('GARLEEK_SCRATCH_DIR', raising=False)
+    monkeypatch.setattr(scratch, 'node_local_dir', lambda: str(tmpdir))
+    with scratch.job_scratch('Gau-123') as path:
+        assert os.path.dirname(path) == str(tmpdir.join('scratch'))
+    assert tmpdir.join('scratch').stat().mode & 0o777 == 0o700
+    os.rmdir(str(tmpdir.join('scratch')))
+    os.symlink(str(tmpdir.ensure_dir('elsewhere')), str(tmpdir.join('scratch')))
+    with pytest.raises(OSError):
+        with scratch.job_scratch('Gau-123'):
+            pass
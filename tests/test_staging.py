@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division, absolute_import
+import os
+from garleek import staging
+
+
+def test_stage_dir(monkeypatch):
+    monkeypatch.setenv('GARLEEK_STAGE_DIR', '/some/where')
+    assert staging.stage_dir() == '/some/where'
+    monkeypatch.delenv('GARLEEK_STAGE_DIR')
+    assert os.path.basename(staging.stage_dir()).startswith('garleek-')
+
+
+def test_stage_file(tmpdir, monkeypatch):
+    monkeypatch.setenv('GARLEEK_STAGE_DIR', str(tmpdir.join('stage')))
+    source = tmpdir.join('shared', 'ff.prm')
+    source.write('atom 1 1 C "Carbon" 6 12.000 4\n', ensure=True)
+    staged = staging.stage_file(str(source))
+    assert staged.startswith(str(tmpdir.join('stage')))
+    assert staged.endswith('-ff.prm')
+    with open(staged) as f:
+        assert f.read() == source.read()
+    assert staging.stage_file(staged) == staged
+    # Not hashed again while unchanged: only the sidecar name is a digest
+    digests = []
+    digest = staging.digest
+    monkeypatch.setattr(staging, 'digest', lambda *a: digests.append(a) or digest(*a))
+    assert staging.stage_file(str(source)) == staged
+    assert digests == [(str(source),)]
+    # Changes are picked up
+    source.write('atom 1 1 C "Carbon" 6 13.000 4\n')
+    os.utime(str(source), (0, 0))
+    restaged = staging.stage_file(str(source))
+    assert restaged != staged
+    with open(restaged) as f:
+        assert f.read() == source.read()
+    # Removed copies are staged again
+    os.remove(restaged)
+    assert staging.stage_file(str(source)) == restaged
+    assert os.path.isfile(restaged)
+
+
+def test_stage_file_unwritable(tmpdir, monkeypatch):
+    stage = tmpdir.join('stage')
+    stage.write('not a directory')
+    monkeypatch.setenv('GARLEEK_STAGE_DIR', str(stage))
+    source = tmpdir.join('ff.prm')
+    source.write('')
+    assert staging.stage_file(str(source)) == str(source)
+
+
+def test_node_local_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(staging, '_fallback', {})
+    path = staging.node_local_dir(str(tmpdir))
+    assert os.path.dirname(path) == str(tmpdir)
+    assert os.path.basename(path).startswith('garleek-')
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    os.chmod(path, 0o777)
+    assert staging.node_local_dir(str(tmpdir)) == path
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    # Someone else's directory (here, a link to it) is not used
+    os.rmdir(path)
+    tmpdir.mkdir('planted')
+    os.symlink(str(tmpdir.join('planted')), path)
+    fallback = staging.node_local_dir(str(tmpdir))
+    assert fallback not in (path, str(tmpdir.join('planted')))
+    assert os.stat(fallback).st_mode & 0o777 == 0o700
+    assert staging.node_local_dir(str(tmpdir)) == fallback